@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Benchmarks ``SendKindle.send_mail`` against a local SMTP sink.
+
+Every combination of the file sizes, file counts and transports given
+is run in a process of its own, so that its peak memory use can be
+measured, and reported as a line of JSON: the throughput, the time to
+the first byte of the message reaching the server, the total latency
+and the peak RSS. With ``--output``, the results are also written to a
+file, which a later run can be compared with using ``--baseline``::
+
+    $ python benchmarks/bench_send.py --output before.json
+    $ python benchmarks/bench_send.py --baseline before.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.dirname(here))
+
+from smtpsink import SMTPSink
+import sendkindle
+
+
+SIZES = ['100K', '1M', '10M', '50M']
+COUNTS = [1, 5]
+# The SMTP types of sendkindle, and how the sink is run for them
+TRANSPORTS = {
+    'plain': ('', 'plain'),
+    'starttls': ('starttls', 'starttls'),
+    'tls': ('tls', 'tls'),
+}
+
+
+def parse_size(text):
+    """Return the number of bytes in ``text``, like "100K" or "50M"."""
+    units = {'K': 1024, 'M': 1024 * 1024}
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+
+def make_files(directory, size, count):
+    """Write ``count`` files of ``size`` random bytes, which do not
+    compress, and return their paths.
+    """
+    files = []
+    for index in range(count):
+        filename = os.path.join(directory, 'document%d.pdf' % index)
+        with open(filename, 'wb') as f:
+            remaining = size
+            while remaining:
+                data = os.urandom(min(remaining, 1024 * 1024))
+                f.write(data)
+                remaining -= len(data)
+        files.append(filename)
+    return files
+
+
+def run_case(case):
+    """Send the files of ``case`` once through a fresh sink, and
+    return the measurements.
+    """
+    smtp_type, mode = TRANSPORTS[case['transport']]
+    extensions = case.get('extensions') or ()
+    sink = SMTPSink(mode, extensions)
+    directory = tempfile.mkdtemp(prefix='bench-send-')
+    try:
+        files = make_files(directory, case['size'], case['count'])
+        settings = {
+            'user': {'email': 'bench@example.com'},
+            'smtp': {
+                'host': 'localhost', 'port': sink.port,
+                'username': '', 'password': '', 'type': smtp_type,
+                'engine': case.get('engine', ''),
+                # The sink's certificate is self-signed
+                'ca-file': getattr(sink, 'certfile', ''),
+            },
+        }
+        sender = sendkindle.SendKindle(settings)
+        start = time.time()
+        records = []
+        sender.add_observer(records.append)
+        sender.send_mail('kindle@example.com', files)
+        latency = time.time() - start
+        sender.close()
+    finally:
+        shutil.rmtree(directory)
+        sink.close()
+
+    message = sink.messages[0]
+    payload = case['size'] * case['count']
+    return dict(case, **{
+        'wire_bytes': message['bytes'],
+        'latency': round(latency, 6),
+        'ttfb': round(message['first_byte'] - start, 6),
+        'tls': records[-1]['phases']['tls']['time'],
+        'throughput': round(payload / latency),
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    })
+
+
+def run_matrix(args):
+    """Run every case in a child process, ``repeat`` times, and
+    return the results with the median latency of each.
+    """
+    results = []
+    for transport in args.transports:
+        for size in args.sizes:
+            for count in args.counts:
+                case = {'transport': transport, 'size': parse_size(size),
+                        'count': count, 'engine': args.engine,
+                        'extensions': args.extensions}
+                runs = []
+                for i in range(args.repeat):
+                    output = subprocess.check_output(
+                        [sys.executable, __file__, '--case', json.dumps(case)])
+                    runs.append(json.loads(output))
+                runs.sort(key=lambda run: run['latency'])
+                result = runs[len(runs) // 2]
+                result['peak_rss'] = max(run['peak_rss'] for run in runs)
+                results.append(result)
+                print json.dumps(result)
+                sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the cases that got slower than in ``baseline`` by more
+    than ``tolerance`` (a fraction), and return how many there were.
+    """
+    def key(result):
+        return (result['transport'], result['size'], result['count'],
+                result.get('engine', ''),
+                tuple(result.get('extensions', ())))
+    before = dict((key(r), r) for r in baseline['results'])
+    regressions = 0
+    for result in results:
+        old = before.get(key(result))
+        if not old:
+            continue
+        change = result['throughput'] / float(old['throughput']) - 1
+        if change < -tolerance:
+            regressions += 1
+            print >>sys.stderr, \
+                'Regression: %s %s x %d: %+.1f%% throughput' % (
+                    result['transport'], sendkindle.sizeof_fmt(result['size']),
+                    result['count'], change * 100)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark sending documents to a local SMTP sink.')
+    parser.add_argument(
+        '--sizes', nargs='+', default=SIZES, metavar='SIZE',
+        help='file sizes, like 100K or 50M (default: %s)' % ' '.join(SIZES))
+    parser.add_argument(
+        '--counts', nargs='+', type=int, default=COUNTS, metavar='N',
+        help='numbers of files per message (default: %s)' %
+             ' '.join(map(str, COUNTS)))
+    parser.add_argument(
+        '--transports', nargs='+', default=sorted(TRANSPORTS),
+        choices=sorted(TRANSPORTS))
+    parser.add_argument(
+        '--engine', default='', choices=['', 'async'],
+        help='the SMTP engine to use')
+    parser.add_argument(
+        '--extensions', nargs='*', default=[], metavar='EXTENSION',
+        help='ESMTP extensions for the sink to offer, like 8BITMIME, '
+             'CHUNKING or BINARYMIME')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='runs of every case; the median is reported')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument(
+        '--baseline',
+        help='compare with the results of a previous run, and exit '
+             'with status 1 if a case got slower')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1,
+        help='how much lower the throughput may be than in the '
+             'baseline, as a fraction (default: 0.1)')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print json.dumps(run_case(json.loads(args.case)))
+        return 0
+
+    results = run_matrix(args)
+    report = {
+        'version': '.'.join(sendkindle.__version__),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(results, json.load(f), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Benchmarks how quickly the graphical utility shows its window.
+
+Every run starts a fresh process, like the file manager does, which
+opens the send window for a document and exits once the window has
+been drawn for the first time. Reported, as a line of JSON, are the
+time it took to import ``sendkindle_gtk`` and the time from starting
+the process to the first frame, the median of ``--repeat`` runs.
+This needs a display. Like ``bench_send.py``, the results can be
+written to a file with ``--output`` and compared with ``--baseline``::
+
+    $ python benchmarks/bench_startup.py --output before.json
+    $ python benchmarks/bench_startup.py --baseline before.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import shutil
+import subprocess
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+
+def run_case(document):
+    """Open the window for ``document``, and return the times at
+    which the import was done and the first frame was drawn.
+    """
+    start = time.time()
+    import sendkindle_gtk
+    from gi.repository import Gtk, GObject
+    imported = time.time()
+
+    times = {}
+
+    def drawn(widget, context):
+        if 'first_frame' not in times:
+            times['first_frame'] = time.time()
+            GObject.idle_add(Gtk.main_quit)
+
+    GObject.threads_init()
+    application = sendkindle_gtk.GtkApplication()
+    window = sendkindle_gtk.MainWindow(application)
+    window.window.connect_after('draw', drawn)
+    window.use_files([document])
+    window.show()
+    Gtk.main()
+    return {'start': start, 'imported': imported,
+            'first_frame': times['first_frame']}
+
+
+def run(repeat):
+    """Start the utility ``repeat`` times, with settings of its own,
+    and return the median timings.
+    """
+    directory = tempfile.mkdtemp(prefix='bench-startup-')
+    try:
+        env = dict(os.environ)
+        for name in ('XDG_CONFIG_HOME', 'XDG_DATA_HOME', 'XDG_CACHE_HOME',
+                     'XDG_RUNTIME_DIR'):
+            env[name] = os.path.join(directory, name.lower())
+            os.mkdir(env[name])
+        document = os.path.join(directory, 'document.txt')
+        with open(document, 'w') as f:
+            f.write('Hello Kindle\n')
+
+        runs = []
+        for i in range(repeat):
+            spawned = time.time()
+            output = subprocess.check_output(
+                [sys.executable, __file__, '--case', document], env=env)
+            times = json.loads(output)
+            runs.append({
+                'import': round(times['imported'] - times['start'], 6),
+                'first_frame': round(times['first_frame'] - spawned, 6),
+            })
+    finally:
+        shutil.rmtree(directory)
+
+    result = {}
+    for key in ('import', 'first_frame'):
+        values = sorted(run[key] for run in runs)
+        result[key] = values[len(values) // 2]
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """Print the timings that got slower than in ``baseline`` by more
+    than ``tolerance`` (a fraction), and return how many there were.
+    """
+    regressions = 0
+    for key in ('import', 'first_frame'):
+        old = baseline['result'].get(key)
+        if not old:
+            continue
+        change = result[key] / float(old) - 1
+        if change > tolerance:
+            regressions += 1
+            print >>sys.stderr, 'Regression: %s: %+.1f%% time' % (
+                key, change * 100)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the start of the graphical utility.')
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='runs; the median is reported')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument(
+        '--baseline',
+        help='compare with the results of a previous run, and exit '
+             'with status 1 if the start got slower')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1,
+        help='how much longer the start may take than in the baseline, '
+             'as a fraction (default: 0.1)')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print json.dumps(run_case(args.case))
+        return 0
+
+    result = run(args.repeat)
+    print json.dumps(result)
+    import sendkindle
+    report = {
+        'version': '.'.join(sendkindle.__version__),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'result': result,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(result, json.load(f), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+An SMTP server that accepts every message and throws it away, for
+benchmarking the send path without a network or a real mail server.
+
+It runs in threads of the benchmarking process, listening on
+localhost, and notes for every message when the first and the last
+byte of it arrived.
+"""
+
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import SocketServer
+
+
+def make_certificate(directory):
+    """Create a self-signed certificate for localhost and 127.0.0.1 in
+    ``directory`` with the ``openssl`` command, and return the paths
+    of the certificate and of the key.
+    """
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-subj', '/CN=localhost', '-days', '1',
+             '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+             '-keyout', keyfile, '-out', certfile],
+            stdout=devnull, stderr=devnull)
+    return certfile, keyfile
+
+
+class SinkHandler(SocketServer.StreamRequestHandler):
+    """Speaks just enough ESMTP to take messages from ``sendkindle``.
+    """
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        self.tls = server.mode == 'tls'
+        self.message = None
+        self.reply('220 localhost sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO', 'LHLO'):
+                lines = ['localhost'] + list(server.extensions)
+                if server.mode == 'starttls' and not self.tls:
+                    lines.append('STARTTLS')
+                lines.append('AUTH PLAIN LOGIN')
+                for extension in lines[:-1]:
+                    self.wfile.write('250-%s\r\n' % extension)
+                self.reply('250 %s' % lines[-1])
+            elif verb == 'STARTTLS':
+                self.reply('220 go ahead')
+                self.connection = server.context.wrap_socket(
+                    self.connection, server_side=True)
+                self.rfile = self.connection.makefile('rb', -1)
+                self.wfile = self.connection.makefile('wb', 0)
+                self.tls = True
+            elif verb == 'AUTH':
+                self.reply('235 ok')
+            elif verb == 'MAIL':
+                self.message = {'recipients': 0, 'bytes': 0,
+                                'first_byte': None, 'last_byte': None}
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                self.message['recipients'] += 1
+                self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                self.read_data()
+            elif verb == 'BDAT':
+                args = command.split()
+                self.read_chunk(int(args[1]))
+                if len(args) > 2:
+                    self.received()
+                else:
+                    self.reply('250 chunk ok')
+            elif verb in ('NOOP', 'RSET'):
+                self.reply('250 ok')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('500 unknown command')
+
+    def read_data(self):
+        message = self.message
+        while True:
+            line = self.rfile.readline()
+            if not line or line == '.\r\n':
+                break
+            if message['first_byte'] is None:
+                message['first_byte'] = time.time()
+            message['bytes'] += len(line)
+        self.received()
+
+    def read_chunk(self, size):
+        message = self.message
+        while size:
+            data = self.rfile.read(min(size, 64 * 1024))
+            if not data:
+                break
+            if message['first_byte'] is None:
+                message['first_byte'] = time.time()
+            message['bytes'] += len(data)
+            size -= len(data)
+
+    def received(self):
+        self.message['last_byte'] = time.time()
+        with self.server.lock:
+            self.server.messages.append(self.message)
+        self.message = None
+        self.reply('250 queued')
+
+
+class SMTPSink(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Listens on a free port of localhost, with ``mode`` being
+    "plain", "starttls" or "tls" (TLS from the start), and
+    advertising ``extensions``.
+
+    The messages received are in ``messages``, as dicts of the number
+    of ``recipients`` and ``bytes``, and the times of the
+    ``first_byte`` and ``last_byte`` received. All TLS connections
+    share one context, so clients can resume their sessions.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, mode='plain', extensions=()):
+        SocketServer.TCPServer.__init__(
+            self, ('127.0.0.1', 0), SinkHandler)
+        self.mode = mode
+        self.extensions = extensions
+        self.messages = []
+        self.lock = threading.Lock()
+        self.directory = None
+        if mode != 'plain':
+            self.directory = tempfile.mkdtemp(prefix='smtpsink-')
+            self.certfile, self.keyfile = make_certificate(self.directory)
+            self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.context.load_cert_chain(self.certfile, self.keyfile)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def get_request(self):
+        sock, address = SocketServer.TCPServer.get_request(self)
+        if self.mode == 'tls':
+            sock = self.context.wrap_socket(sock, server_side=True)
+        return sock, address
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        if self.directory:
+            shutil.rmtree(self.directory)
@@ -0,0 +1,4523 @@
+# coding: utf8
+"""
+Send to Kindle core: sends documents to the Amazon Kindle delivery
+service, and manages the configuration. Does not depend on GTK, so
+it can be used by scripts and on headless machines.
+
+Created 2011 by Michael Elsdörfer <michael@elsdoerfer.com>.
+
+Licensed under GNU AGPL 3.
+"""
+
+import os
+import re
+import sys
+import errno
+import argparse
+import asyncore
+import logging
+import multiprocessing
+import tempfile
+import shutil
+from os import path
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+import json
+import base64
+import hashlib
+import random
+import select
+import struct
+from email.header import Header
+from email.message import Message
+import smtplib
+import socket
+import ssl
+import SocketServer
+import sqlite3
+import subprocess
+import threading
+import time
+import urllib
+import urlparse
+import zipfile
+
+
+__version__ = ('0', '5', '9')
+
+
+# Receives details on errors that are reported to the user in short
+log = logging.getLogger('sendkindle')
+log.addHandler(logging.NullHandler())
+# Receives a JSON line with timings for every message sent
+stats_log = logging.getLogger('sendkindle.stats')
+
+
+def sizeof_fmt(num):
+    """Format number of bytes in human readable form.
+
+    http://blogmag.net/blog/read/38/Print_human_readable_file_size
+    """
+    for x in ['bytes', 'KB', 'MB', 'GB', 'TB']:
+        if num < 1024.0:
+            return "%3.1f %s" % (num, x)
+        num /= 1024.0
+    return num
+
+
+class SendKindleException(StandardError):
+    pass
+
+
+class SendCancelled(SendKindleException):
+    pass
+
+
+# Limits Amazon imposes on a single e-mail sent to the personal
+# document service.
+MAX_MESSAGE_SIZE = 50 * 1024 * 1024
+MAX_ATTACHMENTS = 25
+
+
+# Attachments are read in multiples of 57 bytes, which is what fits
+# into one 76 character line of base64; that way every chunk encodes
+# to complete lines and can be written out on its own.
+ENCODE_CHUNK_SIZE = 57 * 1024
+# Largest piece of the message written to the server at once; a
+# cancelled send stops after the current one.
+SEND_CHUNK_SIZE = 64 * 1024
+# Largest BDAT command; the server acknowledges each one.
+BDAT_CHUNK_SIZE = 1024 * 1024
+
+# How a message goes on the wire: everything 7bit, with attachments
+# in base64; attachments that allow it as 8bit (8BITMIME); or all
+# attachments as raw binary, which needs CHUNKING (BINARYMIME). The
+# value is the BODY parameter of the MAIL command.
+TRANSFER_MODES = OrderedDict([
+    ('binarymime', 'BODY=BINARYMIME'),
+    ('8bitmime', 'BODY=8BITMIME'),
+    ('base64', None),
+])
+
+
+def base64_size(num):
+    """Return the number of bytes ``num`` bytes take up once encoded
+    as base64 with CRLF line endings (the way ``encode_base64_chunk``
+    does it).
+    """
+    lines, rest = divmod(num, 57)
+    size = lines * 78
+    if rest:
+        size += (rest + 2) // 3 * 4 + 2
+    return size
+
+
+def encode_base64_chunk(data):
+    """Base64-encode ``data``, split into 76 character lines, each
+    terminated by CRLF.
+    """
+    encoded = base64.b64encode(data)
+    return ''.join(['%s\r\n' % encoded[i:i+76]
+                    for i in xrange(0, len(encoded), 76)])
+
+
+class SendStats(object):
+    """Collects the wall time spent in, and the bytes processed by,
+    each phase of sending a message.
+    """
+
+    PHASES = ('compress', 'read', 'encode', 'flatten', 'connect', 'tls',
+              'auth', 'data', 'throttle')
+
+    def __init__(self):
+        self.phases = OrderedDict(
+            (phase, {'time': 0.0, 'bytes': 0}) for phase in self.PHASES)
+        # TLS handshakes done, and how many of them resumed a session
+        self.handshakes = 0
+        self.resumed = 0
+
+    def add(self, phase, seconds, bytes=0):
+        self.phases[phase]['time'] += seconds
+        self.phases[phase]['bytes'] += bytes
+
+    @contextmanager
+    def measure(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start)
+
+    def get_time(self, phase):
+        return self.phases[phase]['time']
+
+    def to_dict(self):
+        return dict((phase, {'time': round(values['time'], 6),
+                             'bytes': values['bytes']})
+                    for phase, values in self.phases.items())
+
+
+class SendProgress(object):
+    """Tracks how many bytes of a message have been written to the
+    server, and allows another thread to cancel the send.
+
+    ``callback`` is called with the instance, from the sending
+    thread, at most every ``interval`` seconds and once the message
+    is complete.
+    """
+
+    def __init__(self, callback=None, interval=0.25):
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+        # Until when a rate limit holds the send back, and for how
+        # long it has in total
+        self.paused_until = 0
+        self.throttled = 0.0
+        self.begin(0)
+
+    def begin(self, total):
+        """Start tracking a message of ``total`` bytes."""
+        self.total = total
+        self.sent = 0
+        self.started = self.reported = time.time()
+
+    def advance(self, bytes):
+        """Note that ``bytes`` more have been written. Raises
+        ``SendCancelled`` if the send has been cancelled meanwhile.
+        """
+        self.sent += bytes
+        now = time.time()
+        if self.callback and (now - self.reported >= self.interval or
+                              self.sent >= self.total):
+            self.reported = now
+            self.callback(self)
+        self.check()
+
+    def check(self):
+        if self.cancelled:
+            raise SendCancelled('Cancelled')
+
+    def throttle(self, seconds):
+        """Note that a rate limit holds the send back for ``seconds``."""
+        self.paused_until = time.time() + seconds
+        self.throttled += seconds
+        if self.callback:
+            self.callback(self)
+
+    def sleep(self, seconds):
+        """Wait for ``seconds`` because of a rate limit. Raises
+        ``SendCancelled`` as soon as the send is cancelled meanwhile.
+        """
+        self.throttle(seconds)
+        while True:
+            self.check()
+            remaining = self.paused_until - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 0.1))
+
+    @property
+    def paused(self):
+        return time.time() < self.paused_until
+
+    def cancel(self):
+        self.cancelled = True
+
+    @property
+    def rate(self):
+        """Bytes per second written so far."""
+        elapsed = time.time() - self.started
+        return self.sent / elapsed if elapsed > 0 else 0
+
+
+def is_uri(filename):
+    """Return whether ``filename`` is a URI, like smb://server/doc.pdf,
+    rather than a local path.
+    """
+    return re.match(r'[a-zA-Z][a-zA-Z0-9+.-]*://', filename) is not None
+
+
+def get_basename(filename):
+    """Return the name of the file at the path or URI ``filename``."""
+    if is_uri(filename):
+        return urllib.unquote(path.basename(urlparse.urlparse(filename).path))
+    return path.basename(filename)
+
+
+def get_absolute(filename):
+    """Return ``filename`` as an absolute path, or as it is, if it is
+    a URI.
+    """
+    return filename if is_uri(filename) else path.abspath(filename)
+
+
+def import_gio():
+    """Return the ``Gio`` and ``GLib`` modules, which are only needed
+    to read files given by URI. Raises ``IOError`` if they are not
+    available.
+    """
+    try:
+        from gi.repository import Gio, GLib
+    except ImportError:
+        raise IOError('PyGObject is needed to read files by URI')
+    return Gio, GLib
+
+
+class FileInfo(object):
+    """The size and modification time of a file read through GIO, in
+    the form of an ``os.stat`` result.
+    """
+
+    def __init__(self, st_size, st_mtime):
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+
+
+def stat_file(filename):
+    """Like ``os.stat``, for a path or a URI."""
+    if not is_uri(filename):
+        return os.stat(filename)
+    Gio, GLib = import_gio()
+    try:
+        info = Gio.File.new_for_uri(filename).query_info(
+            'standard::size,time::modified', Gio.FileQueryInfoFlags.NONE,
+            None)
+    except GLib.GError, e:
+        raise IOError(e.message)
+    return FileInfo(info.get_size(), info.get_attribute_uint64(
+        'time::modified'))
+
+
+class GioReader(object):
+    """Reads a file given by URI, through GIO and thus from anywhere
+    GVFS can reach, in chunks of ``ENCODE_CHUNK_SIZE`` bytes.
+
+    The reads are asynchronous: while a chunk is being processed, GIO
+    already fetches the next one. Their results are delivered to a
+    main context of the reader's own, which it only runs while waiting
+    for a chunk, so this works in any thread and does not need the
+    main loop of the application.
+    """
+
+    def __init__(self, uri):
+        self.Gio, self.GLib = import_gio()
+        self.file = self.Gio.File.new_for_uri(uri)
+        self.context = self.GLib.MainContext()
+
+    def start(self, method, *args):
+        """Call the asynchronous ``method`` with ``args``, and return
+        a list that receives its result.
+        """
+        result = []
+        self.context.push_thread_default()
+        try:
+            method(*args + (self.GLib.PRIORITY_DEFAULT, None,
+                            lambda source, res, data: result.append(res),
+                            None))
+        finally:
+            self.context.pop_thread_default()
+        return result
+
+    def wait(self, result):
+        while not result:
+            self.context.iteration(True)
+        return result[0]
+
+    def __iter__(self):
+        try:
+            stream = self.file.read_finish(
+                self.wait(self.start(self.file.read_async)))
+            pending = None
+            try:
+                pending = self.start(stream.read_bytes_async,
+                                     ENCODE_CHUNK_SIZE)
+                while True:
+                    data = stream.read_bytes_finish(
+                        self.wait(pending)).get_data()
+                    pending = None
+                    if not data:
+                        break
+                    # Read ahead while the chunk is being used
+                    pending = self.start(stream.read_bytes_async,
+                                         ENCODE_CHUNK_SIZE)
+                    yield data
+            finally:
+                # The stream cannot be closed while reading
+                if pending is not None:
+                    self.wait(pending)
+                stream.close(None)
+        except self.GLib.GError, e:
+            raise IOError(e.message)
+
+
+def iter_file(filename, stats=None):
+    """Yield the contents of ``filename``, a path or a URI, in
+    chunks.
+    """
+    if is_uri(filename):
+        chunks = iter(GioReader(filename))
+        while True:
+            start = time.time()
+            data = next(chunks, '')
+            if stats:
+                stats.add('read', time.time() - start, len(data))
+            if not data:
+                break
+            yield data
+        return
+    with open(filename, 'rb') as f:
+        while True:
+            start = time.time()
+            data = f.read(ENCODE_CHUNK_SIZE)
+            if stats:
+                stats.add('read', time.time() - start, len(data))
+            if not data:
+                break
+            yield data
+
+
+def iter_encoded(file_path, stats=None):
+    """Yield the contents of ``file_path``, base64-encoded."""
+    for data in iter_file(file_path, stats):
+        start = time.time()
+        chunk = encode_base64_chunk(data)
+        if stats:
+            stats.add('encode', time.time() - start, len(chunk))
+        yield chunk
+
+
+def encode_file(file_path, directory):
+    """Write the contents of ``file_path``, base64-encoded, into a new
+    temporary file in ``directory``. Returns the name of that file,
+    and the SHA-1 and the size of the contents.
+
+    Runs in the worker processes of ``Prefetcher``.
+    """
+    fd, temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    digest = hashlib.sha1()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for data in iter_file(file_path):
+                digest.update(data)
+                size += len(data)
+                f.write(encode_base64_chunk(data))
+    except:
+        os.unlink(temp)
+        raise
+    return temp, digest.hexdigest(), size
+
+
+def is_8bit_clean(filename, max_line=998):
+    """Return whether the contents of ``filename`` may be sent with
+    Content-Transfer-Encoding 8bit as they are: no NUL bytes, CR and
+    LF only as CRLF pairs, and no lines longer than ``max_line``.
+    """
+    line = 0
+    rest = ''
+    for data in iter_file(filename):
+        data = rest + data
+        # A CRLF may be split across chunks
+        if data.endswith('\r'):
+            data, rest = data[:-1], '\r'
+        else:
+            rest = ''
+        if '\0' in data:
+            return False
+        lines = data.split('\r\n')
+        for text in lines:
+            if '\r' in text or '\n' in text:
+                return False
+        line += len(lines[0])
+        if line > max_line or \
+                any(len(text) > max_line for text in lines[1:]):
+            return False
+        if len(lines) > 1:
+            line = len(lines[-1])
+    return not rest
+
+
+def choose_transfer_mode(has_extension, message):
+    """Return the best of ``TRANSFER_MODES`` that both ``message``
+    and the server, as described by the ``has_extension`` callable
+    (taking a lowercase EHLO keyword), support.
+    """
+    modes = getattr(message, 'modes', ('base64',))
+    if 'binarymime' in modes and has_extension('chunking') and \
+            has_extension('binarymime'):
+        return 'binarymime'
+    if '8bitmime' in modes and has_extension('8bitmime'):
+        return '8bitmime'
+    return 'base64'
+
+
+def generate(message, mode='base64'):
+    """Return an iterator over the text of ``message``, as encoded
+    for ``mode``.
+    """
+    if mode == 'base64':
+        return iter(message)
+    return message.generate(mode)
+
+
+class TimedChunks(object):
+    """Wraps an iterable of message chunks, keeping track of the
+    time spent producing them in ``generated``. Once exhausted, that
+    time is recorded in ``stats`` as flattening, as far as it has not
+    been recorded as reading or encoding meanwhile.
+    """
+
+    def __init__(self, chunks, stats):
+        self.chunks = chunks
+        self.stats = stats
+        self.generated = 0.0
+
+    def __iter__(self):
+        produced = self.stats.get_time('read') + self.stats.get_time('encode')
+        size = 0
+        chunks = iter(self.chunks)
+        while True:
+            start = time.time()
+            chunk = next(chunks, None)
+            self.generated += time.time() - start
+            if chunk is None:
+                break
+            size += len(chunk)
+            yield chunk
+        produced = self.stats.get_time('read') + \
+            self.stats.get_time('encode') - produced
+        self.stats.add('flatten', max(self.generated - produced, 0), size)
+
+
+def file_digest(file_path):
+    """Return the SHA-1 of the contents of ``file_path``."""
+    digest = hashlib.sha1()
+    for data in iter_file(file_path):
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def format_headers(msg):
+    """Return the headers of the ``email.message.Message`` instance
+    ``msg``, with CRLF line endings and including the empty line that
+    separates them from the body.
+    """
+    try:
+        lines = ['%s: %s\n' % (name, Header(value, header_name=name).encode())
+                 for name, value in msg.items()]
+    except UnicodeError, e:
+        raise SendKindleException('Cannot encode the message headers: %s' % e)
+    return (''.join(lines) + '\n').replace('\n', '\r\n')
+
+
+def decode_path(filename):
+    """Return ``filename`` as unicode, decoding it with the filesystem
+    encoding, or as UTF-8 if that fails.
+    """
+    if isinstance(filename, unicode):
+        return filename
+    try:
+        return filename.decode(sys.getfilesystemencoding() or 'utf-8')
+    except UnicodeDecodeError:
+        return filename.decode('utf-8', 'replace')
+
+
+def get_filename_param(file_path):
+    """Return the ``filename`` parameter of the attachment header for
+    ``file_path``: its name if that is ASCII, otherwise a tuple that
+    makes ``email`` encode it as UTF-8 the RFC 2231 way.
+    """
+    name = decode_path(get_basename(file_path))
+    try:
+        return name.encode('ascii')
+    except UnicodeEncodeError:
+        return ('utf-8', '', name.encode('utf-8'))
+
+
+def dot_stuff(chunks):
+    """Apply SMTP dot-stuffing to a stream of message chunks, i.e.
+    double every dot at the start of a line, also if the line starts
+    at a chunk boundary.
+    """
+    line_start = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        chunk = chunk.replace('\n.', '\n..')
+        if line_start and chunk[0] == '.':
+            chunk = '.' + chunk
+        line_start = chunk[-1] == '\n'
+        yield chunk
+
+
+def as_list(recipient):
+    """Recipients may be given as a single address, or a list."""
+    if isinstance(recipient, basestring):
+        return [recipient]
+    return list(recipient)
+
+
+def pack_files(files, max_size=MAX_MESSAGE_SIZE, max_count=MAX_ATTACHMENTS):
+    """Group ``files`` into as few messages as possible, such that
+    no message exceeds ``max_size`` bytes (as encoded on the wire) or
+    ``max_count`` attachments.
+
+    Uses the first-fit decreasing heuristic on the file sizes. A file
+    that is too large by itself ends up in a group of its own. Returns
+    a list of lists of file paths.
+
+    Raises ``OSError`` if a file cannot be stat'ed.
+    """
+    sized = [(base64_size(stat_file(f).st_size), f) for f in files]
+    sized.sort(key=lambda item: item[0], reverse=True)
+
+    groups = []   # [free space, [files]]
+    for size, file_path in sized:
+        for group in groups:
+            if group[0] >= size and len(group[1]) < max_count:
+                group[0] -= size
+                group[1].append(file_path)
+                break
+        else:
+            groups.append([max_size - size, [file_path]])
+    return [group_files for free, group_files in groups]
+
+
+class OutgoingMessage(object):
+    """A MIME message with file attachments, generated on the fly.
+
+    Iterating over an instance yields the message text in chunks,
+    with CRLF line endings. The attachments are only read from disk,
+    one chunk at a time, and base64-encoded as the message is being
+    consumed, so memory use does not depend on the size of the files.
+
+    ``generate`` yields the message for the other ``TRANSFER_MODES``,
+    with attachments left unencoded where the mode allows it.
+    """
+
+    modes = tuple(TRANSFER_MODES)
+
+    def __init__(self, sender, recipient, files, convert=True, cache=None,
+                 stats=None):
+        self.files = files
+        self.cache = cache
+        self.stats = stats
+        start = time.time()
+        self.boundary = '===============%d==' % random.randint(0, sys.maxint)
+
+        # The same message may go to many devices, which do not need
+        # to know about each other.
+        recipients = as_list(recipient)
+        if len(recipients) == 1:
+            to = recipients[0]
+        else:
+            to = 'undisclosed-recipients:;'
+
+        msg = Message()
+        msg['Content-Type'] = 'multipart/mixed'
+        msg.set_param('boundary', self.boundary)
+        msg['MIME-Version'] = '1.0'
+        msg['From'] = sender
+        msg['To'] = to
+        msg['Subject'] = 'convert' if convert else ''
+        self.headers = format_headers(msg)
+
+        self.parts = []
+        for file_path in files:
+            self.parts.append((file_path, stat_file(file_path).st_size))
+        self.part_headers = {}
+        self.clean = {}
+        if stats:
+            stats.add('flatten', time.time() - start)
+
+    @property
+    def size(self):
+        """The total size of the message in bytes, before
+        dot-stuffing.
+        """
+        return self.get_size()
+
+    def get_size(self, mode='base64'):
+        """The size of the message as generated for ``mode``."""
+        delimiter = len('--%s\r\n' % self.boundary)
+        size = len(self.headers) + delimiter + 2
+        for file_path, filesize in self.parts:
+            encoding = self.get_encoding(file_path, mode)
+            size += delimiter + len(self.get_part_headers(file_path, encoding))
+            if encoding == 'base64':
+                size += base64_size(filesize)
+            else:
+                # The line break before the next delimiter
+                size += filesize + 2
+        return size
+
+    def __iter__(self):
+        return self.generate()
+
+    def generate(self, mode='base64'):
+        yield self.headers
+        for file_path, filesize in self.parts:
+            encoding = self.get_encoding(file_path, mode)
+            yield '--%s\r\n%s' % (
+                self.boundary, self.get_part_headers(file_path, encoding))
+            if encoding == 'base64':
+                for chunk in self.iter_attachment(file_path):
+                    yield chunk
+            else:
+                if self.cache:
+                    self.cache.skip_pending(file_path)
+                for chunk in iter_file(file_path, self.stats):
+                    yield chunk
+                yield '\r\n'
+        yield '--%s--\r\n' % self.boundary
+
+    def get_encoding(self, file_path, mode):
+        """Return the Content-Transfer-Encoding to use for the
+        attachment ``file_path`` in ``mode``.
+        """
+        if mode == 'binarymime':
+            return 'binary'
+        if mode == '8bitmime':
+            if file_path not in self.clean:
+                self.clean[file_path] = is_8bit_clean(file_path)
+            if self.clean[file_path]:
+                return '8bit'
+        return 'base64'
+
+    def get_part_headers(self, file_path, encoding):
+        key = (file_path, encoding)
+        if key not in self.part_headers:
+            part = Message()
+            part['Content-Type'] = 'application/octet-stream'
+            part['MIME-Version'] = '1.0'
+            part['Content-Transfer-Encoding'] = encoding
+            part.add_header('Content-Disposition', 'attachment',
+                            filename=get_filename_param(file_path))
+            self.part_headers[key] = format_headers(part)
+        return self.part_headers[key]
+
+    def iter_attachment(self, file_path):
+        """Yield the body of an attachment, base64-encoded."""
+        if self.cache:
+            return self.cache.iter_encoded(file_path, self.stats)
+        return iter_encoded(file_path, self.stats)
+
+
+class PreparedMessage(object):
+    """A message that has been written to a file before, and is
+    sent from there, in chunks.
+    """
+
+    # Messages are always prepared in base64, which any server takes.
+    modes = ('base64',)
+
+    def __init__(self, filename, stats=None):
+        self.filename = filename
+        self.size = os.path.getsize(filename)
+        self.stats = stats
+
+    @classmethod
+    def from_message(cls, message, filename):
+        """Generate ``message`` into ``filename``."""
+        with open(filename, 'wb') as f:
+            for chunk in message:
+                f.write(chunk)
+        return cls(filename, getattr(message, 'stats', None))
+
+    def __iter__(self):
+        return iter_file(self.filename, self.stats)
+
+    def get_size(self, mode='base64'):
+        return self.size
+
+
+class SpoolingMessage(object):
+    """Wraps a message, writing a copy to ``filename`` while it is
+    being sent. Only a message that has been completely generated
+    ends up there (atomically), so a failed send can later be retried
+    from the copy, using ``PreparedMessage``.
+
+    Only the base64 form is kept, since the retry might go to a server
+    that does not support the others.
+    """
+
+    def __init__(self, message, filename):
+        self.message = message
+        self.filename = filename
+        self.size = message.size
+        self.stats = message.stats
+        self.modes = message.modes
+
+    def get_size(self, mode='base64'):
+        return self.message.get_size(mode)
+
+    def generate(self, mode):
+        return self.message.generate(mode)
+
+    def __iter__(self):
+        temp = self.filename + '.tmp'
+        f = open(temp, 'wb')
+        try:
+            for chunk in self.message:
+                f.write(chunk)
+                yield chunk
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(temp, self.filename)
+        finally:
+            if not f.closed:
+                f.close()
+                os.unlink(temp)
+
+
+class Packager(object):
+    """Compresses documents into ZIP archives, which the Kindle service
+    accepts as well, when that makes the upload noticeably smaller.
+
+    An archive is only used if its size on the wire is at least
+    ``min_saving`` (a fraction) below that of the document. Archives
+    are written to ``directory`` with ``zipfile``, which reads the
+    document in small pieces, and are kept there while the document
+    does not change; so is the decision not to compress it. Entries
+    not used for ``max_age`` seconds are removed.
+    """
+
+    # Formats that are compressed already
+    COMPRESSED = ('.zip', '.epub', '.mobi', '.azw', '.azw3', '.prc',
+                  '.gif', '.jpg', '.jpeg', '.png', '.gz', '.bz2')
+
+    def __init__(self, directory, min_saving=0.1, max_age=7 * 24 * 60 * 60):
+        self.directory = directory
+        self.min_saving = min_saving
+        self.max_age = max_age
+        if not path.exists(directory):
+            os.makedirs(directory)
+        self.evict()
+
+    def package(self, file_path, stats=None):
+        """Return the path of the archive to send instead of
+        ``file_path``, or ``file_path`` itself if it is better sent
+        as it is.
+        """
+        name = get_basename(file_path)
+        # zipfile can only read local files
+        if path.splitext(name)[1].lower() in self.COMPRESSED or \
+                is_uri(file_path):
+            return file_path
+        stat = os.stat(file_path)
+        entry = path.join(self.directory, hashlib.sha1(repr(
+            (path.abspath(file_path), stat.st_mtime, stat.st_size))
+        ).hexdigest())
+        archive = path.join(entry, path.splitext(name)[0] + '.zip')
+        skip = path.join(entry, 'skip')
+        for known in (archive, skip):
+            if path.exists(known):
+                os.utime(entry, None)
+                return archive if known == archive else file_path
+
+        start = time.time()
+        if not path.exists(entry):
+            os.makedirs(entry)
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=entry)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as z:
+                    z.write(file_path, name)
+            size = os.path.getsize(temp)
+            if stats:
+                stats.add('compress', time.time() - start, stat.st_size)
+            if base64_size(size) > \
+                    base64_size(stat.st_size) * (1 - self.min_saving):
+                os.unlink(temp)
+                open(skip, 'w').close()
+                return file_path
+            os.rename(temp, archive)
+        except:
+            if path.exists(temp):
+                os.unlink(temp)
+            raise
+        return archive
+
+    def evict(self):
+        """Remove the entries not used for ``max_age`` seconds."""
+        now = time.time()
+        for name in os.listdir(self.directory):
+            entry = path.join(self.directory, name)
+            try:
+                if now - os.stat(entry).st_mtime > self.max_age:
+                    shutil.rmtree(entry)
+            except OSError:
+                pass
+
+
+class AttachmentCache(object):
+    """Keeps the base64-encoded bodies of attachments on disk, so
+    that sending a document again only costs the upload.
+
+    Entries are named after the SHA-1 of the document's contents;
+    an index maps the paths of documents to their hash, together with
+    their modification time and size, so an entry is only used while
+    the document is unchanged. Once the entries take up more than
+    ``max_size`` bytes, the least recently used ones are removed.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.index_path = path.join(directory, 'index.json')
+        self.lock = threading.Lock()
+        # Documents being encoded elsewhere, with a callable that waits
+        # for their entry
+        self.pending = {}
+        if not path.exists(directory):
+            os.makedirs(directory)
+
+    def iter_encoded(self, file_path, stats=None):
+        """Yield the contents of ``file_path``, base64-encoded: from
+        the cache if possible, otherwise adding them to the cache
+        while they are encoded.
+        """
+        wait = self.take_pending(file_path)
+        if wait:
+            start = time.time()
+            wait()
+            if stats:
+                stats.add('encode', time.time() - start)
+        stat = stat_file(file_path)
+        entry = self.lookup(file_path, stat)
+        if entry:
+            # Entries are evicted by modification time
+            os.utime(entry, None)
+            for chunk in iter_file(entry, stats):
+                yield chunk
+            return
+
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        digest = hashlib.sha1()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for data in iter_file(file_path, stats):
+                    start = time.time()
+                    digest.update(data)
+                    size += len(data)
+                    chunk = encode_base64_chunk(data)
+                    f.write(chunk)
+                    if stats:
+                        stats.add('encode', time.time() - start, len(chunk))
+                    yield chunk
+        except:
+            os.unlink(temp)
+            raise
+        if size != stat.st_size:
+            # The file changed while we were reading it
+            os.unlink(temp)
+            return
+        self.store(file_path, stat, digest.hexdigest(), temp)
+
+    def add_pending(self, file_path, wait):
+        """Note that an entry for ``file_path`` is being made, and
+        that calling ``wait`` returns once it is there.
+        """
+        with self.lock:
+            self.pending[get_absolute(file_path)] = wait
+
+    def take_pending(self, file_path):
+        """Return the ``wait`` callable given for ``file_path``, if it
+        has not been called yet, and forget about it.
+        """
+        with self.lock:
+            return self.pending.pop(get_absolute(file_path), None)
+
+    def skip_pending(self, file_path):
+        """Note that ``file_path`` is sent unencoded after all: the
+        entry being made for it is completed in the background, rather
+        than waited for.
+        """
+        wait = self.take_pending(file_path)
+        if wait:
+            thread = threading.Thread(target=wait)
+            thread.daemon = True
+            thread.start()
+
+    def fill(self, file_path):
+        """Make sure there is an entry for ``file_path``."""
+        for chunk in self.iter_encoded(file_path):
+            pass
+
+    def lookup(self, file_path, stat=None):
+        """Return the path of the entry for ``file_path``, if there
+        is one and the file has not changed since.
+        """
+        digest = self.get_digest(file_path, stat)
+        if digest:
+            entry = self.entry_path(digest)
+            if path.exists(entry):
+                return entry
+        return None
+
+    def get_digest(self, file_path, stat=None):
+        """Return the SHA-1 of the contents of ``file_path`` if known,
+        without reading the file.
+        """
+        stat = stat or stat_file(file_path)
+        with self.lock:
+            item = self._load_index().get(get_absolute(file_path))
+        if item and item['mtime'] == stat.st_mtime and \
+                item['size'] == stat.st_size:
+            return item['digest']
+        return None
+
+    def store(self, file_path, stat, digest, temp):
+        """Move the encoded contents of ``file_path`` in ``temp`` into
+        the cache.
+        """
+        entry = self.entry_path(digest)
+        with self.lock:
+            if path.exists(entry):
+                os.unlink(temp)
+                os.utime(entry, None)
+            else:
+                os.rename(temp, entry)
+            index = self._load_index()
+            index[get_absolute(file_path)] = {
+                'mtime': stat.st_mtime, 'size': stat.st_size,
+                'digest': digest}
+            write_atomic(self.index_path, json.dumps(index))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache
+        fits into ``max_size``.
+        """
+        with self.lock:
+            entries = []
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.b64'):
+                    stat = os.stat(path.join(self.directory, filename))
+                    entries.append((stat.st_mtime, stat.st_size, filename))
+            entries.sort()
+            total = sum(size for mtime, size, filename in entries)
+            while entries and total > self.max_size:
+                mtime, size, filename = entries.pop(0)
+                os.unlink(path.join(self.directory, filename))
+                total -= size
+
+            # Forget about documents whose entry is gone
+            index = self._load_index()
+            remaining = set(filename[:-4] for m, s, filename in entries)
+            for file_path, item in index.items():
+                if item['digest'] not in remaining:
+                    del index[file_path]
+            write_atomic(self.index_path, json.dumps(index))
+
+    def entry_path(self, digest):
+        return path.join(self.directory, '%s.b64' % digest)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+class Ledger(object):
+    """Records every document delivered to a device in an SQLite
+    database, so that sending the same document to the same device
+    again can be skipped.
+
+    Documents are identified by the SHA-1 of their contents.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS deliveries (
+            id INTEGER PRIMARY KEY,
+            digest TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            convert INTEGER NOT NULL,
+            sent_at REAL NOT NULL,
+            response TEXT
+        );
+        CREATE INDEX IF NOT EXISTS deliveries_digest
+            ON deliveries (digest, recipient, convert);
+    """
+
+    def __init__(self, filename):
+        # Used from the send queue's thread as well
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.executescript(self.SCHEMA)
+
+    def record(self, digest, filename, recipient, convert, response):
+        # sqlite3 only takes text as unicode, or ASCII byte strings
+        filename = decode_path(filename)
+        if isinstance(response, str):
+            response = response.decode('utf-8', 'replace')
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT INTO deliveries (digest, filename, recipient, '
+                'convert, sent_at, response) VALUES (?, ?, ?, ?, ?, ?)',
+                (digest, filename, recipient, bool(convert), time.time(),
+                 response))
+
+    def has_sent(self, digest, recipient, convert=None):
+        """Return whether the document with ``digest`` has been
+        delivered to ``recipient`` (with the given ``convert`` flag,
+        unless it is None).
+        """
+        query = 'SELECT 1 FROM deliveries WHERE digest = ? AND recipient = ?'
+        args = [digest, recipient]
+        if convert is not None:
+            query += ' AND convert = ?'
+            args.append(bool(convert))
+        with self.lock:
+            return self.db.execute(query, args).fetchone() is not None
+
+    def get_deliveries(self, digest):
+        """Return ``(recipient, convert, sent_at, response)`` for each
+        delivery of the document with ``digest``, oldest first.
+        """
+        with self.lock:
+            return self.db.execute(
+                'SELECT recipient, convert, sent_at, response '
+                'FROM deliveries WHERE digest = ? ORDER BY sent_at',
+                (digest,)).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class TimedSMTP_SSL(smtplib.SMTP_SSL):
+    """``smtplib.SMTP_SSL`` that connects to ``relay`` through its SSL
+    context, and keeps track of how long of the time connecting was
+    spent in the TLS handshake.
+    """
+
+    tls_time = 0
+
+    def __init__(self, relay, stats):
+        self.relay = relay
+        self.stats = stats
+        smtplib.SMTP_SSL.__init__(self, host=relay.host, port=relay.port)
+
+    def _get_socket(self, host, port, timeout):
+        sock = socket.create_connection((host, port), timeout)
+        start = time.time()
+        sock = self.relay.wrap_socket(sock, self.stats)
+        self.tls_time = time.time() - start
+        self.file = smtplib.SSLFakeFile(sock)
+        return sock
+
+
+def starttls(smtp, relay, stats):
+    """Like ``smtp.starttls()``, but through the SSL context of
+    ``relay``, which ``smtplib`` cannot be given.
+    """
+    smtp.ehlo_or_helo_if_needed()
+    if not smtp.has_extn('starttls'):
+        raise smtplib.SMTPException(
+            'STARTTLS extension not supported by server.')
+    code, reply = smtp.docmd('STARTTLS')
+    if code != 220:
+        raise smtplib.SMTPResponseException(code, reply)
+    smtp.sock = relay.wrap_socket(smtp.sock, stats)
+    smtp.file = smtplib.SSLFakeFile(smtp.sock)
+    # What the server said before does not count (RFC 3207)
+    smtp.helo_resp = smtp.ehlo_resp = None
+    smtp.esmtp_features = {}
+    smtp.does_esmtp = 0
+
+
+class PooledConnection(object):
+    """An SMTP session held by ``SMTPConnectionPool``, together with
+    the bookkeeping the pool needs.
+    """
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.last_used = time.time()
+        self.messages = 0
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            self.smtp.close()
+
+
+class SMTPConnectionPool(object):
+    """Keeps authenticated SMTP sessions open, so that consecutive
+    sends do not pay for connecting, TLS and AUTH every time.
+
+    ``connect`` is a callable returning a new, authenticated
+    ``smtplib.SMTP`` instance.
+
+    A session that has been idle for longer than ``idle_timeout``
+    seconds is closed rather than reused, one that has been idle for
+    more than ``check_after`` seconds is checked with a NOOP first,
+    and one that has sent ``max_messages`` messages is retired.
+    """
+
+    def __init__(self, connect, idle_timeout=60, check_after=5,
+                 max_messages=50):
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.max_messages = max_messages
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self, stats=None):
+        """Return a ``PooledConnection`` ready to send a message.
+
+        Reuses an idle session if a healthy one exists, otherwise
+        connects, recording the timings in ``stats``. Errors while
+        connecting propagate.
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            idle_for = time.time() - conn.last_used
+            if idle_for > self.idle_timeout:
+                conn.close()
+                continue
+            if idle_for > self.check_after and not self.is_alive(conn):
+                conn.smtp.close()
+                continue
+            return conn
+        return PooledConnection(self.connect(stats))
+
+    def warm_up(self, stats=None):
+        """Make sure there is an idle session, and return it."""
+        conn = self.acquire(stats)
+        self.release(conn)
+        return conn
+
+    def close_unused(self, conn):
+        """Close ``conn`` if it is idle and has not sent anything."""
+        with self.lock:
+            if conn not in self.idle or conn.messages:
+                return
+            self.idle.remove(conn)
+        conn.close()
+
+    def release(self, conn):
+        """Return a session to the pool after a completed message
+        transaction.
+        """
+        conn.last_used = time.time()
+        if conn.messages >= self.max_messages:
+            conn.close()
+            return
+        with self.lock:
+            self.idle.append(conn)
+
+    def discard(self, conn):
+        """Drop a session that is broken, or in an unknown state."""
+        conn.smtp.close()
+
+    def is_alive(self, conn):
+        try:
+            return conn.smtp.noop()[0] == 250
+        except (smtplib.SMTPException, socket.error):
+            return False
+
+    def prune(self):
+        """Close the sessions that have exceeded the idle timeout, and
+        return how many idle ones are left.
+        """
+        now = time.time()
+        with self.lock:
+            expired = [c for c in self.idle
+                       if now - c.last_used > self.idle_timeout]
+            self.idle = [c for c in self.idle if c not in expired]
+            left = len(self.idle)
+        for conn in expired:
+            conn.close()
+        return left
+
+    def close(self):
+        """Close all idle sessions."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+def get_skipped(files, groups):
+    """Return the ``files`` that do not appear in any of the
+    ``(recipients, files)`` pairs in ``groups``.
+    """
+    planned = set()
+    for recipients, group in groups:
+        planned.update(group)
+    return [file_path for file_path in files if file_path not in planned]
+
+
+def describe_error(error):
+    """Return a message for the user about ``error``, an exception
+    from sending, or such a message already.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return 'refused by %s' % ', '.join(
+            '%s (%d %s)' % (recipient, code, resp)
+            for recipient, (code, resp) in sorted(error.recipients.items()))
+    return str(error)
+
+
+def batch_failure(failed, files, errors=()):
+    """Return a ``SendKindleException`` for the ``failed`` ones
+    among the ``files`` of a batch, mentioning the ``errors`` that
+    caused it.
+    """
+    reasons = []
+    for error in errors:
+        if describe_error(error) not in reasons:
+            reasons.append(describe_error(error))
+    error = SendKindleException(
+        '%d of %d documents could not be sent: %s%s' % (
+            len(failed), len(files),
+            ', '.join(get_basename(f) for f in failed),
+            ' (%s)' % '; '.join(reasons) if reasons else ''))
+    error.files = failed
+    return error
+
+
+def is_transient_error(error):
+    """Return whether a send that failed with ``error`` may succeed
+    if it is retried later, e.g. after a 4xx reply or a network
+    problem.
+    """
+    if isinstance(error, (ssl.SSLZeroReturnError, ssl.SSLEOFError)):
+        # The connection was dropped
+        return True
+    if isinstance(error, (ssl.SSLError, ssl.CertificateError)):
+        # The TLS handshake or the certificate check failed, which
+        # trying again does not fix
+        return False
+    if isinstance(error, (smtplib.SMTPServerDisconnected, socket.error)):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500
+                   for code, resp in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return False
+
+
+class TokenBucket(object):
+    """Allows ``rate`` units per second, in bursts of up to ``burst``.
+
+    ``reserve`` takes units from the bucket even if there are not
+    enough, and returns how long to wait before using them, so that
+    the same bucket can pace blocking and non-blocking senders.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        # Seconds of waiting handed out so far
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = max(-self.tokens / self.rate, 0)
+            self.waited += delay
+            return delay
+
+    def to_dict(self):
+        return {'rate': self.rate, 'tokens': round(self.tokens, 3),
+                'waited': round(self.waited, 6)}
+
+
+class RateLimiter(object):
+    """Limits the bytes per second written, to ``max_rate`` KiB, and
+    the messages started per minute, to ``max_messages``. Messages
+    are spaced evenly rather than sent in a burst, to stay clear of
+    the quotas of the relays.
+    """
+
+    def __init__(self, max_rate=0, max_messages=0):
+        self.bytes = self.messages = None
+        if max_rate:
+            self.bytes = TokenBucket(
+                max_rate * 1024, max(max_rate * 1024, SEND_CHUNK_SIZE))
+        if max_messages:
+            self.messages = TokenBucket(max_messages / 60.0, 1)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """Return the limiter for the ``max-rate`` and
+        ``max-messages-per-minute`` settings given, or None if there
+        are no limits.
+        """
+        max_rate = float(settings.get('max-rate') or 0)
+        max_messages = float(settings.get('max-messages-per-minute') or 0)
+        if max_rate or max_messages:
+            return cls(max_rate, max_messages)
+        return None
+
+    def reserve(self, bytes=0, messages=0):
+        """Take ``bytes`` and ``messages``, and return the seconds to
+        wait before sending them.
+        """
+        delay = 0
+        if bytes and self.bytes:
+            delay = max(delay, self.bytes.reserve(bytes))
+        if messages and self.messages:
+            delay = max(delay, self.messages.reserve(messages))
+        return delay
+
+    def to_dict(self):
+        return {'bytes': self.bytes and self.bytes.to_dict(),
+                'messages': self.messages and self.messages.to_dict()}
+
+
+def get_delay(limiters, bytes=0, messages=0):
+    """Return how long to wait before sending ``bytes`` and starting
+    ``messages``, according to all of ``limiters``.
+    """
+    return max([limiter.reserve(bytes, messages)
+                for limiter in limiters] or [0])
+
+
+def throttle(delivery, bytes=0, messages=0):
+    """Hold the current thread back as long as the rate limits of
+    ``delivery`` ask for, before sending ``bytes`` or starting
+    ``messages``.
+    """
+    delay = get_delay(delivery.limiters, bytes, messages)
+    if delay > 0:
+        delivery.stats.add('throttle', delay)
+        delivery.progress.sleep(delay)
+
+
+# How much a new measurement counts in a relay's latency average
+RELAY_LATENCY_WEIGHT = 0.3
+# After this many consecutive failures, a relay is not used...
+RELAY_MAX_FAILURES = 3
+# ...for this many seconds
+RELAY_COOLDOWN = 30
+# Whether the ssl module can resume TLS sessions on new connections;
+# Python 2 cannot, the handshakes are then always full ones.
+SSL_SESSIONS = hasattr(ssl, 'SSLSession')
+
+
+class Relay(object):
+    """An SMTP server to send through, and how to log in there.
+
+    Also keeps track of how the server has been doing: an
+    exponentially weighted average of the time a transaction took,
+    and the failures since the last success. After
+    ``RELAY_MAX_FAILURES`` of those, the relay is left alone for
+    ``RELAY_COOLDOWN`` seconds, after which a single transaction
+    decides whether it is used again.
+
+    All TLS connections to the relay share one ``ssl.SSLContext``, and
+    resume the TLS session of the last one where possible.
+    """
+
+    def __init__(self, host, port=25, type='', username='', password='',
+                 weight=1, max_sessions=None, verify=True, ca_file=None):
+        self.host = host
+        self.port = int(port or 25)
+        self.type = type
+        self.username = username
+        self.password = password
+        # Whether to check the server's certificate, against the CA
+        # certificates in ``ca_file``, or the system's
+        self.verify = verify
+        self.ca_file = ca_file
+        self.context = None
+        self.session = None
+        self.handshakes = 0
+        self.resumed = 0
+        self.lock = threading.Lock()
+        # The share of the messages the relay gets, relative to the
+        # others
+        self.weight = float(weight or 1)
+        # How many sessions the async engine may open to the relay,
+        # if not the engine's default
+        self.max_sessions = max_sessions
+        # A ``RateLimiter`` for this relay alone, or None
+        self.limiter = None
+        self.latency = None
+        self.failures = 0
+        self.blocked_until = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings['host'], settings['port'], settings['type'],
+                   settings['username'], settings['password'],
+                   settings.get('weight'), settings.get('max-sessions'),
+                   settings.get('verify', True), settings.get('ca-file'))
+
+    @property
+    def key(self):
+        return (self.host, self.port)
+
+    @property
+    def available(self):
+        return time.time() >= self.blocked_until
+
+    def record_success(self, seconds):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += RELAY_LATENCY_WEIGHT * (seconds - self.latency)
+        self.failures = 0
+        self.blocked_until = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= RELAY_MAX_FAILURES:
+            self.blocked_until = time.time() + RELAY_COOLDOWN
+
+    def get_ssl_context(self):
+        """Return the ``ssl.SSLContext`` for connections to the relay,
+        creating it, and loading the CA certificates, the first time.
+        """
+        with self.lock:
+            if not self.context:
+                context = ssl.create_default_context(
+                    cafile=self.ca_file or None)
+                if not self.verify:
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                self.context = context
+            return self.context
+
+    def wrap_socket(self, sock, stats=None, do_handshake_on_connect=True):
+        """Start TLS on ``sock``, a connection to the relay. Unless
+        ``do_handshake_on_connect`` is False, the handshake is done and
+        noted in ``stats``; otherwise call ``handshake_done`` after it.
+        """
+        kwargs = {}
+        if SSL_SESSIONS and self.session:
+            kwargs['session'] = self.session
+        start = time.time()
+        try:
+            sock = self.get_ssl_context().wrap_socket(
+                sock, server_hostname=self.host,
+                do_handshake_on_connect=do_handshake_on_connect, **kwargs)
+        except ssl.CertificateError, e:
+            raise ssl.SSLError(ssl.SSL_ERROR_SSL, str(e))
+        if do_handshake_on_connect:
+            self.handshake_done(sock, stats, time.time() - start)
+        return sock
+
+    def handshake_done(self, sock, stats, seconds):
+        """Note the TLS handshake on ``sock``, which took ``seconds``,
+        and keep its session for the next connection.
+        """
+        resumed = bool(getattr(sock, 'session_reused', False))
+        with self.lock:
+            self.handshakes += 1
+            self.resumed += resumed
+        self.save_session(sock)
+        if stats:
+            stats.add('tls', seconds)
+            stats.handshakes += 1
+            stats.resumed += resumed
+
+    def save_session(self, sock):
+        """Keep the TLS session of ``sock`` to resume on the next
+        connection. With TLS 1.3, the server only sends it after the
+        handshake, so this is called again once the session is set up.
+        """
+        if SSL_SESSIONS and isinstance(sock, ssl.SSLSocket) and sock.session:
+            self.session = sock.session
+
+    def to_dict(self):
+        return {
+            'host': self.host,
+            'port': self.port,
+            'latency': round(self.latency, 6)
+                if self.latency is not None else None,
+            'failures': self.failures,
+            'available': self.available,
+            'handshakes': self.handshakes,
+            'resumption_rate': get_resumption_rate([self]),
+        }
+
+
+def get_relays(settings):
+    """Return the ``Relay`` instances for the ``smtp`` settings given:
+    one for every entry of ``relays``, which default to the settings
+    of the ``smtp`` section, or just the one configured there.
+
+    Rate limits given for a relay apply to it alone.
+    """
+    relays = []
+    for relay_settings in settings.get('relays') or [{}]:
+        merged = dict(settings)
+        merged.update(relay_settings)
+        relay = Relay.from_settings(merged)
+        # The limits of the smtp section are for all relays together
+        relay.limiter = RateLimiter.from_settings(relay_settings)
+        relays.append(relay)
+    return relays
+
+
+def get_resumption_rate(relays):
+    """Return the share of the TLS handshakes with ``relays`` so far
+    that resumed a session, or None if there were none.
+    """
+    handshakes = sum(relay.handshakes for relay in relays)
+    if not handshakes:
+        return None
+    return round(sum(relay.resumed for relay in relays) /
+                 float(handshakes), 3)
+
+
+def choose_relay(relays, exclude=(), load=None):
+    """Return the relay among ``relays`` to send the next message
+    through, or None if all of them are in ``exclude``.
+
+    The relays passed over for failing recently are only used when no
+    other is left. Of the rest, the one with the lowest latency per
+    weight wins, counting every failure since its last success against
+    it. ``load`` can give the number of messages already assigned to
+    each relay (by key), to spread them over the relays in proportion
+    to their weights. A relay not used yet is tried before the others,
+    once their latency is known.
+    """
+    candidates = [r for r in relays if r not in exclude]
+    if not candidates:
+        return None
+    available = [r for r in candidates if r.available]
+    if not available:
+        return min(candidates, key=lambda r: r.blocked_until)
+    load = load or {}
+    known = [r.latency for r in relays if r.latency is not None]
+    untried = 0.0 if known else 1.0
+    slowest = max(known or [1.0])
+
+    def cost(relay):
+        latency = relay.latency
+        if latency is None:
+            latency = slowest if relay.failures else untried
+        return (load.get(relay.key, 0) + 1) * (relay.failures + 1) * \
+            latency / relay.weight
+    return min(available, key=cost)
+
+
+class Delivery(object):
+    """A message to be handed to a ``Transport`` for ``recipients``.
+
+    Once ``done``, either ``result`` is the ``(delivered, refused)``
+    pair ``Transport.deliver`` returns, or ``error`` is the exception
+    it raised. ``started`` and ``finished`` are the times the delivery
+    was begun and ended.
+    """
+
+    def __init__(self, sender, recipients, message, stats=None,
+                 progress=None):
+        # The relay to send to; set by the transport.
+        self.relay = None
+        self.sender = sender
+        self.recipients = recipients
+        self.message = message
+        self.stats = stats or SendStats()
+        self.progress = progress or SendProgress()
+        self.result = None
+        self.error = None
+        self.done = False
+        self.started = self.finished = None
+        # How long the MAIL and RCPT round trips took on the relay
+        # last tried, its latency; and the relays that have failed it
+        self.envelope_time = None
+        self.tried = []
+        # The transport's ``RateLimiter``, or None; the relay's applies
+        # as well.
+        self.limiter = None
+        # Set once the delivery has been retried after a reused
+        # session turned out to have been dropped.
+        self.retried = False
+
+    @property
+    def limiters(self):
+        return [limiter for limiter in (
+            self.limiter, self.relay and self.relay.limiter) if limiter]
+
+
+class AsyncSMTPSession(asyncore.dispatcher):
+    """A non-blocking SMTP session to ``relay``, run by
+    ``AsyncSMTPEngine``: connects, does TLS and AUTH, and then runs
+    the transactions handed to it by ``start``.
+
+    Every reply from the server is passed to ``handler``, which is
+    set by whatever sent the command.
+    """
+
+    def __init__(self, engine, relay, stats):
+        asyncore.dispatcher.__init__(self, map=engine.map)
+        self.engine = engine
+        self.relay = relay
+        # The connect, TLS and AUTH timings go here
+        self.stats = stats
+        self.inbuf = ''
+        self.outbuf = ''
+        self.lines = []
+        self.handler = self.on_greeting
+        self.extensions = {}
+        self.tls = self.authenticated = False
+        self.handshaking = self.want_write = False
+        self.ready = self.closing = False
+        self.transaction = None
+        self.messages = 0
+        # The message being written in the DATA phase, if any
+        self.chunks = None
+        self.in_data = False
+        self.last_used = self.last_activity = self.started = time.time()
+        # Nothing is written before this time, while rate limited
+        self.resume_at = 0
+        # When the MAIL command of the current transaction was sent
+        self.envelope_started = None
+
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            relay.host, relay.port, 0, socket.SOCK_STREAM)[0]
+        self.create_socket(family, socktype)
+        self.connect(address)
+
+    @property
+    def busy(self):
+        return not self.ready or self.transaction is not None
+
+    def readable(self):
+        if self.handshaking:
+            return not self.want_write
+        return True
+
+    def writable(self):
+        if self.connecting:
+            return True
+        if self.handshaking:
+            return self.want_write
+        if self.resume_at > time.time():
+            return False
+        return bool(self.outbuf) or self.chunks is not None
+
+    def handle_connect(self):
+        self.last_activity = time.time()
+        self.stats.add('connect', self.last_activity - self.started)
+        if self.relay.type == 'tls':
+            self.start_tls()
+
+    def handle_read(self):
+        if self.handshaking:
+            self.do_handshake()
+            return
+        try:
+            data = self.recv(8192)
+            # Data already decrypted is not seen by select().
+            while data and isinstance(self.socket, ssl.SSLSocket) and \
+                    self.socket.pending():
+                data += self.recv(self.socket.pending())
+        except ssl.SSLWantReadError:
+            return
+        self.last_activity = time.time()
+        self.inbuf += data
+        while '\n' in self.inbuf and not self.closing:
+            line, self.inbuf = self.inbuf.split('\n', 1)
+            line = line.rstrip('\r')
+            self.lines.append(line[4:])
+            if line[3:4] == '-':
+                continue
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+            reply, self.lines = '\n'.join(self.lines), []
+            handler, self.handler = self.handler, None
+            if handler is None:
+                raise smtplib.SMTPResponseException(code, reply)
+            handler(code, reply)
+
+    def handle_write(self):
+        if self.handshaking:
+            self.do_handshake()
+            return
+        if self.chunks is not None and len(self.outbuf) < SEND_CHUNK_SIZE:
+            self.generate()
+        if not self.outbuf:
+            # Became writable while finishing the TLS handshake
+            return
+        try:
+            sent = self.send(self.outbuf[:SEND_CHUNK_SIZE])
+        except ssl.SSLWantWriteError:
+            return
+        self.last_activity = time.time()
+        self.outbuf = self.outbuf[sent:]
+        if self.transaction and self.in_data:
+            # Don't count BDAT commands as part of the message
+            counted = max(sent - self.overhead, 0)
+            self.overhead = max(self.overhead - sent, 0)
+            self.data_bytes += counted
+            self.transaction.progress.advance(counted)
+            self.throttle(bytes=counted)
+
+    def throttle(self, bytes=0, messages=0):
+        """Hold back further writes as long as the rate limits of the
+        current transaction ask for.
+        """
+        transaction = self.transaction
+        delay = get_delay(transaction.limiters, bytes, messages)
+        if delay > 0:
+            self.resume_at = time.time() + delay
+            # Not hearing from the server meanwhile is expected.
+            self.last_activity = self.resume_at
+            transaction.stats.add('throttle', delay)
+            transaction.progress.throttle(delay)
+
+    def handle_close(self):
+        self.fail(smtplib.SMTPServerDisconnected(
+            'Connection unexpectedly closed'))
+
+    def handle_error(self):
+        self.fail(sys.exc_info()[1])
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.engine.session_closed(self)
+
+    def fail(self, error):
+        """Drop the session after ``error``, which the transaction
+        in progress, if any, fails with.
+        """
+        ready, transaction = self.ready, self.transaction
+        self.ready = self.in_data = False
+        self.transaction = self.chunks = None
+        self.close()
+        if transaction:
+            self.engine.transaction_failed(self, transaction, error)
+        elif not ready and not self.closing:
+            self.engine.setup_failed(self, error)
+
+    def command(self, line, handler):
+        self.outbuf += line + '\r\n'
+        self.handler = handler
+
+    def start_tls(self):
+        self.tls_started = time.time()
+        sock = self.relay.wrap_socket(
+            self.socket, do_handshake_on_connect=False)
+        self.del_channel()
+        self.set_socket(sock, self.engine.map)
+        self.handshaking = True
+        self.do_handshake()
+
+    def do_handshake(self):
+        try:
+            self.socket.do_handshake()
+        except ssl.CertificateError, e:
+            raise ssl.SSLError(ssl.SSL_ERROR_SSL, str(e))
+        except ssl.SSLWantReadError:
+            self.want_write = False
+            return
+        except ssl.SSLWantWriteError:
+            self.want_write = True
+            return
+        self.last_activity = time.time()
+        self.relay.handshake_done(
+            self.socket, self.stats, self.last_activity - self.tls_started)
+        self.handshaking = False
+        self.tls = True
+        if self.relay.type == 'starttls':
+            self.ehlo()
+
+    # Setting up the session
+
+    def on_greeting(self, code, reply):
+        if code != 220:
+            raise smtplib.SMTPConnectError(code, reply)
+        self.ehlo()
+
+    def ehlo(self):
+        self.extensions = {}
+        self.command('EHLO %s' % self.engine.local_hostname, self.on_ehlo)
+
+    def on_ehlo(self, code, reply):
+        if code != 250:
+            self.command('HELO %s' % self.engine.local_hostname,
+                         self.on_helo)
+            return
+        for line in reply.split('\n')[1:]:
+            name, _, params = line.partition(' ')
+            self.extensions[name.lower()] = params
+        self.login()
+
+    def on_helo(self, code, reply):
+        if code != 250:
+            raise smtplib.SMTPHeloError(code, reply)
+        self.login()
+
+    def login(self):
+        if self.relay.type == 'starttls' and not self.tls:
+            if 'starttls' not in self.extensions:
+                raise smtplib.SMTPException(
+                    'STARTTLS extension not supported by server.')
+            self.command('STARTTLS', self.on_starttls)
+        elif self.relay.username and not self.authenticated:
+            self.auth_started = time.time()
+            mechanisms = self.extensions.get('auth', 'PLAIN').upper().split()
+            if 'PLAIN' in mechanisms or 'LOGIN' not in mechanisms:
+                credentials = '\0%s\0%s' % (
+                    self.relay.username, self.relay.password)
+                self.command('AUTH PLAIN %s' % base64.b64encode(credentials),
+                             self.on_auth)
+            else:
+                self.command('AUTH LOGIN', self.on_auth_login)
+        else:
+            self.set_ready()
+
+    def on_starttls(self, code, reply):
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, reply)
+        self.start_tls()
+
+    def on_auth_login(self, code, reply):
+        if code != 334:
+            raise smtplib.SMTPAuthenticationError(code, reply)
+        if base64.b64decode(reply).lower().startswith('username'):
+            self.command(base64.b64encode(self.relay.username),
+                         self.on_auth_login)
+        else:
+            self.command(base64.b64encode(self.relay.password), self.on_auth)
+
+    def on_auth(self, code, reply):
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, reply)
+        self.stats.add('auth', time.time() - self.auth_started)
+        self.authenticated = True
+        self.set_ready()
+
+    def set_ready(self):
+        if self.tls:
+            self.relay.save_session(self.socket)
+        self.ready = True
+        self.last_used = time.time()
+        self.engine.session_ready(self)
+
+    # Running a transaction
+
+    def start(self, transaction):
+        self.transaction = transaction
+        transaction.envelope_time = None
+        self.refused = {}
+        self.pending_recipients = list(transaction.recipients)
+        try:
+            transaction.progress.check()
+        except SendCancelled, e:
+            self.finish(error=e)
+            return
+        self.throttle(messages=1)
+        self.envelope_started = max(time.time(), self.resume_at)
+        self.mode = choose_transfer_mode(
+            lambda name: name in self.extensions, transaction.message)
+        # The progress was started with the size in base64
+        message = transaction.message
+        transaction.progress.total += \
+            message.get_size(self.mode) - message.size
+        command = 'MAIL FROM:%s' % smtplib.quoteaddr(transaction.sender)
+        if TRANSFER_MODES[self.mode]:
+            command += ' ' + TRANSFER_MODES[self.mode]
+        self.command(command, self.on_mail)
+
+    def on_mail(self, code, reply):
+        if code != 250:
+            self.finish(error=smtplib.SMTPSenderRefused(
+                code, reply, self.transaction.sender))
+            return
+        self.rcpt()
+
+    def rcpt(self):
+        recipient = self.pending_recipients.pop(0)
+        self.command('RCPT TO:%s' % smtplib.quoteaddr(recipient),
+                     lambda code, reply: self.on_rcpt(recipient, code, reply))
+
+    def on_rcpt(self, recipient, code, reply):
+        if code not in (250, 251):
+            self.refused[recipient] = (code, reply)
+        if self.pending_recipients:
+            self.rcpt()
+            return
+        self.transaction.envelope_time = \
+            time.time() - self.envelope_started
+        if len(self.refused) == len(self.transaction.recipients):
+            self.finish(error=smtplib.SMTPRecipientsRefused(self.refused))
+        elif 'chunking' in self.extensions:
+            self.begin_data()
+            self.message_chunks = iter(self.timed)
+            self.rest = ''
+            self.bdat()
+        else:
+            self.command('DATA', self.on_data)
+
+    def begin_data(self):
+        transaction = self.transaction
+        self.timed = TimedChunks(
+            generate(transaction.message, self.mode), transaction.stats)
+        self.in_data = True
+        self.data_started = time.time()
+        self.data_throttled = transaction.stats.get_time('throttle')
+        self.data_bytes = self.overhead = 0
+
+    def end_data(self):
+        self.in_data = False
+        stats = self.transaction.stats
+        throttled = stats.get_time('throttle') - self.data_throttled
+        stats.add('data', time.time() - self.data_started -
+                  self.timed.generated - throttled, self.data_bytes)
+
+    def on_data(self, code, reply):
+        if code != 354:
+            self.finish(error=smtplib.SMTPDataError(code, reply))
+            return
+        self.begin_data()
+        self.chunks = dot_stuff(self.timed)
+        self.handler = self.on_data_end
+
+    def generate(self):
+        """Fill the output buffer from the message being sent."""
+        while len(self.outbuf) < SEND_CHUNK_SIZE:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                # The message always ends with a line break.
+                self.outbuf += '.\r\n'
+                self.chunks = None
+                break
+            self.outbuf += chunk
+
+    def on_data_end(self, code, reply):
+        self.end_data()
+        if code != 250:
+            self.finish(error=smtplib.SMTPDataError(code, reply))
+            return
+        self.delivered(code, reply)
+
+    def bdat(self):
+        """Send the next BDAT command, with up to ``BDAT_CHUNK_SIZE``
+        bytes of the message.
+        """
+        buffered, size = [self.rest], len(self.rest)
+        last = False
+        while size < BDAT_CHUNK_SIZE:
+            chunk = next(self.message_chunks, None)
+            if chunk is None:
+                last = True
+                break
+            buffered.append(chunk)
+            size += len(chunk)
+        data = ''.join(buffered)
+        data, self.rest = data[:BDAT_CHUNK_SIZE], data[BDAT_CHUNK_SIZE:]
+        last = last and not self.rest
+        command = 'BDAT %d%s\r\n' % (len(data), ' LAST' if last else '')
+        self.overhead = len(command)
+        self.outbuf += command + data
+        self.handler = lambda code, reply: self.on_bdat(last, code, reply)
+
+    def on_bdat(self, last, code, reply):
+        if code != 250:
+            self.end_data()
+            self.finish(error=smtplib.SMTPDataError(code, reply))
+        elif last:
+            self.end_data()
+            self.delivered(code, reply)
+        else:
+            self.bdat()
+
+    def delivered(self, code, reply):
+        response = '%d %s' % (code, reply)
+        delivered = dict((recipient, response)
+                         for recipient in self.transaction.recipients
+                         if recipient not in self.refused)
+        self.messages += 1
+        self.finish(result=(delivered, self.refused))
+
+    def finish(self, result=None, error=None):
+        """End the transaction in progress, and get ready for the
+        next one.
+        """
+        transaction, self.transaction = self.transaction, None
+        self.engine.transaction_done(transaction, result, error)
+        if error:
+            self.ready = False
+            self.command('RSET', lambda code, reply: self.set_ready())
+        elif self.messages >= self.engine.max_messages:
+            self.quit()
+        else:
+            self.set_ready()
+
+    def quit(self):
+        self.ready = False
+        self.closing = True
+        self.command('QUIT', lambda code, reply: self.close())
+
+
+class AsyncSMTPEngine(object):
+    """Runs many SMTP sessions at once from a single thread, using
+    non-blocking sockets and ``asyncore``.
+
+    At most ``max_sessions`` sessions are opened per relay, unless
+    changed for a relay with ``set_limit``. Sessions are kept open
+    for reuse, like ``SMTPConnectionPool`` does, until they have been
+    idle for ``idle_timeout`` seconds or have sent ``max_messages``
+    messages. A session that does not hear from the server for
+    ``timeout`` seconds while busy is dropped.
+    """
+
+    def __init__(self, max_sessions=4, idle_timeout=60, max_messages=50,
+                 timeout=60):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.limits = {}
+        self.map = {}
+        self.sessions = []
+        self.pending = []
+        self.local_hostname = socket.getfqdn()
+        self.lock = threading.Lock()
+        # Called with every transaction that ends, and its error or
+        # None; may return another relay to try the transaction on.
+        self.reroute = None
+
+    def set_limit(self, relay, max_sessions):
+        self.limits[relay.key] = max_sessions
+
+    def run(self, transactions):
+        """Send the ``Delivery`` instances given, and return
+        once all of them are done.
+        """
+        with self.lock:
+            self.pending.extend(transactions)
+            self.dispatch()
+            while not all(t.done for t in transactions):
+                self.poll(1)
+
+    def warm_up(self, relay):
+        """Open a session to ``relay`` ahead of time, unless there is
+        one already. Returns the session once it is ready, or None if
+        it could not be set up.
+        """
+        with self.lock:
+            sessions = [s for s in self.sessions
+                        if s.relay.key == relay.key and not s.closing]
+            if sessions:
+                session = sessions[0]
+            else:
+                session = AsyncSMTPSession(self, relay, SendStats())
+                self.sessions.append(session)
+            while session.busy and session in self.sessions:
+                self.poll(1)
+            return session if session in self.sessions else None
+
+    def close_unused(self, session):
+        """Close ``session`` if it is idle and has not sent anything."""
+        with self.lock:
+            if session not in self.sessions or session.busy or \
+                    session.messages:
+                return
+            session.quit()
+            while session in self.sessions:
+                self.poll(1)
+
+    def prune(self):
+        """Say goodbye to the sessions that have exceeded the idle
+        timeout, and return how many sessions are left.
+        """
+        with self.lock:
+            self.poll()
+            deadline = time.time() + 5
+            while any(s.closing for s in self.sessions) and \
+                    time.time() < deadline:
+                self.poll(1)
+            return len(self.sessions)
+
+    def poll(self, timeout=0):
+        """Handle the socket events that happen within ``timeout``
+        seconds, and drop sessions that have timed out.
+        """
+        if self.map:
+            now = time.time()
+            resume_at = [s.resume_at for s in self.sessions
+                         if s.resume_at > now]
+            if resume_at:
+                # Wake up when a rate limited session may go on, and
+                # in between to notice if it has been cancelled.
+                timeout = min(timeout, min(resume_at) - now, 0.1)
+            asyncore.loop(timeout, map=self.map, count=1)
+        if self.pending:
+            self.dispatch()
+        now = time.time()
+        for session in list(self.sessions):
+            if session.resume_at > now and session.transaction and \
+                    session.transaction.progress.cancelled:
+                session.fail(SendCancelled('Cancelled'))
+            elif session.busy and \
+                    now - session.last_activity > self.timeout:
+                session.fail(socket.timeout('timed out'))
+            elif not session.busy and \
+                    now - session.last_used > self.idle_timeout:
+                session.quit()
+
+    def dispatch(self):
+        """Hand pending transactions to idle sessions, and open new
+        sessions as far as needed and allowed.
+        """
+        for transaction in list(self.pending):
+            if transaction not in self.pending:
+                # Started meanwhile, by a session becoming ready
+                continue
+            key = transaction.relay.key
+            sessions = [s for s in self.sessions
+                        if s.relay.key == key and not s.closing]
+            idle = [s for s in sessions if not s.busy]
+            if idle:
+                self.pending.remove(transaction)
+                idle[0].start(transaction)
+                continue
+            connecting = len([s for s in sessions if not s.ready])
+            waiting = len([t for t in self.pending if t.relay.key == key])
+            limit = self.limits.get(key, self.max_sessions)
+            if connecting < waiting and len(sessions) < limit:
+                try:
+                    self.sessions.append(AsyncSMTPSession(
+                        self, transaction.relay, transaction.stats))
+                except socket.error, e:
+                    self.fail_pending(key, e)
+
+    def session_ready(self, session):
+        self.dispatch()
+
+    def session_closed(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+
+    def setup_failed(self, session, error):
+        """A session could not be set up. Unless another session to
+        the same relay is working, the transactions waiting for it
+        fail with the same error.
+        """
+        key = session.relay.key
+        if not any(s.relay.key == key for s in self.sessions):
+            self.fail_pending(key, error)
+
+    def fail_pending(self, key, error):
+        for transaction in list(self.pending):
+            if transaction.relay.key == key:
+                self.pending.remove(transaction)
+                self.transaction_done(transaction, error=error)
+
+    def transaction_failed(self, session, transaction, error):
+        """The session running ``transaction`` broke down. If it had
+        been reused, the server may have dropped it while idle, so
+        the transaction is tried once more on another session.
+        """
+        if session.messages > 0 and not transaction.retried and \
+                isinstance(error, (smtplib.SMTPServerDisconnected,
+                                   socket.error)):
+            transaction.retried = True
+            self.pending.insert(0, transaction)
+        else:
+            self.transaction_done(transaction, error=error)
+        self.dispatch()
+
+    def transaction_done(self, transaction, result=None, error=None):
+        relay = self.reroute and self.reroute(transaction, error)
+        if relay:
+            transaction.relay = relay
+            transaction.retried = False
+            self.pending.append(transaction)
+            return
+        transaction.result = result
+        transaction.error = error
+        transaction.finished = time.time()
+        transaction.done = True
+
+    def close(self):
+        """Close all sessions, saying goodbye to those not busy."""
+        with self.lock:
+            for session in list(self.sessions):
+                if session.busy:
+                    session.close()
+                else:
+                    session.quit()
+            deadline = time.time() + 5
+            while self.map and time.time() < deadline:
+                asyncore.loop(0.1, map=self.map, count=1)
+            for session in list(self.sessions):
+                session.close()
+
+
+class Transport(object):
+    """Hands messages over for delivery. Subclasses implement
+    ``deliver``, and ``deliver_many`` if they can make several
+    deliveries at once.
+    """
+
+    # A ``RateLimiter`` for all deliveries, or None
+    limiter = None
+
+    def deliver(self, delivery):
+        """Deliver the message of ``delivery``, and return the
+        ``(delivered, refused)`` dicts: the response for every
+        recipient accepted, and the error for every one refused.
+        """
+        raise NotImplementedError()
+
+    def deliver_many(self, deliveries):
+        """Make the ``Delivery`` instances given, storing the result
+        or error in each. Once one has failed because the transport
+        is unavailable, or has been cancelled, the rest fail the same
+        way.
+        """
+        error = None
+        for delivery in deliveries:
+            delivery.limiter = self.limiter
+            delivery.started = time.time()
+            if error:
+                delivery.error = error
+            else:
+                try:
+                    delivery.result = self.deliver(delivery)
+                except SendCancelled, e:
+                    delivery.error = error = e
+                except (smtplib.SMTPException, IOError, OSError), e:
+                    delivery.error = e
+                    if isinstance(e, (smtplib.SMTPServerDisconnected,
+                                      socket.error)):
+                        error = e
+            delivery.finished = time.time()
+            delivery.done = True
+
+    def open_session(self):
+        """Make sure the transport is ready for the next message.
+        Returns a session for ``close_unused`` (or None), and the
+        transfer mode supported for our messages.
+        """
+        return None, 'base64'
+
+    def close_unused(self, session):
+        pass
+
+    def prune(self):
+        """Close the sessions that have been idle for too long. Returns
+        whether any sessions are still open.
+        """
+        return False
+
+    def get_limits(self):
+        """Return the state of the rate limiters, by what they limit."""
+        limits = {}
+        if self.limiter:
+            limits['all'] = self.limiter.to_dict()
+        for relay in getattr(self, 'relays', []):
+            if relay.limiter:
+                limits['%s:%s' % relay.key] = relay.limiter.to_dict()
+        return limits
+
+    def close(self):
+        pass
+
+
+class SMTPTransport(Transport):
+    """Delivers through SMTP servers, keeping the sessions open for
+    reuse in a ``SMTPConnectionPool`` per relay; or running many at
+    once, if the "async" engine is configured.
+
+    With several relays configured, every message goes through the
+    one ``choose_relay`` picks, and is sent through another if that
+    fails to connect or replies with a temporary error.
+    """
+
+    # LMTP servers reply to the message once for every recipient
+    lmtp = False
+
+    def __init__(self, settings):
+        self.relays = get_relays(settings)
+        self.limiter = RateLimiter.from_settings(settings)
+        self.pools = dict(
+            (relay.key, SMTPConnectionPool(
+                lambda stats=None, relay=relay: self.connect(relay, stats)))
+            for relay in self.relays)
+        self.engine = None
+        if settings.get('engine') == 'async':
+            self.engine = AsyncSMTPEngine(
+                int(settings.get('max-sessions') or 4))
+            self.engine.reroute = self.reroute
+            for relay in self.relays:
+                if relay.max_sessions:
+                    self.engine.set_limit(relay, int(relay.max_sessions))
+
+    def connect(self, relay, stats=None):
+        """Open an authenticated SMTP session to ``relay``."""
+        stats = stats or SendStats()
+        start = time.time()
+        if relay.type == 'tls':
+            smtp = TimedSMTP_SSL(relay, stats)
+            stats.add('connect', time.time() - start - smtp.tls_time)
+        else:
+            smtp = smtplib.SMTP(host=relay.host, port=relay.port)
+            stats.add('connect', time.time() - start)
+        if relay.type == 'starttls':
+            starttls(smtp, relay, stats)
+        if relay.username:
+            with stats.measure('auth'):
+                smtp.login(relay.username, relay.password)
+        if relay.type in ('tls', 'starttls'):
+            smtp.ehlo_or_helo_if_needed()
+            relay.save_session(smtp.sock)
+        return smtp
+
+    def open_session(self):
+        relay = choose_relay(self.relays)
+        if self.engine:
+            session = self.engine.warm_up(relay)
+            if not session:
+                raise smtplib.SMTPServerDisconnected('Could not connect')
+            has_extension = lambda name: name in session.extensions
+        else:
+            session = self.pools[relay.key].warm_up()
+            # Only sessions with TLS have said EHLO already
+            session.smtp.ehlo_or_helo_if_needed()
+            has_extension = session.smtp.has_extn
+        return session, choose_transfer_mode(has_extension, OutgoingMessage)
+
+    def close_unused(self, session):
+        if self.engine:
+            self.engine.close_unused(session)
+        else:
+            for pool in self.pools.values():
+                pool.close_unused(session)
+
+    def prune(self):
+        left = sum(pool.prune() for pool in self.pools.values())
+        if self.engine:
+            left += self.engine.prune()
+        return left > 0
+
+    def close(self):
+        """Close any SMTP sessions kept open for reuse."""
+        for pool in self.pools.values():
+            pool.close()
+        if self.engine:
+            self.engine.close()
+
+    def deliver_many(self, deliveries):
+        if not self.engine:
+            return super(SMTPTransport, self).deliver_many(deliveries)
+        totals = OrderedDict()
+        load = {}
+        for delivery in deliveries:
+            delivery.limiter = self.limiter
+            delivery.relay = choose_relay(self.relays, load=load)
+            load[delivery.relay.key] = load.get(delivery.relay.key, 0) + 1
+            delivery.started = time.time()
+            totals.setdefault(delivery.progress, 0)
+            totals[delivery.progress] += delivery.message.size
+        for progress, total in totals.items():
+            progress.begin(total)
+        self.engine.run(deliveries)
+
+    def reroute(self, delivery, error):
+        """Record how ``delivery`` went on its relay, and return the
+        relay to try it on next, if it failed in a way another relay
+        might not.
+        """
+        relay = delivery.relay
+        if not error:
+            # Not the whole transaction: the upload takes longer for
+            # larger messages, however fast the relay answers
+            relay.record_success(delivery.envelope_time)
+            return None
+        if isinstance(error, SendCancelled) or \
+                not is_transient_error(error):
+            return None
+        relay.record_failure()
+        delivery.tried.append(relay)
+        return choose_relay(self.relays, exclude=delivery.tried)
+
+    def deliver(self, delivery):
+        """Send ``delivery`` through the best relay, failing over to
+        the others in turn.
+        """
+        relay = choose_relay(self.relays)
+        while True:
+            delivery.relay = relay
+            try:
+                result = self._send_with_retry(relay, delivery)
+            except (smtplib.SMTPException, socket.error), e:
+                relay = self.reroute(delivery, e)
+                if not relay:
+                    raise
+                continue
+            self.reroute(delivery, None)
+            return result
+
+    def _send_with_retry(self, relay, delivery):
+        """Send ``delivery`` over a session to ``relay`` from the pool.
+
+        If a reused session turns out to have been dropped by the
+        server, the message is retried once on a new session.
+        """
+        pool = self.pools[relay.key]
+        conn = pool.acquire(delivery.stats)
+        reused = conn.messages > 0
+        try:
+            return self._send_pooled(pool, conn, delivery)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            if not reused:
+                raise
+        return self._send_pooled(pool, pool.acquire(delivery.stats), delivery)
+
+    def _send_pooled(self, pool, conn, delivery):
+        """Run a mail transaction on the pooled session ``conn``, then
+        return it to the pool, or drop it if it is no longer usable.
+        """
+        try:
+            result = self.transfer(conn.smtp, delivery)
+        except smtplib.SMTPServerDisconnected:
+            pool.discard(conn)
+            raise
+        except smtplib.SMTPException:
+            # The server rejected the message, but the session
+            # is still in a defined state.
+            pool.release(conn)
+            raise
+        except:
+            pool.discard(conn)
+            raise
+        conn.messages += 1
+        pool.release(conn)
+        return result
+
+    def transfer(self, smtp, delivery):
+        """Run a single mail transaction on the connected ``smtp``
+        session, streaming the message into the DATA command, or into
+        BDAT commands if the server supports CHUNKING.
+
+        This does what ``smtplib.SMTP.sendmail`` does, except that
+        the message does not need to exist as a string, that it is
+        sent in the best transfer mode the session supports (see
+        ``choose_transfer_mode``), and that it is written in pieces of
+        at most ``SEND_CHUNK_SIZE`` bytes, reporting to the progress
+        and checking for cancellation in between.
+
+        The time spent writing to the socket is recorded in the stats
+        as the data phase; the time spent generating the message, as
+        far as not recorded as reading or encoding, as flattening.
+        """
+        message, stats, progress = \
+            delivery.message, delivery.stats, delivery.progress
+        recipients = delivery.recipients
+        throttle(delivery, messages=1)
+        smtp.ehlo_or_helo_if_needed()
+        mode = choose_transfer_mode(smtp.has_extn, message)
+        options = [TRANSFER_MODES[mode]] if TRANSFER_MODES[mode] else []
+        delivery.envelope_time = None
+        start = time.time()
+        code, resp = smtp.mail(delivery.sender, options)
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, delivery.sender)
+        refused = {}
+        for recipient in recipients:
+            code, resp = smtp.rcpt(recipient)
+            if code not in (250, 251):
+                refused[recipient] = (code, resp)
+        if len(refused) == len(recipients):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        delivery.envelope_time = time.time() - start
+
+        progress.check()
+        chunks = TimedChunks(generate(message, mode), stats)
+        throttled = stats.get_time('throttle')
+        if smtp.has_extn('chunking'):
+            progress.begin(message.get_size(mode))
+            start = time.time()
+            code, resp, complete = self._send_bdat(smtp, chunks, delivery)
+        else:
+            code, resp = smtp.docmd('data')
+            if code != 354:
+                smtp.rset()
+                raise smtplib.SMTPDataError(code, resp)
+            progress.begin(message.get_size(mode))
+            start = time.time()
+            code, resp = self._send_data(smtp, dot_stuff(chunks), delivery)
+            complete = True
+
+        accepted = [r for r in recipients if r not in refused]
+        replies = [(code, resp)]
+        # A rejected chunk ends the transaction with this one reply
+        if self.lmtp and complete:
+            replies += [smtp.getreply() for recipient in accepted[1:]]
+        else:
+            replies *= len(accepted)
+        throttled = stats.get_time('throttle') - throttled
+        stats.add('data', time.time() - start - chunks.generated - throttled,
+                  progress.sent)
+        delivered = {}
+        for recipient, (code, resp) in zip(accepted, replies):
+            if code == 250:
+                delivered[recipient] = '%d %s' % (code, resp)
+            else:
+                refused[recipient] = (code, resp)
+        if not delivered:
+            raise smtplib.SMTPDataError(code, resp)
+        return delivered, refused
+
+    def _send_data(self, smtp, chunks, delivery):
+        """Write the dot-stuffed ``chunks`` after a DATA command, and
+        return the server's reply.
+        """
+        for chunk in chunks:
+            self._send_chunk(smtp, chunk, delivery)
+        # The message always ends with a line break.
+        smtp.send('.\r\n')
+        return smtp.getreply()
+
+    def _send_bdat(self, smtp, chunks, delivery):
+        """Write ``chunks`` as a series of BDAT commands. Returns the
+        server's reply to the last one sent, and whether that was the
+        final one, BDAT LAST. The session is reset if the server
+        rejects a chunk before that.
+        """
+        chunks = iter(chunks)
+        buffered, size = [], 0
+        last = False
+        while not last:
+            while size < BDAT_CHUNK_SIZE:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    last = True
+                    break
+                buffered.append(chunk)
+                size += len(chunk)
+            data = ''.join(buffered)
+            data, rest = data[:BDAT_CHUNK_SIZE], data[BDAT_CHUNK_SIZE:]
+            buffered, size = [rest], len(rest)
+            last = last and not rest
+            smtp.send('BDAT %d%s\r\n' % (len(data), ' LAST' if last else ''))
+            self._send_chunk(smtp, data, delivery)
+            code, resp = smtp.getreply()
+            if code != 250 and not last:
+                smtp.rset()
+                return code, resp, False
+        return code, resp, True
+
+    def _send_chunk(self, smtp, chunk, delivery):
+        for offset in range(0, len(chunk), SEND_CHUNK_SIZE):
+            piece = chunk[offset:offset + SEND_CHUNK_SIZE]
+            throttle(delivery, bytes=len(piece))
+            smtp.send(piece)
+            delivery.progress.advance(len(piece))
+
+
+class LMTPTransport(SMTPTransport):
+    """Delivers to an LMTP server, such as the local delivery agent
+    of a mail server. A host starting with a slash is taken to be the
+    path of a Unix socket.
+
+    The async engine does not speak LMTP; sessions are pooled instead.
+    """
+
+    lmtp = True
+
+    def __init__(self, settings):
+        settings = dict(settings, engine='')
+        if not settings['port']:
+            settings['port'] = smtplib.LMTP_PORT
+        super(LMTPTransport, self).__init__(settings)
+
+    def connect(self, relay, stats=None):
+        stats = stats or SendStats()
+        with stats.measure('connect'):
+            smtp = smtplib.LMTP(host=relay.host, port=relay.port)
+        if relay.username:
+            with stats.measure('auth'):
+                smtp.login(relay.username, relay.password)
+        return smtp
+
+
+def get_envelope(delivery):
+    """Return the headers that record the sender and the recipients of
+    ``delivery`` in a message handed over as a file, where there is
+    no envelope.
+    """
+    return 'Return-Path: <%s>\r\nX-Envelope-To: %s\r\n' % (
+        delivery.sender, ', '.join('<%s>' % r for r in delivery.recipients))
+
+
+class SendmailTransport(Transport):
+    """Pipes messages into the local MTA's ``sendmail`` command, which
+    queues them and takes care of delivery.
+
+    The recipients are passed on the command line, rather than with
+    ``-t``, since a message to several Kindles does not list them in
+    its headers.
+    """
+
+    def __init__(self, settings):
+        self.command = settings.get('path') or '/usr/sbin/sendmail'
+        self.limiter = RateLimiter.from_settings(settings)
+
+    def deliver(self, delivery):
+        message, stats, progress = \
+            delivery.message, delivery.stats, delivery.progress
+        throttle(delivery, messages=1)
+        errors = tempfile.TemporaryFile()
+        with stats.measure('connect'):
+            process = subprocess.Popen(
+                [self.command, '-i', '-f', delivery.sender, '--'] +
+                list(delivery.recipients),
+                stdin=subprocess.PIPE, stderr=errors, close_fds=True)
+        progress.begin(message.size)
+        start = time.time()
+        chunks = TimedChunks(generate(message), stats)
+        throttled = stats.get_time('throttle')
+        try:
+            for chunk in chunks:
+                throttle(delivery, bytes=len(chunk))
+                # sendmail expects local line endings
+                process.stdin.write(chunk.replace('\r\n', '\n'))
+                progress.advance(len(chunk))
+            process.stdin.close()
+        except SendCancelled:
+            # Don't let sendmail take what we have written so far
+            # for the whole message.
+            process.kill()
+            process.wait()
+            raise
+        except IOError, e:
+            # sendmail went away; its status says why.
+            if e.errno != errno.EPIPE:
+                process.kill()
+                process.wait()
+                raise
+        status = process.wait()
+        throttled = stats.get_time('throttle') - throttled
+        stats.add('data', time.time() - start - chunks.generated - throttled,
+                  progress.sent)
+        errors.seek(0)
+        output = errors.read().strip()
+        if status != 0:
+            code = 451 if status == os.EX_TEMPFAIL else 554
+            raise smtplib.SMTPDataError(
+                code, '%s exited with status %d: %s' % (
+                    self.command, status, output))
+        response = 'Queued by %s' % self.command
+        return dict((r, response) for r in delivery.recipients), {}
+
+
+class FileTransport(Transport):
+    """Writes every message into a file in a directory, where another
+    program picks it up. Subclasses decide on the file names and the
+    line endings.
+    """
+
+    line_ending = '\r\n'
+
+    def __init__(self, settings):
+        if not settings.get('path'):
+            raise SendKindleException('No directory configured')
+        self.directory = path.expanduser(settings['path'])
+        self.hostname = socket.gethostname().replace('/', '_')
+        self.counter = 0
+
+    def get_paths(self):
+        """Return the temporary path a message is written to, and
+        the path it is moved to once complete.
+        """
+        raise NotImplementedError()
+
+    def get_name(self):
+        self.counter += 1
+        now = time.time()
+        return '%d.M%dP%dQ%d.%s' % (
+            now, (now % 1) * 1e6, os.getpid(), self.counter, self.hostname)
+
+    def deliver(self, delivery):
+        message, stats, progress = \
+            delivery.message, delivery.stats, delivery.progress
+        progress.check()
+        temp, filename = self.get_paths()
+        progress.begin(message.size)
+        start = time.time()
+        chunks = TimedChunks(generate(message), stats)
+        try:
+            with open(temp, 'wb') as f:
+                f.write(self.convert(get_envelope(delivery)))
+                for chunk in chunks:
+                    f.write(self.convert(chunk))
+                    progress.advance(len(chunk))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp, filename)
+        except:
+            if path.exists(temp):
+                os.unlink(temp)
+            raise
+        stats.add('data', time.time() - start - chunks.generated,
+                  progress.sent)
+        response = 'Written to %s' % filename
+        return dict((r, response) for r in delivery.recipients), {}
+
+    def convert(self, chunk):
+        if self.line_ending == '\r\n':
+            return chunk
+        return chunk.replace('\r\n', self.line_ending)
+
+
+class MaildirTransport(FileTransport):
+    """Delivers messages into the ``new`` folder of a Maildir."""
+
+    line_ending = '\n'
+
+    def __init__(self, settings):
+        super(MaildirTransport, self).__init__(settings)
+        for folder in ('tmp', 'new', 'cur'):
+            folder = path.join(self.directory, folder)
+            if not path.exists(folder):
+                os.makedirs(folder)
+
+    def get_paths(self):
+        name = self.get_name()
+        return (path.join(self.directory, 'tmp', name),
+                path.join(self.directory, 'new', name))
+
+
+class EMLTransport(FileTransport):
+    """Writes every message into an ``.eml`` file."""
+
+    def __init__(self, settings):
+        super(EMLTransport, self).__init__(settings)
+        if not path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def get_paths(self):
+        filename = path.join(self.directory, self.get_name() + '.eml')
+        return filename + '.tmp', filename
+
+
+# The transport for every value of the ``smtp.type`` setting
+TRANSPORTS = {
+    '': SMTPTransport,
+    'tls': SMTPTransport,
+    'starttls': SMTPTransport,
+    'lmtp': LMTPTransport,
+    'sendmail': SendmailTransport,
+    'maildir': MaildirTransport,
+    'eml': EMLTransport,
+}
+
+
+def get_transport(settings):
+    """Return the ``Transport`` the ``smtp`` settings given ask for."""
+    try:
+        transport = TRANSPORTS[settings['type']]
+    except KeyError:
+        raise SendKindleException(
+            'Unknown transport type: %s' % settings['type'])
+    return transport(settings)
+
+
+class SendKindle(object):
+    """Takes a SMTP configuration, can send files to the Amazon
+    Kindle delivery service.
+
+    Adapted from:
+        https://github.com/kparal/sendKindle/blob/master/sendKindle.py
+    """
+
+    def __init__(self, settings, cache=None, ledger=None, packager=None):
+        self.user_email = settings['user']['email']
+        # How many recipients the server accepts per transaction.
+        self.max_recipients = int(
+            settings['smtp'].get('max-recipients') or 50)
+        # How messages are handed over, by ``smtp.type``: to an SMTP
+        # or LMTP server, to the local sendmail, or into a directory.
+        self.transport = get_transport(settings['smtp'])
+        # An ``AttachmentCache``, or None
+        self.cache = cache
+        # A ``Ledger`` of past deliveries, or None
+        self.ledger = ledger
+        # A ``Packager`` to compress the documents with, or None
+        self.packager = packager
+        # How many processes encode documents into the cache ahead of
+        # sending them (0 for one per core), and how many documents
+        # ahead at most (0 to not do that)
+        cache_settings = settings.get('cache', {})
+        self.encoders = int(cache_settings.get('encoders') or 0) or \
+            multiprocessing.cpu_count()
+        self.max_ahead = int(cache_settings.get('prefetch') or 0)
+        self.encoder_pool = None
+        self.prefetcher = None
+        self.digests = {}
+        # Called with a dict of statistics after every message
+        self.observers = []
+
+    def warm_up(self, files, callback=None):
+        """Start getting ready to send ``files`` in the background,
+        and return the ``WarmUp`` thread doing it.
+        """
+        warm_up = WarmUp(self, files, callback)
+        warm_up.start()
+        return warm_up
+
+    def open_session(self):
+        """Make sure the transport is ready for the next message, with
+        an authenticated session where it needs one. Returns the
+        session and the transfer mode it supports for our messages.
+        """
+        return self.transport.open_session()
+
+    def close_unused(self, session):
+        """Close a session returned by ``open_session``, unless it has
+        been used meanwhile.
+        """
+        self.transport.close_unused(session)
+
+    def prune(self):
+        """Close the sessions that have been idle for too long. Returns
+        whether any sessions are still open.
+        """
+        return self.transport.prune()
+
+    def add_observer(self, observer):
+        """Have ``observer`` called with the statistics of every
+        message sent, see ``report``.
+        """
+        self.observers.append(observer)
+
+    def report(self, recipients, message, stats, elapsed, error=None,
+               relays=()):
+        """Pass the statistics of a message sent to the observers, and
+        log them as a line of JSON. ``relays`` are the servers it went
+        through; their latency, failures and TLS handshakes so far are
+        reported as well.
+        """
+        record = {
+            'time': time.time(),
+            'recipients': len(recipients),
+            'files': [get_basename(f) for f in getattr(message, 'files', [])],
+            'size': message.size,
+            'elapsed': round(elapsed, 6),
+            'phases': stats.to_dict(),
+            'error': str(error) if error else None,
+            'relays': ['%s:%s' % relay.key for relay in relays],
+            'relay_state': [relay.to_dict() for relay in relays],
+            'limits': self.transport.get_limits(),
+            'tls': {
+                'handshakes': stats.handshakes,
+                'resumed': stats.resumed,
+                'resumption_rate': get_resumption_rate(relays),
+            },
+        }
+        for observer in self.observers:
+            observer(record)
+        stats_log.info(json.dumps(record))
+
+    def create_message(self, recipient, files, convert=True):
+        """Return an ``OutgoingMessage`` from us, with the given
+        attachments; compressed, where that is worth it.
+        """
+        stats = SendStats()
+        attachments = [self.package(f, stats) for f in files]
+        return OutgoingMessage(
+            self.user_email, recipient, attachments, convert,
+            cache=self.cache, stats=stats)
+
+    def prefetch(self, files, mode=None):
+        """Start encoding the documents among ``files`` that are not
+        sent first into the cache, in the background, in the order
+        they will be sent.
+
+        The first document is left to be encoded while it is being
+        sent, which starts the upload sooner. Nothing is encoded if
+        the documents are sent in ``mode``, by default the transfer
+        mode of the transport, without being encoded.
+        """
+        if self.prefetcher:
+            self.prefetcher.cancel()
+            self.prefetcher = None
+        if not self.cache or not self.max_ahead or len(files) < 2:
+            return
+        if mode is None:
+            try:
+                mode = self.open_session()[1]
+            except (smtplib.SMTPException, socket.error):
+                # The send will report it
+                return
+        if mode == 'binarymime':
+            return
+        if not self.encoder_pool:
+            self.encoder_pool = multiprocessing.Pool(self.encoders)
+        self.prefetcher = Prefetcher(
+            self, files[1:], self.encoder_pool, self.max_ahead)
+        self.prefetcher.start()
+
+    def package(self, file_path, stats=None):
+        """Return the path of the file to attach for ``file_path``:
+        a ZIP archive of it, if the packager finds that worth it.
+        """
+        if not self.packager:
+            return file_path
+        return self.packager.package(file_path, stats)
+
+    def send_mail(self, recipient, files, convert=True):
+        """Send email with attachments, to one recipient or a list"""
+
+        # Prepare the MIME message; the attachments are only read
+        # once we are actually sending.
+        try:
+            message = self.create_message(recipient, files, convert)
+        except (IOError, OSError), e:
+            raise SendKindleException(e)
+
+        # send email
+        try:
+            self.send_message(recipient, message)
+        except (smtplib.SMTPException, IOError), e:
+            raise SendKindleException(e)
+
+    def send_batch(self, recipient, files, convert=True, force=False):
+        """Send any number of files, packed into as few messages as
+        the Kindle service accepts, through a single SMTP session
+        (or several at once, with the async engine).
+
+        Documents the ledger knows to have been delivered already are
+        skipped, unless ``force`` is set; those are returned.
+
+        If some of the messages are rejected, the others are still
+        sent; a ``SendKindleException`` listing the failed files is
+        raised at the end. So it is if some of the recipients refused
+        a message, though the others have got it.
+        """
+        try:
+            groups = self.plan(recipient, files, convert, force)
+        except (IOError, OSError), e:
+            raise SendKindleException(e)
+
+        self.prefetch([f for recipients, group in groups for f in group])
+        failed, errors = [], []
+        messages, sent_groups = [], []
+        for recipients, group in groups:
+            try:
+                messages.append(
+                    (recipients, self.create_message(recipients, group, convert)))
+                sent_groups.append(group)
+            except (IOError, OSError), e:
+                failed.extend(group)
+                errors.append(e)
+
+        for group, result in zip(sent_groups, self.send_messages(messages)):
+            if isinstance(result, Exception):
+                failed.extend(group)
+                errors.append(result)
+                continue
+            delivered, refused = result
+            self.record_delivery(group, delivered, convert)
+            if refused:
+                failed.extend(group)
+                errors.append(smtplib.SMTPRecipientsRefused(refused))
+
+        if failed:
+            raise batch_failure(failed, files, errors)
+        return get_skipped(files, groups)
+
+    def plan(self, recipient, files, convert=True, force=False):
+        """Work out the messages needed to deliver ``files`` to
+        ``recipient`` (one address or a list): a list of
+        ``(recipients, files)`` pairs, packed as tightly as allowed.
+
+        Unless ``force`` is set, deliveries recorded in the ledger are
+        left out, so a file may only go to some of the recipients.
+        """
+        recipients = as_list(recipient)
+        pending = OrderedDict()
+        for file_path in files:
+            if self.ledger and not force:
+                digest = self.get_digest(file_path)
+                todo = tuple(r for r in recipients
+                             if not self.ledger.has_sent(digest, r, convert))
+            else:
+                todo = tuple(recipients)
+            if todo:
+                pending.setdefault(todo, []).append(file_path)
+
+        groups = []
+        for todo, todo_files in pending.items():
+            for group in pack_files(todo_files):
+                groups.append((list(todo), group))
+        return groups
+
+    def get_digest(self, file_path):
+        """Return the SHA-1 of the contents of ``file_path``; from the
+        attachment cache, if it knows the file.
+        """
+        stat = stat_file(file_path)
+        key = (get_absolute(file_path), stat.st_mtime, stat.st_size)
+        if key not in self.digests:
+            digest = self.cache and self.cache.get_digest(file_path, stat)
+            self.digests[key] = digest or file_digest(file_path)
+        return self.digests[key]
+
+    def record_delivery(self, files, delivered, convert):
+        """Record in the ledger that ``files`` have been delivered to
+        the recipients in ``delivered``, a dict of the server's reply
+        by recipient.
+        """
+        if not self.ledger:
+            return
+        for file_path in files:
+            digest = self.get_digest(file_path)
+            for recipient, response in delivered.items():
+                self.ledger.record(digest, get_basename(file_path),
+                                   recipient, convert, response)
+
+    def send_message(self, recipient, message, progress=None):
+        """Send ``message`` to ``recipient``, one address or a list.
+
+        Many recipients are split into as few transactions as the
+        server allows. Even then, the message is only generated once.
+
+        Returns two dicts: the server's reply to the message for
+        each recipient that was accepted, and the error for each that
+        was refused. Raises ``SMTPRecipientsRefused`` if all were.
+
+        ``progress``, a ``SendProgress``, is kept informed of the
+        bytes written, and can be used to cancel the send from
+        another thread, which then raises ``SendCancelled``.
+        """
+        result = self.send_messages([(recipient, message)], progress)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def send_messages(self, messages, progress=None):
+        """Send a list of ``(recipient, message)`` pairs through the
+        transport; concurrently if it can.
+
+        Returns a list with the result of ``send_message`` for each,
+        or the exception it raised. Once a message has failed because
+        the transport was unavailable, the rest fail the same way.
+        ``SendCancelled`` is raised rather than returned.
+        """
+        progress = progress or SendProgress()
+        temp_files = []
+        pending = []
+        try:
+            for recipient, message in messages:
+                recipients = as_list(recipient)
+                stats = getattr(message, 'stats', None) or SendStats()
+                batches = self.get_batches(recipients)
+                if len(batches) > 1 and \
+                        not isinstance(message, PreparedMessage):
+                    # Every transaction needs to read the message
+                    # independently; generate it only once, though.
+                    fd, filename = tempfile.mkstemp(suffix='.eml')
+                    os.close(fd)
+                    temp_files.append(filename)
+                    try:
+                        message = PreparedMessage.from_message(
+                            message, filename)
+                    except (IOError, OSError), e:
+                        pending.append((recipients, message, stats, e))
+                        continue
+                deliveries = [
+                    Delivery(self.user_email, batch, message, stats, progress)
+                    for batch in batches]
+                pending.append((recipients, message, stats, deliveries))
+
+            self.transport.deliver_many(
+                [d for item in pending if isinstance(item[3], list)
+                 for d in item[3]])
+        finally:
+            for filename in temp_files:
+                os.unlink(filename)
+
+        results = []
+        for recipients, message, stats, deliveries in pending:
+            if not isinstance(deliveries, list):
+                self.report(recipients, message, stats, 0, deliveries)
+                results.append(deliveries)
+                continue
+            delivered, refused = {}, {}
+            error = None
+            for delivery in deliveries:
+                if delivery.error:
+                    error = error or delivery.error
+                else:
+                    delivered.update(delivery.result[0])
+                    refused.update(delivery.result[1])
+            elapsed = max(d.finished for d in deliveries) - \
+                min(d.started for d in deliveries)
+            # Including those failed over from
+            relays = []
+            for delivery in deliveries:
+                for relay in delivery.tried + [delivery.relay]:
+                    if relay and relay not in relays:
+                        relays.append(relay)
+            self.report(recipients, message, stats, elapsed, error, relays)
+            results.append(error or (delivered, refused))
+        for result in results:
+            if isinstance(result, SendCancelled):
+                raise result
+        return results
+
+    def get_batches(self, recipients):
+        """Split ``recipients`` into as few transactions as the
+        server allows.
+        """
+        return [recipients[i:i + self.max_recipients]
+                for i in range(0, len(recipients), self.max_recipients)]
+
+    def close(self):
+        """Close any sessions the transport keeps open for reuse, and
+        stop the encoder processes.
+        """
+        self.transport.close()
+        if self.prefetcher:
+            self.prefetcher.cancel()
+            self.prefetcher = None
+        if self.encoder_pool:
+            self.encoder_pool.terminate()
+            self.encoder_pool = None
+
+
+class WarmUp(threading.Thread):
+    """Prepares sending ``files`` with ``sender`` while the user is
+    still deciding: opens an SMTP session, hashes the files for the
+    ledger, compresses them if configured, and puts them into the
+    attachment cache, unless the session takes them unencoded anyway.
+
+    Once the files are prepared, ``wire_size`` is the number of bytes
+    their attachments take up in the message, and ``callback`` is
+    called with the instance. It is called as well if connecting or
+    reading a file failed; ``error`` is then the exception. Sending
+    will most likely fail the same way.
+
+    Call ``release`` once the files are being sent, or ``cancel`` if
+    they won't be; the latter closes the session again, unless it
+    has been used for something else meanwhile.
+    """
+
+    def __init__(self, sender, files, callback=None):
+        super(WarmUp, self).__init__()
+        self.sender = sender
+        self.files = files
+        self.callback = callback
+        self.wire_size = None
+        self.error = None
+        self.session = None
+        self.cancelled = False
+        self.finished = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        mode = 'base64'
+        try:
+            self.session, mode = self.sender.open_session()
+        except (smtplib.SMTPException, socket.error), e:
+            self.error = e
+        wire_size = 0
+        try:
+            for file_path in self.files:
+                if self.finished.is_set():
+                    break
+                packaged = self.sender.package(file_path)
+                if self.sender.cache and mode != 'binarymime':
+                    self.sender.cache.fill(packaged)
+                # Unless the file was compressed, the cache has hashed
+                # it while encoding it, so this does not read it again
+                self.sender.get_digest(file_path)
+                size = stat_file(packaged).st_size
+                wire_size += size if mode == 'binarymime' \
+                    else base64_size(size)
+            else:
+                self.wire_size = wire_size
+        except (IOError, OSError), e:
+            self.error = e
+        if self.callback and not self.finished.is_set():
+            self.callback(self)
+
+        self.finished.wait()
+        if self.cancelled and self.session:
+            try:
+                self.sender.close_unused(self.session)
+            except (smtplib.SMTPException, socket.error):
+                # It was not going to be used anyway
+                pass
+
+    def release(self):
+        self.finished.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.finished.set()
+
+
+class Prefetcher(threading.Thread):
+    """Encodes ``files`` into the attachment cache of ``sender`` ahead
+    of sending them, in the worker processes of ``pool``, so that the
+    encoding runs on other cores while earlier files are uploaded.
+
+    At most ``max_ahead`` files are encoded, or waiting to be sent,
+    at a time; the next one is only started once the send has come
+    to one of them. ``cancel`` stops starting new ones.
+    """
+
+    def __init__(self, sender, files, pool, max_ahead=4):
+        super(Prefetcher, self).__init__()
+        self.sender = sender
+        self.files = files
+        self.pool = pool
+        self.slots = threading.Semaphore(max_ahead)
+        self.started = []
+        self.cancelled = False
+        self.daemon = True
+
+    def run(self):
+        cache = self.sender.cache
+        for file_path in self.files:
+            self.slots.acquire()
+            if self.cancelled:
+                break
+            try:
+                file_path = self.sender.package(file_path)
+                if cache.lookup(file_path):
+                    self.slots.release()
+                    continue
+                stat = stat_file(file_path)
+            except (IOError, OSError):
+                # The send will report it
+                self.slots.release()
+                continue
+            result = self.pool.apply_async(
+                encode_file, (file_path, cache.directory))
+            self.started.append(file_path)
+            cache.add_pending(
+                file_path, partial(self.finish, file_path, stat, result))
+
+    def finish(self, file_path, stat, result):
+        """Wait for the encoding of ``file_path`` to complete, and
+        store it in the cache. If it failed, the file is encoded while
+        it is sent.
+        """
+        try:
+            temp, digest, size = result.get()
+        except (IOError, OSError):
+            return
+        finally:
+            self.slots.release()
+        if size != stat.st_size:
+            # The file changed while we were reading it
+            os.unlink(temp)
+            return
+        self.sender.cache.store(file_path, stat, digest, temp)
+
+    def cancel(self):
+        """Start no more encodings, and put those done in the cache."""
+        self.cancelled = True
+        self.slots.release()
+        self.join()
+        for file_path in self.started:
+            wait = self.sender.cache.take_pending(file_path)
+            if wait:
+                wait()
+
+
+# Priorities of send jobs: documents the user is waiting for go before
+# those sent in the background.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+
+class SendJob(object):
+    """A request to send ``files`` to ``recipient``, to be processed
+    by a ``SendQueue``.
+    """
+
+    # The attributes stored in the spool
+    FIELDS = ('id', 'recipient', 'files', 'convert', 'force', 'groups',
+              'sent', 'skipped', 'failed', 'errors', 'attempts',
+              'next_attempt', 'priority', 'queued_at', 'size')
+
+    def __init__(self, recipient, files, convert=True, force=False,
+                 priority=PRIORITY_BATCH):
+        self.id = None
+        self.recipient = recipient
+        self.files = files
+        self.convert = convert
+        # Send documents even if they have been delivered before
+        self.force = force
+        # One of the PRIORITY_ constants, when the job was queued, and
+        # the size of its documents, once the queue has looked it up.
+        self.priority = priority
+        self.queued_at = time.time()
+        self.size = None
+        # The ``(recipients, files)`` messages planned by
+        # ``SendKindle.plan``, and how many of those have been sent.
+        self.groups = None
+        self.sent = 0
+        # Files that had been delivered before, files that could not
+        # be sent for good, and why not.
+        self.skipped = []
+        self.failed = []
+        self.errors = []
+        # Transient failures so far, the last of them, and when to
+        # try again.
+        self.attempts = 0
+        self.last_error = None
+        self.next_attempt = 0
+        # Set to the ``SendKindleException`` if sending failed.
+        self.error = None
+        # Called with the job from the queue's thread when done,
+        # or when a failed send has been rescheduled, and while a
+        # message is being uploaded (see ``progress``).
+        self.on_done = None
+        self.on_retry = None
+        self.on_progress = None
+        # Tracks the upload of the message currently being sent,
+        # of the group ``sent``.
+        self.progress = SendProgress(self._progress)
+        # Set if the job has been cancelled by ``cancel``.
+        self.cancelled = False
+
+    def _progress(self, progress):
+        if self.on_progress:
+            self.on_progress(self)
+
+    def cancel(self):
+        """Stop sending the job. If it is being sent, the upload
+        stops after the current chunk.
+        """
+        self.cancelled = True
+        self.progress.cancel()
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    def get_remaining(self):
+        """Estimate how many bytes of the messages not yet sent are
+        left to upload, as encoded on the wire.
+        """
+        size = base64_size(self.size or 0)
+        if self.groups:
+            size = size * (len(self.groups) - self.sent) // len(self.groups)
+        return size
+
+    @classmethod
+    def from_dict(cls, data):
+        job = cls(data['recipient'], data['files'], data['convert'])
+        for name in cls.FIELDS:
+            setattr(job, name, data.get(name, getattr(job, name)))
+        return job
+
+    def describe(self):
+        """Return a short description of the documents, for use in
+        notifications and menus.
+        """
+        if len(self.files) == 1:
+            return '"%s"' % get_basename(self.files[0])
+        return '%d documents' % len(self.files)
+
+
+# How often, and how soon, to retry after transient send errors.
+RETRY_MAX_ATTEMPTS = 8
+RETRY_BASE_DELAY = 30
+RETRY_MAX_DELAY = 60 * 60
+
+
+# The queue sends the job that costs the least first. The cost of a job
+# is the size of its documents, in bytes, which sends short jobs first;
+# plus QUEUE_PRIORITY_COST for every priority level below the highest;
+# plus the bytes sent to the same recipients lately, halved every
+# QUEUE_USAGE_HALF_LIFE seconds, so one Kindle cannot hog the queue;
+# minus QUEUE_AGING_RATE for every second the job has waited, so even
+# large batch jobs get their turn eventually.
+QUEUE_PRIORITY_COST = 64 * 1024 * 1024
+QUEUE_USAGE_HALF_LIFE = 60
+QUEUE_AGING_RATE = 256 * 1024
+# How much the upload rate measured for a message counts into the
+# rate used to estimate when jobs start
+QUEUE_RATE_WEIGHT = 0.3
+# While idle, how often the queue closes the sessions of its sender
+# that have been idle for too long
+QUEUE_PRUNE_INTERVAL = 15
+
+
+def get_retry_delay(attempts):
+    """Return the seconds to wait before retrying a send that failed
+    ``attempts`` times: exponential backoff with jitter, so many
+    queued jobs don't hit the server all at once again.
+    """
+    delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def write_atomic(filename, data):
+    """Replace ``filename`` with ``data``, such that after a crash
+    either the old or the new version exists.
+    """
+    temp = filename + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp, filename)
+
+
+class Spool(object):
+    """Stores the ``SendJob`` instances not yet completed in a
+    directory, so they survive a crash or restart.
+
+    Every job is a ``<id>.json`` file. The messages prepared for it
+    are kept as ``<id>-<group>.eml`` files, so a retry does not need
+    to read and encode the documents again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not path.exists(directory):
+            os.makedirs(directory)
+
+    def add(self, job):
+        job.id = '%d-%06x' % (time.time() * 1000, random.getrandbits(24))
+        self.save(job)
+
+    def save(self, job):
+        write_atomic(self.job_path(job), json.dumps(job.to_dict()))
+        # Messages that have been sent are no longer needed.
+        for index in range(job.sent):
+            self._unlink(self.message_path(job, index))
+
+    def remove(self, job):
+        if job.groups:
+            for index in range(len(job.groups)):
+                self._unlink(self.message_path(job, index))
+        self._unlink(self.job_path(job))
+
+    def load(self, on_error=None):
+        """Return the jobs in the spool, oldest first. ``on_error`` is
+        called with the path and the error for every job that cannot
+        be read.
+        """
+        jobs = []
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(path.join(self.directory, filename)) as f:
+                    jobs.append(SendJob.from_dict(json.load(f)))
+            except (IOError, ValueError, KeyError), e:
+                if on_error:
+                    on_error(path.join(self.directory, filename), e)
+        return jobs
+
+    def get_prepared_message(self, job, index):
+        """Return the message prepared for the group ``index`` of
+        ``job`` by an earlier attempt, or ``None``.
+        """
+        filename = self.message_path(job, index)
+        if path.exists(filename):
+            return PreparedMessage(filename)
+        return None
+
+    def spool_message(self, job, index, message):
+        """Wrap ``message`` such that it is kept in the spool while
+        being sent, as the group ``index`` of ``job``.
+        """
+        return SpoolingMessage(message, self.message_path(job, index))
+
+    def job_path(self, job):
+        return path.join(self.directory, '%s.json' % job.id)
+
+    def message_path(self, job, index):
+        return path.join(self.directory, '%s-%d.eml' % (job.id, index))
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class SendQueue(threading.Thread):
+    """Sends queued ``SendJob`` instances one after another, in a
+    background thread so we don't block the UI.
+
+    ``get_sender`` is a callable returning the ``SendKindle`` instance
+    to use. It is called for every job, so that changed settings
+    apply to the next job.
+
+    Jobs are kept in ``spool``, if given, until they are done. Sends
+    that fail with a transient error are retried later. Which job is
+    sent next is decided by ``get_cost``.
+    """
+
+    def __init__(self, get_sender, spool=None):
+        super(SendQueue, self).__init__()
+        self.get_sender = get_sender
+        self.spool = spool
+        self.pending = []
+        self.current = None
+        self.condition = threading.Condition()
+        # Recipients -> the bytes sent to them lately, and when that
+        # was last updated
+        self.usage = {}
+        # The upload rate in bytes per second, once measured
+        self.rate = None
+        # The sender of the last job, while it may have sessions open
+        # that need to be closed once idle for too long
+        self.idle_sender = None
+
+        # A send in progress can be cancelled (see ``cancel``), but
+        # that takes up to a chunk; don't keep the process alive for it.
+        self.daemon = True
+
+    def put(self, job):
+        if self.spool and job.id is None:
+            self.spool.add(job)
+        with self.condition:
+            self.pending.append(job)
+            self.condition.notify()
+
+    def clear(self):
+        """Drop all jobs that have not been started yet, and return
+        them.
+        """
+        with self.condition:
+            dropped, self.pending = self.pending, []
+        if self.spool:
+            for job in dropped:
+                self.spool.remove(job)
+        return dropped
+
+    def cancel(self):
+        """Drop all pending jobs, and cancel the one being sent, if
+        any. Its ``on_done`` callback is called once it has stopped.
+        """
+        dropped = self.clear()
+        for job in dropped:
+            job.cancel()
+        with self.condition:
+            if self.current:
+                self.current.cancel()
+        return dropped
+
+    def is_idle(self):
+        with self.condition:
+            return not self.pending and self.current is None
+
+    def run(self):
+        while True:
+            self._measure_jobs()
+            with self.condition:
+                job = self._next_job()
+                if job is None:
+                    timeout = self._time_to_next_job()
+                    if self.idle_sender and (
+                            timeout is None or timeout > QUEUE_PRUNE_INTERVAL):
+                        timeout = QUEUE_PRUNE_INTERVAL
+                    self.condition.wait(timeout)
+                else:
+                    self.pending.remove(job)
+                    self.current = job
+            if job is None:
+                if self.idle_sender and not self.idle_sender.prune():
+                    self.idle_sender = None
+                continue
+            done = self.process(job)
+            with self.condition:
+                self.current = None
+                if not done:
+                    self.pending.append(job)
+            callback = job.on_done if done else job.on_retry
+            if callback:
+                callback(job)
+
+    def _measure_jobs(self):
+        """Look up the size of the jobs queued since the last time,
+        without holding the lock, as it may take a while for URIs.
+        """
+        with self.condition:
+            jobs = [job for job in self.pending if job.size is None]
+        for job in jobs:
+            size = 0
+            for file_path in job.files:
+                try:
+                    size += stat_file(file_path).st_size
+                except (IOError, OSError):
+                    # Sending will report it
+                    pass
+            job.size = size
+
+    def _next_job(self, jobs=None, now=None):
+        now = now or time.time()
+        ready = [job for job in (self.pending if jobs is None else jobs)
+                 if job.next_attempt <= now]
+        if not ready:
+            return None
+        return min(ready, key=lambda job: self.get_cost(job, now))
+
+    def get_cost(self, job, now):
+        """Return the cost of sending ``job`` at ``now``; the pending
+        job with the lowest cost is sent first.
+        """
+        return (job.priority * QUEUE_PRIORITY_COST + (job.size or 0) +
+                self.get_usage(job.recipient, now) -
+                (now - job.queued_at) * QUEUE_AGING_RATE)
+
+    def get_usage(self, recipient, now):
+        """Return how many bytes have been sent to ``recipient``
+        lately, with those sent longer ago counting less.
+        """
+        sent, updated = self.usage.get(tuple(as_list(recipient)), (0, now))
+        return sent * 0.5 ** ((now - updated) / QUEUE_USAGE_HALF_LIFE)
+
+    def add_usage(self, job, progress):
+        """Note that the message tracked by ``progress`` has been sent
+        for ``job``, for the recipients' usage and the upload rate.
+        """
+        now = time.time()
+        self.usage[tuple(as_list(job.recipient))] = (
+            self.get_usage(job.recipient, now) + progress.total, now)
+        # Including the time held back by rate limits, which will hold
+        # back the next jobs as well
+        elapsed = now - progress.started
+        if progress.total and elapsed > 0:
+            rate = progress.total / elapsed
+            if self.rate:
+                rate = (QUEUE_RATE_WEIGHT * rate +
+                        (1 - QUEUE_RATE_WEIGHT) * self.rate)
+            self.rate = rate
+
+    def get_schedule(self):
+        """Return the pending jobs in the order they are expected to be
+        sent in, as ``(job, start)`` pairs, ``start`` being an estimate
+        of when the job will be started, or None until the upload rate
+        is known.
+        """
+        now = time.time()
+        with self.condition:
+            pending = list(self.pending)
+            current = self.current
+        rate = self.rate
+        start = now
+        if current and rate:
+            start += max(0, current.get_remaining() -
+                         current.progress.sent) / rate
+        schedule = []
+        while pending:
+            job = self._next_job(pending, start)
+            if job is None:
+                # Waiting for a retry
+                job = min(pending, key=lambda job: job.next_attempt)
+                start = job.next_attempt
+            pending.remove(job)
+            schedule.append((job, start if rate else None))
+            if rate:
+                start += job.get_remaining() / rate
+        return schedule
+
+    def _time_to_next_job(self):
+        if not self.pending:
+            return None
+        return max(0, min(job.next_attempt for job in self.pending) -
+                      time.time())
+
+    def process(self, job):
+        """Send the job. Return False if it failed with a transient
+        error and should be retried later.
+        """
+        if os.environ.get('STK_SLEEP', False) == '1':
+            # For debugging purposes.
+            time.sleep(5)
+            return True
+
+        sender = self.idle_sender = self.get_sender()
+        try:
+            job.progress.check()
+            if job.groups is None:
+                job.groups = sender.plan(
+                    job.recipient, job.files, job.convert, job.force)
+                job.skipped = get_skipped(job.files, job.groups)
+            # Spooled messages are always encoded
+            sender.prefetch([f for recipients, group in job.groups[job.sent:]
+                             for f in group],
+                            'base64' if self.spool else None)
+            while job.sent < len(job.groups):
+                recipients, group = job.groups[job.sent]
+                try:
+                    message = self.get_message(sender, job, recipients, group)
+                    delivered, refused = sender.send_message(
+                        recipients, message, job.progress)
+                    self.add_usage(job, job.progress)
+                    sender.record_delivery(group, delivered, job.convert)
+                    if refused:
+                        job.failed.extend(group)
+                        job.errors.append(describe_error(
+                            smtplib.SMTPRecipientsRefused(refused)))
+                except SendCancelled:
+                    raise
+                except (smtplib.SMTPException, SendKindleException,
+                        IOError, OSError), e:
+                    if is_transient_error(e):
+                        raise
+                    job.failed.extend(group)
+                    job.errors.append(describe_error(e))
+                job.sent += 1
+                if self.spool:
+                    self.spool.save(job)
+        except SendCancelled:
+            # Groups sent before stay recorded in the ledger.
+            if self.spool:
+                self.spool.remove(job)
+            return True
+        except (smtplib.SMTPException, IOError, OSError), e:
+            if is_transient_error(e) and job.attempts < RETRY_MAX_ATTEMPTS:
+                job.last_error = describe_error(e)
+                job.attempts += 1
+                job.next_attempt = time.time() + get_retry_delay(job.attempts)
+                if self.spool:
+                    self.spool.save(job)
+                return False
+            job.errors.append(describe_error(e))
+            self.fail_remaining(job)
+        except Exception, e:
+            # Whatever went wrong, it must not stop the queue, nor
+            # come back with the job from the spool on every start.
+            log.exception('Failed to send %s', job.describe())
+            job.errors.append('unexpected error: %s' % describe_error(e))
+            self.fail_remaining(job)
+
+        if self.spool:
+            self.spool.remove(job)
+        if job.failed:
+            job.error = batch_failure(job.failed, job.files, job.errors)
+        return True
+
+    def fail_remaining(self, job):
+        """Mark the files of ``job`` not sent yet as failed."""
+        if job.groups is None:
+            job.failed.extend(job.files)
+        else:
+            for recipients, group in job.groups[job.sent:]:
+                job.failed.extend(group)
+
+    def get_message(self, sender, job, recipients, group):
+        if self.spool:
+            prepared = self.spool.get_prepared_message(job, job.sent)
+            if prepared:
+                return prepared
+        message = sender.create_message(recipients, group, job.convert)
+        if self.spool:
+            return self.spool.spool_message(job, job.sent, message)
+        return message
+
+
+def get_socket_path():
+    """Return the path of the Unix socket through which a running
+    instance accepts requests from others.
+    """
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return path.join(base, 'sendtokindle-%d.sock' % os.getuid())
+
+
+def send_request(request, socket_path=None):
+    """Pass ``request``, a dict, to the running instance, and return
+    its reply. Returns ``None`` if no instance is running.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path or get_socket_path())
+        sock.sendall(json.dumps(request) + '\n')
+        reply = sock.makefile('rb').readline()
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    return json.loads(reply) if reply else None
+
+
+class IPCRequestHandler(SocketServer.StreamRequestHandler):
+    """Reads one JSON request per connection, and writes back the
+    reply of ``IPCServer.dispatch``.
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            reply = {'error': 'Invalid request'}
+        else:
+            reply = self.server.dispatch(request)
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+class IPCServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Accepts requests from other instances on a Unix socket, and
+    passes them to ``dispatch``, which is called in a server thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, dispatch, socket_path=None):
+        self.dispatch = dispatch
+        self.socket_path = socket_path or get_socket_path()
+        SocketServer.UnixStreamServer.__init__(
+            self, self.socket_path, IPCRequestHandler)
+
+    @classmethod
+    def listen(cls, dispatch, socket_path=None):
+        """Start a server in a background thread, unless another
+        instance is already listening; return ``None`` in that case.
+        """
+        socket_path = socket_path or get_socket_path()
+        try:
+            server = cls(dispatch, socket_path)
+        except socket.error, e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            if send_request({'command': 'ping'}, socket_path) is not None:
+                return None
+            # Left behind by an instance that did not exit cleanly.
+            os.unlink(socket_path)
+            server = cls(dispatch, socket_path)
+
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+# Events of inotify(7) we are interested in
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# A watched directory is sent as a batch once no document arrived in
+# it for WATCH_DEBOUNCE seconds, or WATCH_WINDOW seconds after the
+# first one, whichever comes first.
+WATCH_DEBOUNCE = 0.25
+WATCH_WINDOW = 0.75
+# Appended to the names of documents that have been sent, unless they
+# are moved elsewhere
+SENT_SUFFIX = '.sent'
+
+
+class Inotify(object):
+    """The events of the files in watched directories, through the
+    inotify API of Linux, which is called with ``ctypes``.
+    """
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.get_errno = ctypes.get_errno
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def check(self, result):
+        if result < 0:
+            error = self.get_errno()
+            raise OSError(error, os.strerror(error))
+        return result
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, directory, mask):
+        """Start watching ``directory`` for the events in ``mask``, and
+        return the watch descriptor.
+        """
+        return self.check(self.libc.inotify_add_watch(
+            self.fd, directory.encode(sys.getfilesystemencoding())
+            if isinstance(directory, unicode) else directory, mask))
+
+    def read(self):
+        """Return the events that have happened, as tuples of the watch
+        descriptor, the event mask and the name of the file.
+        """
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            offset += struct.calcsize('iIII')
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """Sends the documents that are put into ``directory`` to
+    ``recipient``, through ``sender``.
+
+    A document is noticed once the program that wrote it closes it, or
+    once it is moved into the directory. Documents arriving close
+    together are sent as a batch; those that could be sent, or had
+    been before, are then moved into ``move_to``, or get ``.sent``
+    appended to their name. Hidden files, and backup files ending in
+    ``~``, are left alone.
+    """
+
+    def __init__(self, sender, directory, recipient, convert=True,
+                 force=False, move_to=None, window=WATCH_WINDOW,
+                 debounce=WATCH_DEBOUNCE):
+        self.sender = sender
+        self.directory = directory
+        self.recipient = recipient
+        self.convert = convert
+        self.force = force
+        self.move_to = move_to
+        self.window = window
+        self.debounce = min(debounce, window)
+
+    def is_document(self, name):
+        return not name.startswith('.') and \
+            not name.endswith(('~', SENT_SUFFIX))
+
+    def run(self):
+        """Watch the directory until it is removed. Blocks without
+        using the CPU while no documents arrive.
+        """
+        inotify = Inotify()
+        try:
+            inotify.add_watch(
+                self.directory, IN_CLOSE_WRITE | IN_MOVED_TO |
+                IN_MOVED_FROM | IN_DELETE)
+            self.watch(inotify)
+        finally:
+            inotify.close()
+
+    def watch(self, inotify):
+        pending = OrderedDict()
+        first = last = None
+        # Whether the sender may have sessions open that need to be
+        # closed once idle for too long
+        sessions = False
+        while True:
+            timeout = QUEUE_PRUNE_INTERVAL if sessions else None
+            if pending:
+                due = min(last + self.debounce, first + self.window)
+                timeout = max(0, due - time.time())
+            try:
+                ready = select.select([inotify], [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if ready:
+                for wd, mask, name in inotify.read():
+                    if mask & IN_IGNORED:
+                        # The directory is gone
+                        return
+                    if mask & IN_ISDIR or not self.is_document(name):
+                        continue
+                    file_path = path.join(self.directory, name)
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        pending[file_path] = True
+                        last = time.time()
+                        first = first or last
+                    else:
+                        pending.pop(file_path, None)
+                if not pending:
+                    first = None
+                    continue
+            if pending and time.time() >= \
+                    min(last + self.debounce, first + self.window):
+                self.send(pending.keys())
+                pending.clear()
+                first = None
+                sessions = True
+            elif not pending and sessions:
+                sessions = self.sender.prune()
+
+    def send(self, files):
+        """Send ``files`` as a batch, and move or rename those that
+        do not need to be sent again.
+        """
+        failed = []
+        try:
+            skipped = self.sender.send_batch(
+                self.recipient, files, convert=self.convert, force=self.force)
+            for file_path in skipped:
+                print 'Skipped %s, it has been delivered before' % file_path
+        except SendKindleException, e:
+            print >>sys.stderr, e
+            failed = getattr(e, 'files', files)
+        for file_path in files:
+            if file_path not in failed:
+                self.finish(file_path)
+
+    def finish(self, file_path):
+        """Move ``file_path`` out of the way, now that it was sent."""
+        if self.move_to:
+            target = path.join(self.move_to, path.basename(file_path))
+        else:
+            target = file_path + SENT_SUFFIX
+        try:
+            shutil.move(file_path, target)
+        except (IOError, OSError), e:
+            print >>sys.stderr, e
+
+
+def merge(dict1, dict2):
+    """Merge ``dict2`` into ``dict1``.
+
+    This is basically a recursive update.
+    """
+    for key, val in dict2.items():
+        if isinstance(val, dict):
+            child = dict1.setdefault(key, {})
+            merge(child, val)
+        else:
+            dict1[key] = val
+
+
+class Application(object):
+    """Holds the configuration, and the ``SendKindle`` instance
+    to send documents with.
+
+    This is everything a front end needs to send documents; the GTK
+    user interface extends it.
+    """
+
+    def __init__(self):
+        super(Application, self).__init__()
+        self.sender = None
+        self.sender_lock = threading.Lock()
+        self.cache = None
+        self.ledger = None
+        self.packager = None
+        self.set_default_config()
+        self.load_config()
+
+    def get_config_path(self):
+        """Return the folder where we store our configuration files.
+
+        Will create the folder if it doesn't exist.
+        """
+        # http://standards.freedesktop.org/basedir-spec/latest/ar01s03.html
+        base = os.environ.get('XDG_CONFIG_HOME') or path.expanduser('~/.config')
+        dir = path.join(base, 'sendtokindle')
+        if not path.exists(dir):
+            os.mkdir(dir)
+        return dir
+
+    def get_data_path(self):
+        """Return the folder where we store our data, like queued
+        documents.
+
+        Will create the folder if it doesn't exist.
+        """
+        base = os.environ.get('XDG_DATA_HOME') or \
+            path.expanduser('~/.local/share')
+        dir = path.join(base, 'sendtokindle')
+        if not path.exists(dir):
+            os.makedirs(dir)
+        return dir
+
+    def get_cache_path(self):
+        """Return the folder where we keep data that can be
+        recreated, like encoded attachments.
+
+        Will create the folder if it doesn't exist.
+        """
+        base = os.environ.get('XDG_CACHE_HOME') or \
+            path.expanduser('~/.cache')
+        dir = path.join(base, 'sendtokindle')
+        if not path.exists(dir):
+            os.makedirs(dir)
+        return dir
+
+    def set_default_config(self):
+        """Initialize the default configuration.
+        """
+        self.config = {
+            # Permanent settings
+            'settings': {
+                'user': {
+                    'email': '',
+                    'kindle-name': '',
+                    'in_us': False,
+                    # Further Kindles: name -> Kindle e-mail name
+                    # or address
+                    'devices': {},
+                    # Group name -> list of device names
+                    'groups': {},
+                },
+                'smtp': {
+                    'host': '',
+                    'port': '',
+                    'username': '',
+                    'password': '',
+                    # '', 'tls' or 'starttls' for SMTP; or 'lmtp',
+                    # 'sendmail', 'maildir' or 'eml'
+                    'type': '',
+                    # The sendmail command, or the directory messages
+                    # are written to
+                    'path': '',
+                    'max-recipients': 50,
+                    # "async" to run many SMTP sessions at once
+                    'engine': '',
+                    'max-sessions': 4,
+                    # In KiB/s, and messages started per minute, over
+                    # all relays; 0 for no limit
+                    'max-rate': 0,
+                    'max-messages-per-minute': 0,
+                    # Whether to check the server's certificate, and
+                    # the CA certificates to check it against, if not
+                    # the system's
+                    'verify': True,
+                    'ca-file': '',
+                    # Servers to spread the messages over, each a dict
+                    # of the settings above that differ, plus a
+                    # "weight"; empty to just use the one above
+                    'relays': [],
+                },
+                'cache': {
+                    # In MB; 0 disables the cache of encoded attachments
+                    'max-size': 512,
+                    # For batches, encode up to this many documents
+                    # ahead of sending, in this many processes (0 for
+                    # one per core)
+                    'prefetch': 4,
+                    'encoders': 0,
+                },
+                'compress': {
+                    # Send documents as ZIP archives where that makes
+                    # the upload at least "min-saving" percent smaller
+                    'enabled': False,
+                    'min-saving': 10,
+                },
+            },
+            # Transient window state
+            'state': {
+                'convert': True,
+                'free': True,
+            }
+        }
+
+    def load_config(self):
+        """Load configuration from a file.
+
+        Note that we have two different types of config values, the
+        actual settings, and the last window state that we store and
+        restore.
+        """
+        config_path = self.get_config_path()
+
+        permanent_config = path.join(config_path, 'settings.json')
+        if path.isfile(permanent_config):
+            with open(permanent_config) as f:
+                merge(self.config['settings'], json.load(f))
+
+        state_config = path.join(config_path, 'state.json')
+        if path.isfile(state_config):
+            with open(state_config) as f:
+                merge(self.config['state'], json.load(f))
+
+        self.notify_config_changed()
+
+    def save_config(self):
+        """Write current configuration to a file.
+        """
+        config_path = self.get_config_path()
+
+        permanent_config = path.join(config_path, 'settings.json')
+        with open(permanent_config, 'w') as f:
+            json.dump(self.config['settings'], f)
+
+        state_config = path.join(config_path, 'state.json')
+        with open(state_config, 'w') as f:
+            json.dump(self.config['state'], f)
+
+    def notify_config_changed(self):
+        """Should be called by whoever modifies the configuration
+        after he is done.
+        """
+
+    def get_sender(self):
+        """Return a ``SendKindle`` instance for the current settings.
+
+        The instance is kept around as long as the settings do not
+        change, so that its SMTP sessions can be reused.
+        """
+        key = json.dumps(self.config['settings'], sort_keys=True)
+        with self.sender_lock:
+            if self.sender and self.sender_key != key:
+                self.sender.close()
+                self.sender = None
+            if not self.sender:
+                self.sender = SendKindle(
+                    self.config['settings'], cache=self.get_cache(),
+                    ledger=self.get_ledger(), packager=self.get_packager())
+                self.sender_key = key
+            return self.sender
+
+    def get_ledger(self):
+        """Return the ``Ledger`` of delivered documents.
+        """
+        if not self.ledger:
+            self.ledger = Ledger(
+                path.join(self.get_config_path(), 'ledger.sqlite'))
+        return self.ledger
+
+    def get_packager(self):
+        """Return the ``Packager``, or None if compression is off.
+        """
+        settings = self.config['settings']['compress']
+        if not settings['enabled']:
+            return None
+        if not self.packager:
+            self.packager = Packager(
+                path.join(self.get_cache_path(), 'packages'))
+        self.packager.min_saving = settings['min-saving'] / 100.0
+        return self.packager
+
+    def get_cache(self):
+        """Return the ``AttachmentCache``, or None if disabled.
+        """
+        max_size = self.config['settings']['cache']['max-size']
+        if not max_size:
+            return None
+        if not self.cache:
+            self.cache = AttachmentCache(
+                path.join(self.get_cache_path(), 'attachments'),
+                max_size * 1024 * 1024)
+        self.cache.max_size = max_size * 1024 * 1024
+        return self.cache
+
+    def get_recipient(self, free=True):
+        """Return the address of the configured Kindle.
+        """
+        username = self.config['settings']['user']['kindle-name']
+        host = 'free.kindle.com' if free else 'kindle.com'
+        return "%s@%s" % (username, host)
+
+    def get_recipients(self, targets=None, free=True):
+        """Resolve ``targets`` into a list of addresses.
+
+        A target may be the name of a device or a group of devices
+        configured in the settings, a Kindle e-mail name, or a full
+        address. Without targets, returns the configured Kindle.
+        """
+        if not targets:
+            return [self.get_recipient(free)]
+        user = self.config['settings']['user']
+        host = 'free.kindle.com' if free else 'kindle.com'
+        recipients = []
+        for target in targets:
+            names = user['groups'].get(target, [target])
+            for name in names:
+                name = user['devices'].get(name, name)
+                address = name if '@' in name else "%s@%s" % (name, host)
+                if address not in recipients:
+                    recipients.append(address)
+        return recipients
+
+    def is_configured(self):
+        """Check if we are configured, and ready to send documents.
+        """
+        for key in ('email', 'kindle-name'):
+            if not self.config['settings']['user'][key]:
+                return False
+        smtp = self.config['settings']['smtp']
+        if smtp['type'] in ('maildir', 'eml'):
+            return bool(smtp['path'])
+        if smtp['type'] != 'sendmail' and not smtp['host']:
+            return False
+        return True
+
+
+def main(argv=None):
+    """Entry point of ``sendtokindle-cli``, which sends documents
+    without any user interface.
+    """
+    parser = argparse.ArgumentParser(
+        prog='sendtokindle-cli', description='Send documents to your Kindle.')
+    parser.add_argument('files', nargs='*', metavar='FILE')
+    parser.add_argument(
+        '-t', '--to', dest='targets', action='append', metavar='DEVICE',
+        help='device, group of devices or address to send to; may be '
+             'given multiple times (default: the configured Kindle)')
+    parser.add_argument(
+        '--paid', action='store_true',
+        help='deliver via kindle.com rather than free.kindle.com '
+             '(Whispernet delivery, may cost money)')
+    parser.add_argument(
+        '--no-convert', dest='convert', action='store_false',
+        help='do not ask Amazon to convert the documents')
+    parser.add_argument(
+        '-f', '--force', action='store_true',
+        help='send documents even if they have been delivered before')
+    parser.add_argument(
+        '--zip', action='store_true',
+        help='send documents as ZIP archives where that makes the '
+             'upload noticeably smaller')
+    parser.add_argument(
+        '--check', action='store_true',
+        help='do not send anything, show whether the documents have '
+             'been delivered to the devices before')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='print the time spent in each phase of sending every '
+             'message, as a line of JSON, to stderr')
+    parser.add_argument(
+        '--queue', action='store_true',
+        help='let a running sendtokindle instance send the documents '
+             'in the background, if there is one')
+    parser.add_argument(
+        '--watch', metavar='DIRECTORY',
+        help='keep running, and send the documents put into DIRECTORY; '
+             'they get %s appended to their name once sent' % SENT_SUFFIX)
+    parser.add_argument(
+        '--move-to', metavar='DIRECTORY',
+        help='with --watch, move sent documents into DIRECTORY instead')
+    parser.add_argument(
+        '--window', type=float, default=WATCH_WINDOW, metavar='SECONDS',
+        help='with --watch, send documents arriving within this time '
+             'of each other together (default: %s)' % WATCH_WINDOW)
+    args = parser.parse_args(argv)
+    if not args.files and not args.watch:
+        parser.error('no documents given')
+    if args.watch and not path.isdir(args.watch):
+        parser.error('not a directory: %s' % args.watch)
+
+    application = Application()
+    if not application.is_configured():
+        print >>sys.stderr, \
+            'Not configured; run sendtokindle to set up your Kindle first.'
+        return 2
+    if args.zip:
+        application.config['settings']['compress']['enabled'] = True
+    recipient = application.get_recipients(args.targets, free=not args.paid)
+    files = [get_absolute(filename) for filename in args.files]
+
+    if args.watch:
+        return watch_directory(application.get_sender(), args, recipient)
+
+    if args.check:
+        return check_deliveries(application.get_sender(), recipient, files)
+
+    if args.queue:
+        reply = send_request({'command': 'send', 'recipient': recipient,
+                              'files': files, 'convert': args.convert,
+                              'force': args.force})
+        if reply is not None:
+            if 'error' in reply:
+                print >>sys.stderr, reply['error']
+                return 1
+            return 0
+
+    sender = application.get_sender()
+    if args.stats:
+        sender.add_observer(
+            lambda record: sys.stderr.write(json.dumps(record) + '\n'))
+    try:
+        skipped = sender.send_batch(
+            recipient, files, convert=args.convert, force=args.force)
+        for file_path in skipped:
+            print 'Skipped %s, it has been delivered before' % file_path
+    except SendKindleException, e:
+        print >>sys.stderr, e
+        return 1
+    finally:
+        sender.close()
+    return 0
+
+
+def watch_directory(sender, args, recipient):
+    """Send the documents put into the directory given with
+    ``--watch``, until interrupted.
+    """
+    watcher = Watcher(
+        sender, get_absolute(args.watch), recipient, convert=args.convert,
+        force=args.force, move_to=args.move_to, window=args.window)
+    if args.stats:
+        sender.add_observer(
+            lambda record: sys.stderr.write(json.dumps(record) + '\n'))
+    try:
+        watcher.run()
+    except OSError, e:
+        print >>sys.stderr, e
+        return 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sender.close()
+    return 0
+
+
+def check_deliveries(sender, recipients, files):
+    """Print whether ``files`` have been delivered to ``recipients``.
+    Returns 0 if all of them have.
+    """
+    missing = 0
+    for file_path in files:
+        try:
+            deliveries = sender.ledger.get_deliveries(
+                sender.get_digest(file_path))
+        except (IOError, OSError), e:
+            print >>sys.stderr, e
+            return 1
+        for recipient in recipients:
+            times = [sent_at for to, convert, sent_at, response in deliveries
+                     if to == recipient]
+            if times:
+                print '%s: delivered to %s on %s' % (
+                    file_path, recipient,
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(times[-1])))
+            else:
+                print '%s: not delivered to %s' % (file_path, recipient)
+                missing += 1
+    return 1 if missing else 0
@@ -0,0 +1,830 @@
+# coding: utf8
+"""
+Graphical Send to Kindle Utility.
+
+Created 2011 by Michael Elsdörfer <michael@elsdoerfer.com>.
+
+Licensed under GNU AGPL 3.
+"""
+
+import re
+import sys
+import time
+from os import path
+from decimal import Decimal
+
+# Notify and AppIndicator are only imported once they are needed, see
+# ``notify`` and ``Indicator``, so the window shows sooner.
+from gi.repository import Gtk, Gio, GLib, GObject
+
+from sendkindle import (
+    Application, SendJob, SendQueue, Spool, IPCServer, send_request,
+    base64_size, sizeof_fmt, PRIORITY_INTERACTIVE)
+
+
+# TODO: This does't make much sense, since libindicator doesn't seem
+# to respect it; so we really need to install our icons system-wide,
+# even for development.
+#p =  path.normpath(path.abspath(path.join(path.dirname(__file__), 'data', 'icons')))
+#Gtk.IconTheme.get_default().prepend_search_path(p)
+
+
+def notify(summary, body, icon):
+    """Show a desktop notification, setting up libnotify first if
+    this is the first one.
+    """
+    from gi.repository import Notify
+    if not Notify.is_initted():
+        Notify.init('send-to-kindle')
+    Notify.Notification.new(summary, body, icon).show()
+
+
+def get_layout_file_path(name):
+    """Return path to layout file; check running from source,
+    or globally installed scenarios.
+    """
+    script = path.abspath(sys.argv[0])
+    if script.startswith('/usr/local'):
+        filename= path.join('/usr', 'local', 'share', 'sendtokindle', 'gui', name)
+    elif script.startswith('/usr'):
+        filename= path.join('/usr', 'share', 'sendtokindle', 'gui', name)
+    else:
+        # assume running from dev
+        filename = path.join(path.dirname(__file__), 'data', 'gui', name)
+
+    if path.isfile(filename):
+        return filename
+    raise RuntimeError("Layout file not found: %s" % name)
+
+
+class ConfigureWindow(object):
+    """Encapsulates the configure window.
+    """
+
+    LAYOUT_FILE = 'configure.ui'
+
+    def __init__(self, application):
+        self.application = application
+        self._construct_ui()
+        self.apply_settings(self.application.config['settings'])
+
+    def _construct_ui(self):
+        self.objects = objects = Gtk.Builder()
+        objects.add_from_file(get_layout_file_path(self.LAYOUT_FILE))
+
+        self.window = self.objects.get_object('configure-window')
+
+        self.save_button = objects.get_object('save-button')
+        self.save_button.connect("clicked", self._save_button_clicked)
+        self.cancel_button = objects.get_object('cancel-button')
+        self.cancel_button.connect("clicked", self._cancel_button_clicked)
+
+        # Get all the input fields
+        for name in ('kindle-username-entry', 'sender-email-entry',
+                     'us-checkbox', 'smtp-host-entry', 'smtp-port-entry',
+                     'smtp-username-entry', 'smtp-password-entry',
+                     'smtp-type-combobox'):
+            widget = objects.get_object(name)
+            setattr(self, name.replace('-', '_'), widget)
+            if isinstance(widget, Gtk.Entry):
+                widget.connect_after("changed", self._widget_changed)
+
+        # Surely there is a less verbose way.
+        self.smtp_type_choices = choices = Gtk.ListStore(str, str)
+        choices.append(('', 'No encryption'))
+        choices.append(('tls', 'TLS/SSL'))
+        choices.append(('starttls', 'STARTLS'))
+        # These have no settings here besides the "path" in the
+        # config file.
+        choices.append(('lmtp', 'LMTP'))
+        choices.append(('sendmail', 'Local sendmail'))
+        choices.append(('maildir', 'Maildir'))
+        choices.append(('eml', '.eml files'))
+        self.smtp_type_combobox.set_model(choices)
+        cell = Gtk.CellRendererText()
+        self.smtp_type_combobox.pack_start(cell, True)
+        self.smtp_type_combobox.add_attribute(cell, 'text', 1)
+
+    def _save_button_clicked(self, widget):
+        if not self.validate():
+            return
+        self.update_settings(self.application.config['settings'])
+        self.application.notify_config_changed()
+        self.application.save_config()
+        self.window.destroy()
+
+    def _cancel_button_clicked(self, widget):
+        self.window.destroy()
+
+    def _widget_changed(self, widget):
+        """One of the many value widgets has changed.
+        """
+        self.validate(typing=True)
+
+    def apply_settings(self, settings):
+        """Initialize GUI from settings object.
+        """
+        self.kindle_username_entry.set_text(settings['user']['kindle-name'])
+        self.sender_email_entry.set_text(settings['user']['email'])
+        self.us_checkbox.set_active(settings['user']['in_us'])
+        self.smtp_host_entry.set_text(settings['smtp']['host'])
+        self.smtp_port_entry.set_text("%s" % settings['smtp']['port'])
+        self.smtp_username_entry.set_text(settings['smtp']['username'])
+        self.smtp_password_entry.set_text(settings['smtp']['password'])
+        # Surely there is a less verbose way for this too
+        self.smtp_type_combobox.set_active(0)
+        for index, item in enumerate(self.smtp_type_choices):
+            if item[0] == settings['smtp']['type']:
+                self.smtp_type_combobox.set_active(index)
+                break
+
+    def update_settings(self, settings):
+        """Write GUI values to the settings object.
+        """
+        settings['user']['kindle-name'] = self.kindle_username_entry.get_text()
+        settings['user']['email'] = self.sender_email_entry.get_text()
+        settings['user']['in-us'] = self.us_checkbox.get_active()
+        settings['smtp']['host'] = self.smtp_host_entry.get_text()
+        settings['smtp']['port'] = self.smtp_port_entry.get_text()
+        settings['smtp']['username'] = self.smtp_username_entry.get_text()
+        settings['smtp']['password'] = self.smtp_password_entry.get_text()
+        settings['smtp']['type'] = \
+            self.smtp_type_choices[self.smtp_type_combobox.get_active()][0]
+
+    def validate(self, typing=False):
+        """Validate the form.
+
+        Mark erroneous input fields appropriately. If typing=False,
+        be less aggressive: Empty fields are not marked.
+
+        Return True/False.
+        """
+        errors = {}
+
+        # Required fields - don't validate this on the fly
+        if not typing:
+            names = ['kindle_username_entry', 'sender_email_entry']
+            smtp_type = \
+                self.smtp_type_choices[self.smtp_type_combobox.get_active()][0]
+            # Only a server needs a host
+            if smtp_type in ('', 'tls', 'starttls', 'lmtp'):
+                names.append('smtp_host_entry')
+            for name in names:
+                widget = getattr(self, name)
+                if not widget.get_text():
+                    errors[widget] = 'This is a required field.'
+                else:
+                    errors[widget] = False
+
+        # Port must be numeric
+        if not errors.get(self.smtp_port_entry):
+            text = self.smtp_port_entry.get_text()
+            if text and not text.isdigit():
+                errors[self.smtp_port_entry] = 'This must be a numeric value.'
+            else:
+                errors[self.smtp_port_entry] = False
+
+        # E-mail must match a format
+        if not errors.get(self.sender_email_entry):
+            text = self.sender_email_entry.get_text()
+            # Don't validate email while typing (in a different
+            # field potentially)
+            if (text or not typing):
+                if not re.match(r'[^@]+@.+\..+$', text):
+                    errors[self.sender_email_entry] = \
+                        'This must be a valid E-mail address.'
+                else:
+                    errors[self.sender_email_entry] = False
+
+        # Update widget error messages
+        for widget, msg in errors.items():
+            if msg:
+                widget.set_property('secondary-icon-name', 'gtk-dialog-warning')
+                widget.set_property('secondary-icon-tooltip-text', msg)
+                if not typing:
+                    widget.grab_focus()
+            else:
+                widget.set_property('secondary-icon-name', None)
+                widget.set_property('secondary-icon-tooltip-text', None)
+
+        return not any(errors.values())
+
+    def show(self):
+        self.window.show_all()
+
+
+class MainWindow(object):
+
+    LAYOUT_FILE = 'main.ui'
+
+    def __init__(self, application):
+        self.application = application
+        self.config_handler = self.application.connect(
+            'config-changed', self._config_changed)
+        self.filenames = []
+        self.filesize = 0
+        # The size of the attachments on the wire, once known
+        self.wire_size = None
+        # Gets the send ready while the window is shown
+        self.warm_up = None
+        # For the file infos still being queried
+        self.info_cancellable = None
+        self.info_pending = 0
+        self._construct_ui()
+
+    def _construct_ui(self):
+        self.objects = objects = Gtk.Builder()
+        objects.add_from_file(get_layout_file_path(self.LAYOUT_FILE))
+
+        # Set up various events
+        self.window = window = objects.get_object('main-window')
+        window.connect_after('destroy', self._window_destroy)
+
+        self.send_button = objects.get_object('send-button')
+        self.send_button.connect("clicked", self._send_button_clicked)
+
+        self.configure_button = objects.get_object('configure-button')
+        self.configure_button.connect("clicked", self._configure_button_clicked)
+
+        self.free_radiobutton = objects.get_object('free-radiobutton')
+        self.free_radiobutton.connect(
+            "toggled", self._free_paid_radiobutton_toggled)
+        self.paid_radiobutton = objects.get_object('paid-radiobutton')
+        self.paid_radiobutton.connect(
+            "toggled", self._free_paid_radiobutton_toggled)
+
+        self.cost_label = self.objects.get_object('cost-label')
+
+    def _configure_button_clicked(self, widget):
+        self.show_configure_window()
+
+    def _send_button_clicked(self, widget):
+        if not self.application.is_configured():
+            # As long as were we are not yet configured, the send
+            # button is the one used for open the config dialog.
+            # It's label is also updated appropriately in ``update_ui``.
+            self.show_configure_window()
+            return
+
+        self.window.hide()
+
+        # Store the window current options in the settings, so
+        # they'll be the default next time around.
+        # Note: An alternative would be updating those whenever the
+        # widget are changed, as opposed to only on send.
+        do_convert = self.objects.get_object('convert-checkbox').get_active()
+        self.application.config['state']['convert'] = do_convert
+        self.application.config['state']['free'] = \
+            self.free_radiobutton.get_active()
+        self.application.notify_config_changed()
+
+        # Queue the documents to be sent in the background
+        if self.warm_up:
+            self.warm_up.release()
+            self.warm_up = None
+        job = SendJob(self.get_recipient(), self.filenames, convert=do_convert,
+                      priority=PRIORITY_INTERACTIVE)
+        job.window = self
+        self.application.send(job)
+
+    def _free_paid_radiobutton_toggled(self, widget):
+        self.update_ui(state=False)
+
+    def _window_destroy(self, widget):
+        if self.info_cancellable:
+            self.info_cancellable.cancel()
+            self.info_cancellable = None
+        if self.warm_up:
+            self.warm_up.cancel()
+            self.warm_up = None
+        self.application.disconnect(self.config_handler)
+        self.application.window_closed(self)
+
+    def _config_changed(self, app, settings):
+        self.update_ui()
+        self.start_warm_up()
+
+    def update_ui(self, state=True):
+        """Updates various UI elements to match current settings,
+        UI selections etc.
+        """
+
+        # Cost
+        in_us = self.application.config['settings']['user']['in_us']
+        cost_per_mb = Decimal("0.15") if in_us else Decimal("0.99")
+        free = self.free_radiobutton.get_active()
+        # What is uploaded: compressed, if the files have been packaged
+        # already, and encoded
+        if self.wire_size is not None:
+            size = self.wire_size
+        else:
+            size = base64_size(self.filesize)
+        if free:
+            cost = 0
+        else:
+            cost = Decimal.from_float(size / 1024.0 / 1024) / cost_per_mb
+        self.cost_label.set_label("Estimated Cost: $%.2f" % round(cost, 2))
+        self.cost_label.set_visible(cost!=0)
+
+        # If not yet configured, force the user to do so first
+        if not self.application.is_configured():
+            self.send_button.set_label('Setup your Kindle first')
+            self.configure_button.hide()
+        else:
+            self.send_button.set_label('Send to %s' % self.get_recipient())
+            self.configure_button.show()
+
+        # State
+        if state:
+            state = self.application.config['state']
+            self.free_radiobutton.set_active(state['free'])
+            self.objects.get_object('convert-checkbox').set_active(
+                state['convert'])
+
+    def get_recipient(self):
+        """Return the currently configured recipient.
+        """
+        return self.application.get_recipient(
+            self.free_radiobutton.get_active())
+
+    def show_configure_window(self):
+        configure_window = ConfigureWindow(self.application)
+        configure_window.show()
+
+    def use_files(self, filenames):
+        """Make the window preview the send of the given files.
+        """
+        self.filenames = []
+        self.filesize = 0
+        self.wire_size = None
+        if self.info_cancellable:
+            self.info_cancellable.cancel()
+        self.info_cancellable = cancellable = Gio.Cancellable()
+        self.info_pending = len(filenames)
+        for filename in filenames:
+            # Let GIO make us an absolute path; files GVFS can only
+            # reach by URI are read through GIO when sending.
+            file = Gio.File.new_for_commandline_arg(filename)
+            self.filenames.append(file.get_path() or file.get_uri())
+
+            # Get icon and filesize without blocking the window, which
+            # may take a while for files on a network share
+            file.query_info_async(
+                'standard::icon,standard::size',
+                Gio.FileQueryInfoFlags.NONE, GLib.PRIORITY_DEFAULT,
+                cancellable, self._query_info_done, cancellable)
+
+        # Update the UI - show the filename, and the size once known
+        label = self.objects.get_object('filename-label')
+        if len(self.filenames) == 1:
+            title = self.filenames[0]
+        else:
+            title = '%d documents' % len(self.filenames)
+        self.title = GLib.markup_escape_text(title)
+        label.set_markup(self.title)
+        label.set_tooltip_text('\n'.join(self.filenames))
+        # Show the icon (of the first file, if there are multiple)
+        image = self.objects.get_object('file-icon-image')
+        if len(self.filenames) == 1:
+            image.set_from_icon_name('text-x-generic', Gtk.IconSize.DIALOG)
+        else:
+            image.set_from_icon_name('document-multiple', Gtk.IconSize.DIALOG)
+
+        self.update_ui()
+
+    def _query_info_done(self, file, result, cancellable):
+        if cancellable is not self.info_cancellable:
+            # The window has moved on to other files
+            return
+        try:
+            fileinfo = file.query_info_finish(result)
+        except GLib.GError:
+            # Sending will report it
+            fileinfo = None
+        self.info_pending -= 1
+        if fileinfo:
+            self.filesize += fileinfo.get_size()
+            if len(self.filenames) == 1:
+                self.objects.get_object('file-icon-image').set_from_gicon(
+                    fileinfo.get_icon(), Gtk.IconSize.DIALOG)
+        if not self.info_pending:
+            self.objects.get_object('filename-label').set_markup(
+                "%s\n<small><i>%s</i></small>" % (
+                    self.title, sizeof_fmt(self.filesize)))
+            self.update_ui(state=False)
+
+    def start_warm_up(self):
+        """Connect to the SMTP server and prepare the files in the
+        background while the window is shown, so that sending only
+        needs to upload them.
+        """
+        if not self.filenames or not self.window.get_visible() or \
+                not self.application.is_configured():
+            return
+        sender = self.application.get_sender()
+        if self.warm_up:
+            if self.warm_up.sender is sender:
+                return
+            # The settings have changed
+            self.warm_up.cancel()
+            self.wire_size = None
+        self.send_button.set_tooltip_text(None)
+        self.warm_up = sender.warm_up(
+            self.filenames,
+            lambda warm_up: GObject.idle_add(self._warm_up_done, warm_up))
+
+    def _warm_up_done(self, warm_up):
+        if warm_up is self.warm_up:
+            self.wire_size = warm_up.wire_size
+            # Sending will fail the same way, unless it was a glitch
+            if warm_up.error:
+                self.send_button.set_tooltip_text(
+                    'Could not prepare sending: %s' % warm_up.error)
+            self.update_ui(state=False)
+
+    def show(self):
+        self.window.show_all()
+        self.start_warm_up()
+
+    def close(self):
+        self.window.destroy()
+
+
+class GtkApplication(Application, GObject.GObject):
+
+    __gsignals__ = {
+        "config-changed": (
+            GObject.SignalFlags.RUN_FIRST, None, (object,)),
+    }
+
+    def __init__(self):
+        super(GtkApplication, self).__init__()
+
+        # For some reason this seems to be disabled by default.
+        Gtk.Settings.get_default().set_long_property(
+            'gtk-button-images', True, 'main')
+
+        self.windows = []
+        self.failed_jobs = []
+        self.server = None
+        # If set, keep running when there is nothing left to do.
+        self.persistent = False
+
+        self.queue = SendQueue(
+            self.get_sender, Spool(path.join(self.get_data_path(), 'spool')))
+        self.queue.start()
+
+        # The app indicator is only created once there is something
+        # to show in it, see ``update_indicator``.
+        self.indicator = None
+
+    def resume(self):
+        """Pick up the sends a previous instance left off with.
+        """
+        for job in self.queue.spool.load(on_error=self._spool_error):
+            self.send(job)
+
+    def _spool_error(self, filename, error):
+        notify("Failed to resume sending to Kindle",
+               'A send left off before could not be read (%s): %s' % (
+                   filename, error),
+               "dialog-error")
+
+    def listen(self):
+        """Start accepting requests from other instances. Returns
+        False if another instance is already running.
+        """
+        self.server = IPCServer.listen(self.handle_request)
+        return self.server is not None
+
+    def handle_request(self, request):
+        """Handle a request from another instance. This is called in
+        a server thread; anything touching the UI is deferred to the
+        main loop.
+        """
+        command = request.get('command')
+        if command == 'ping':
+            return {'status': 'ok'}
+        elif command == 'open':
+            GObject.idle_add(self.open_window, request['files'])
+            return {'status': 'ok'}
+        elif command == 'send':
+            if not self.is_configured():
+                return {'error': 'Not configured'}
+            job = SendJob(
+                request.get('recipient') or
+                    self.get_recipient(request.get('free', True)),
+                request['files'], request.get('convert', True),
+                request.get('force', False))
+            GObject.idle_add(self.send, job)
+            return {'status': 'queued'}
+        return {'error': 'Unknown command: %s' % command}
+
+    def open_window(self, filenames):
+        """Show a window to send the given files.
+        """
+        window = MainWindow(self)
+        window.use_files(filenames)
+        window.show()
+        self.windows.append(window)
+
+    def window_closed(self, window):
+        self.windows.remove(window)
+        self.failed_jobs = [
+            job for job in self.failed_jobs
+            if getattr(job, 'window', None) is not window]
+        self.update_indicator()
+        self.quit_if_done()
+
+    def send(self, job):
+        """Queue a ``SendJob``.
+        """
+        job.on_done = lambda job: GObject.idle_add(self._job_done, job)
+        job.on_retry = lambda job: GObject.idle_add(self.update_indicator)
+        job.on_progress = lambda job: GObject.idle_add(self.update_indicator)
+        self.queue.put(job)
+        self.update_indicator()
+
+    def _job_done(self, job):
+        window = getattr(job, 'window', None)
+        if job.cancelled:
+            if window:
+                window.close()
+        elif not job.error:
+            # File has been sent; show a notification.
+            if job.skipped == job.files:
+                text = '%s had already been sent before.' % job.describe()
+            else:
+                text = '%s has been sent.' % job.describe()
+            notify("Sent to Kindle", text, "dialog-ok")
+            if window:
+                window.close()
+        else:
+            # File has not been sent. Show an error
+            notify("Failed to send to Kindle",
+                   '%s could not be sent: %s' % (job.describe(), job.error),
+                   "dialog-error")
+
+            # Put the indicator in error mode, the user may have
+            # missed the notification
+            self.failed_jobs.append(job)
+
+        self.update_indicator()
+        self.quit_if_done()
+
+    def update_indicator(self):
+        """Bring the app indicator up to date, creating it if it is
+        needed for the first time.
+        """
+        if not self.indicator:
+            if not self.failed_jobs and self.queue.is_idle():
+                return
+            self.indicator = Indicator(self)
+        self.indicator.update()
+
+    def abort(self):
+        """Abort all sends. A send in progress stops after the chunk
+        currently being uploaded.
+        """
+        for job in self.queue.cancel():
+            window = getattr(job, 'window', None)
+            if window:
+                window.close()
+        self.update_indicator()
+        self.quit_if_done()
+
+    def notify_config_changed(self):
+        """Should be called by whoever modifies the configuration
+        after he is done.
+        """
+        self.emit('config-changed', self.config)
+
+    def quit_if_done(self):
+        """Stop the application unless there are windows open, sends
+        in progress, or errors not yet seen by the user.
+        """
+        if self.persistent:
+            return
+        if self.windows or self.failed_jobs or not self.queue.is_idle():
+            return
+        self.stop()
+
+    def run(self):
+        """Run the application.
+        """
+        # The send queue and the IPC server never touch the UI from
+        # their threads, they go through idle_add; so there is no need
+        # for the GDK lock.
+        Gtk.main()
+
+    def stop(self):
+        """Sto the application.
+        """
+        # Before we go, save the config; in particular, we're
+        # interested in saving the state.
+        self.save_config()
+        if self.server:
+            self.server.stop()
+        if self.sender:
+            self.sender.close()
+
+        Gtk.main_quit()
+
+
+def format_start(start):
+    """Describe when a queued job is expected to start, given the
+    time ``start``.
+    """
+    minutes = int(round((start - time.time()) / 60))
+    if minutes < 1:
+        return 'starts in under a minute'
+    if minutes < 60:
+        return 'starts in about %d min' % minutes
+    return 'starts at %s' % time.strftime('%H:%M', time.localtime(start))
+
+
+class Indicator(object):
+    """Encapsulates the Ubuntu App indicator, which reflects the
+    state of the application's send queue.
+    """
+
+    # How many of the queued jobs are listed in the menu
+    QUEUED_ITEMS = 5
+
+    def __init__(self, application):
+        self.application = application
+        self._create_indicator()
+
+    def _create_indicator(self):
+        try:
+            from gi.repository import AppIndicator3 as AppIndicator
+        except ImportError:
+            from gi.repository import AppIndicator
+        self.AppIndicator = AppIndicator
+        self.ind = ind = AppIndicator.Indicator.new(
+            "sendtokindle",
+            "sendtokindle-indicator",
+            AppIndicator.IndicatorCategory.APPLICATION_STATUS)
+        ind.set_status(AppIndicator.IndicatorStatus.PASSIVE)
+        ind.set_attention_icon ("sendtokindle-indicator-error")
+
+        # Attach the required menu
+        self.menu = Gtk.Menu()
+
+        self.abort_menuitem = item = Gtk.MenuItem()
+        item.connect("activate", self._abort_item_activate)
+        item.show()
+        self.menu.append(item)
+
+        # The jobs waiting, with their position and estimated start
+        self.queued_menuitems = []
+        for index in range(self.QUEUED_ITEMS):
+            item = Gtk.MenuItem()
+            item.set_sensitive(False)
+            self.menu.append(item)
+            self.queued_menuitems.append(item)
+
+        # TODO: It would be nicer if this were not a submenu, but
+        # clicking the indicator itself shows the error. Apparently
+        # this might be possible in AppIndicator3.
+        self.error_menuitem = item = Gtk.MenuItem()
+        item.connect("activate", self._error_item_activate)
+        item.show()
+        self.menu.append(item)
+
+        self.menu.show()
+        ind.set_menu(self.menu)
+
+    def _abort_item_activate(self, widget):
+        self.application.abort()
+
+    def _error_item_activate(self, widget):
+        failed_jobs = self.application.failed_jobs
+        self.application.failed_jobs = []
+        self.update()
+
+        # Give the user the chance to retry
+        parent = None
+        for job in failed_jobs:
+            window = getattr(job, 'window', None)
+            if window:
+                window.show()
+                parent = window.window
+
+        md = Gtk.MessageDialog(
+            parent,
+            Gtk.DialogFlags.DESTROY_WITH_PARENT, Gtk.MessageType.ERROR,
+            Gtk.ButtonsType.OK,
+            "An error occurred trying to send the documents: %s" % (
+                failed_jobs[-1].error))
+        md.set_title('Failed to send to Kindle')
+        md.run()
+        md.destroy()
+        self.application.quit_if_done()
+
+    def update(self):
+        """Refresh the indicator and its menu to the current state
+        of the send queue.
+
+        Error mode represents state after a failed send.
+        """
+        queue = self.application.queue
+        current = queue.current
+        schedule = queue.get_schedule()
+        jobs = ([current] if current else []) + [job for job, start in schedule]
+        failed_jobs = self.application.failed_jobs
+
+        # There are a number of strange bugs I ran across with changing
+        # the menu item visibility and text dynamically. Setting this
+        # as early as possible helps.
+        progress = None
+        if jobs:
+            job = jobs[0]
+            label = 'Abort sending %s' % job.describe()
+            if job is queue.current and job.progress.total:
+                progress = job.progress
+                label += ' (%s of %s, %s/s%s)' % (
+                    sizeof_fmt(progress.sent), sizeof_fmt(progress.total),
+                    sizeof_fmt(progress.rate),
+                    ', rate limited' if progress.paused else '')
+            elif job.attempts:
+                label += ' (retry %d after: %s)' % (
+                    job.attempts, job.last_error)
+            if len(jobs) > 1:
+                label += ' and %d more' % (len(jobs) - 1)
+            self.abort_menuitem.set_label(label)
+
+        # The jobs after the first, in the order they will be sent
+        queued = schedule if current else schedule[1:]
+        for index, item in enumerate(self.queued_menuitems):
+            if index < len(queued):
+                job, start = queued[index]
+                label = '%d. %s' % (index + 1, job.describe())
+                if job.attempts:
+                    label += ', retry %d' % job.attempts
+                if start:
+                    label += ', ' + format_start(start)
+                item.set_label(label)
+            item.set_visible(index < len(queued))
+        if failed_jobs:
+            self.error_menuitem.set_label(
+                'Error sending %s' % failed_jobs[-1].describe())
+
+        # On Natty, sometimes this works, sometimes a menu item
+        # is not shown when it should (usually the error item).
+        # Sometimes there is segmentation fault.
+        self.abort_menuitem.set_visible(bool(jobs))
+        self.error_menuitem.set_visible(bool(failed_jobs))
+
+        if progress:
+            percent = '%d%%' % (100 * progress.sent / progress.total)
+            self.ind.set_label(percent, '100%')
+        else:
+            self.ind.set_label('', '')
+
+        if failed_jobs:
+            self.ind.set_status(self.AppIndicator.IndicatorStatus.ATTENTION)
+        elif jobs:
+            self.ind.set_status(self.AppIndicator.IndicatorStatus.ACTIVE)
+        else:
+            self.ind.set_status(self.AppIndicator.IndicatorStatus.PASSIVE)
+
+
+def choose_files():
+    """Let the user choose the files to send. Returns an empty list
+    if the dialog is cancelled.
+    """
+    dialog = Gtk.FileChooserDialog(title="Choose files to send", parent=None,
+            action=Gtk.FileChooserAction.OPEN,
+            buttons=(Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL,
+                     Gtk.STOCK_OPEN, Gtk.ResponseType.OK))
+    dialog.set_select_multiple(True)
+    # Also offer the locations GVFS can reach, like SMB shares
+    dialog.set_local_only(False)
+    try:
+        response = dialog.run()
+        if response == Gtk.ResponseType.OK:
+            return [Gio.File.new_for_uri(uri).get_path() or uri
+                    for uri in dialog.get_uris()]
+        return []
+    finally:
+        dialog.destroy()
+
+
+def run(filenames, persistent=False):
+    """Run the GUI as the single instance, showing a window for
+    ``filenames``, if any.
+    """
+    GObject.threads_init()
+    application = GtkApplication()
+    application.persistent = persistent
+    if not application.listen():
+        # Another instance started in the meantime
+        if filenames:
+            send_request({'command': 'open', 'files': filenames})
+        return 0
+    if filenames:
+        application.open_window(filenames)
+    # Only once the window is up
+    GObject.idle_add(application.resume)
+    application.run()
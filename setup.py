@@ -18,12 +18,12 @@ if os.path.exists(os.path.join(here, 'sendtokindle.py')):
 # Figure out the version.
 import re
 here = os.path.dirname(os.path.abspath(__file__))
-fp = open(os.path.join(here, 'data', 'sendtokindle'))
+fp = open(os.path.join(here, 'sendkindle.py'))
 match = re.search(r'__version__ = (\(.*?\))', fp.read())
 if match:
     version = eval(match.group(1))
 else:
-    raise Exception("Cannot find version in __init__.py")
+    raise Exception("Cannot find version in sendkindle.py")
 fp.close()
 
 
@@ -46,5 +46,6 @@ setup(
     license="AGPL",
     description="Utility to send documents to your Kindle",
     data_files=data_files,
-    scripts=["data/sendtokindle"],
+    py_modules=["sendkindle", "sendkindle_gtk"],
+    scripts=["data/sendtokindle", "sendtokindle-cli"],
 )
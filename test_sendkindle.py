@@ -0,0 +1,598 @@
+# coding: utf8
+"""
+Tests of the sending core. Run them with::
+
+    $ python -m unittest test_sendkindle
+"""
+
+import os
+import ssl
+import time
+import base64
+import email
+import shutil
+import tempfile
+import threading
+import unittest
+
+import sendkindle
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='test-sendkindle-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_file(self, name, data):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename
+
+
+class OutgoingMessageTest(TempDirTestCase):
+
+    def parse(self, message):
+        parsed = email.message_from_string(''.join(message))
+        return [part for part in parsed.walk() if part.get_filename()]
+
+    def test_non_ascii_names(self):
+        data = 'Hello Kindle\n'
+        files = [self.make_file('r\xc3\xa9sum\xc3\xa9.pdf', data),
+                 self.make_file('plain.pdf', data)]
+        message = sendkindle.OutgoingMessage(
+            'me@example.com', 'kindle@example.com', files)
+        parts = self.parse(message)
+        self.assertEqual(len(''.join(message)), message.size)
+        self.assertEqual([part.get_filename() for part in parts],
+                         [u'r\xe9sum\xe9.pdf', 'plain.pdf'])
+        for part in parts:
+            self.assertEqual(part.get_payload(decode=True), data)
+
+    def test_unicode_name(self):
+        # As given over IPC
+        message = sendkindle.OutgoingMessage(
+            'me@example.com', 'kindle@example.com', [])
+        headers = message.get_part_headers(u'/tmp/r\xe9sum\xe9.pdf', 'base64')
+        part = email.message_from_string(headers)
+        self.assertEqual(part.get_filename(), u'r\xe9sum\xe9.pdf')
+
+    def test_unencoded_parts_release_pending(self):
+        # An attachment being encoded ahead of time, but sent as it is
+        cache = sendkindle.AttachmentCache(
+            os.path.join(self.directory, 'cache'), 1024 * 1024)
+        document = self.make_file('document.pdf', '\x00\xff' * 100)
+        done = threading.Event()
+        cache.add_pending(document, done.set)
+        message = sendkindle.OutgoingMessage(
+            'me@example.com', 'kindle@example.com', [document], cache=cache)
+        ''.join(message.generate('binarymime'))
+        self.assertTrue(done.wait(5))
+        self.assertEqual(cache.pending, {})
+
+
+class Base64SizeTest(unittest.TestCase):
+
+    def test_matches_encoder(self):
+        for size in (0, 1, 2, 3, 56, 57, 58, 114, 1000, 57 * 1024 + 5):
+            data = os.urandom(size)
+            encoded = sendkindle.encode_base64_chunk(data)
+            self.assertEqual(sendkindle.base64_size(size), len(encoded))
+            self.assertEqual(base64.b64decode(encoded.replace('\r\n', '')),
+                             data)
+
+
+class DotStuffTest(unittest.TestCase):
+
+    def stuff(self, chunks):
+        return ''.join(sendkindle.dot_stuff(chunks))
+
+    def test_within_chunk(self):
+        self.assertEqual(self.stuff(['a\r\n.b\r\n..c\r\nd.e\r\n']),
+                         'a\r\n..b\r\n...c\r\nd.e\r\n')
+
+    def test_first_line(self):
+        self.assertEqual(self.stuff(['.a\r\n']), '..a\r\n')
+
+    def test_chunk_boundaries(self):
+        message = 'a\r\n.b\r\n.\r\nc.\r\n..d\r\n'
+        expected = self.stuff([message])
+        # Every way of splitting the message in two or three
+        for i in range(len(message) + 1):
+            for j in range(i, len(message) + 1):
+                chunks = [message[:i], message[i:j], message[j:]]
+                self.assertEqual(self.stuff(chunks), expected, chunks)
+
+    def test_dot_after_line_break_in_previous_chunk(self):
+        self.assertEqual(self.stuff(['a\r\n', '.', 'b\r\n']),
+                         'a\r\n..b\r\n')
+        self.assertEqual(self.stuff(['a.', '.b']), 'a..b')
+
+
+class PackFilesTest(TempDirTestCase):
+
+    def make_files(self, sizes):
+        return [self.make_file('f%d' % i, 'x' * size)
+                for i, size in enumerate(sizes)]
+
+    def test_max_size(self):
+        files = self.make_files([600, 500, 400, 300, 200, 100])
+        max_size = sendkindle.base64_size(900) + 50
+        groups = sendkindle.pack_files(files, max_size=max_size)
+        self.assertEqual(sorted(sum(groups, [])), sorted(files))
+        for group in groups:
+            self.assertTrue(sum(sendkindle.base64_size(os.path.getsize(f))
+                                for f in group) <= max_size)
+        # 2100 bytes do not fit into two messages of 900
+        self.assertEqual(len(groups), 3)
+
+    def test_max_count(self):
+        files = self.make_files([10] * 7)
+        groups = sendkindle.pack_files(files, max_count=3)
+        self.assertEqual([len(group) for group in groups], [3, 3, 1])
+
+    def test_too_large(self):
+        files = self.make_files([2000, 10])
+        groups = sendkindle.pack_files(files, max_size=1000)
+        self.assertEqual(groups, [[files[0]], [files[1]]])
+
+    def test_missing_file(self):
+        self.assertRaises(OSError, sendkindle.pack_files,
+                          [os.path.join(self.directory, 'missing')])
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = sendkindle.TokenBucket(100, 200)
+        bucket.updated = now = time.time()
+        self.assertEqual(bucket.reserve(150), 0)
+        bucket.updated = now
+        self.assertAlmostEqual(bucket.reserve(100), 0.5, places=2)
+        self.assertAlmostEqual(bucket.waited, 0.5, places=2)
+
+    def test_refills_up_to_burst(self):
+        bucket = sendkindle.TokenBucket(100, 200)
+        bucket.tokens = 0
+        bucket.updated = time.time() - 10
+        self.assertEqual(bucket.reserve(200), 0)
+        bucket.updated = time.time()
+        self.assertAlmostEqual(bucket.reserve(100), 1.0, places=2)
+
+
+class ChooseRelayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.relays = [sendkindle.Relay('relay%d' % i)
+                       for i in range(3)]
+
+    def test_untried_first(self):
+        a, b, c = self.relays
+        self.assertIs(sendkindle.choose_relay(self.relays), a)
+        a.record_success(0.5)
+        self.assertIs(sendkindle.choose_relay(self.relays), b)
+        b.record_success(0.2)
+        self.assertIs(sendkindle.choose_relay(self.relays), c)
+        c.record_success(0.3)
+        self.assertIs(sendkindle.choose_relay(self.relays), b)
+
+    def test_failed_untried_counts_as_slowest(self):
+        a, b, c = self.relays
+        a.record_success(0.5)
+        b.record_success(0.2)
+        c.record_failure()
+        # As slow as the slowest, and worse for the failure
+        self.assertIs(sendkindle.choose_relay(self.relays), b)
+        self.assertIs(sendkindle.choose_relay(self.relays, exclude=[b]), a)
+
+    def test_load_by_weight(self):
+        a, b, c = self.relays
+        for relay in self.relays:
+            relay.record_success(0.1)
+        c.weight = 2.0
+        load = {}
+        for i in range(8):
+            relay = sendkindle.choose_relay(self.relays, load=load)
+            load[relay.key] = load.get(relay.key, 0) + 1
+        self.assertEqual([load[r.key] for r in self.relays], [2, 2, 4])
+
+
+class ReportTest(TempDirTestCase):
+
+    def test_relay_state(self):
+        settings = {'user': {'email': 'me@example.com'},
+                    'smtp': {'type': 'maildir',
+                             'path': os.path.join(self.directory, 'mail')}}
+        sender = sendkindle.SendKindle(settings)
+        records = []
+        sender.add_observer(records.append)
+        relay = sendkindle.Relay('relay', 587)
+        relay.record_success(0.25)
+        relay.record_failure()
+        message = sendkindle.OutgoingMessage(
+            'me@example.com', 'kindle@example.com', [])
+        sender.report(['kindle@example.com'], message,
+                      sendkindle.SendStats(), 1.0, relays=[relay])
+        self.assertEqual(records[0]['relays'], ['relay:587'])
+        state = records[0]['relay_state'][0]
+        self.assertEqual((state['host'], state['port']), ('relay', 587))
+        self.assertEqual(state['latency'], 0.25)
+        self.assertEqual(state['failures'], 1)
+
+    def test_failover(self):
+        settings = {'user': {'email': 'me@example.com'},
+                    'smtp': {'host': 'localhost', 'port': 0, 'type': '',
+                             'username': '', 'password': '',
+                             'relays': [{'host': 'down'}, {'host': 'up'}]}}
+        sender = sendkindle.SendKindle(settings)
+        down, up = sender.transport.relays
+
+        def connect(stats=None):
+            raise sendkindle.socket.error(111, 'Connection refused')
+
+        smtp = ScriptedSMTP([], [
+            (250, 'ok'), (250, 'ok'), (354, 'go ahead'), (250, 'queued')])
+        sender.transport.pools[down.key] = \
+            sendkindle.SMTPConnectionPool(connect)
+        sender.transport.pools[up.key] = sendkindle.SMTPConnectionPool(
+            lambda stats=None: smtp)
+        records = []
+        sender.add_observer(records.append)
+        sender.send_batch('kindle@example.com',
+                          [self.make_file('document.pdf', 'Hello Kindle\n')])
+        self.assertEqual(records[0]['relays'], ['down:25', 'up:25'])
+        self.assertEqual([state['failures']
+                          for state in records[0]['relay_state']], [1, 0])
+
+
+class SendQueueCostTest(unittest.TestCase):
+
+    def make_job(self, size, recipient='kindle@example.com',
+                 priority=sendkindle.PRIORITY_BATCH, waited=0):
+        job = sendkindle.SendJob(recipient, [], priority=priority)
+        job.size = size
+        job.queued_at = self.now - waited
+        return job
+
+    def setUp(self):
+        self.queue = sendkindle.SendQueue(None)
+        self.now = time.time()
+
+    def pick(self, jobs):
+        self.queue.pending = jobs
+        return self.queue._next_job(now=self.now)
+
+    def test_shortest_first(self):
+        small, large = self.make_job(1000), self.make_job(50 * 1024 * 1024)
+        self.assertIs(self.pick([large, small]), small)
+
+    def test_priority(self):
+        batch = self.make_job(1000)
+        interactive = self.make_job(
+            10 * 1024 * 1024, priority=sendkindle.PRIORITY_INTERACTIVE)
+        self.assertIs(self.pick([batch, interactive]), interactive)
+
+    def test_aging(self):
+        small = self.make_job(1000)
+        seconds = 50 * 1024 * 1024 / sendkindle.QUEUE_AGING_RATE + 1
+        large = self.make_job(50 * 1024 * 1024, waited=seconds)
+        self.assertIs(self.pick([small, large]), large)
+
+    def test_recipient_fairness(self):
+        busy = self.make_job(1000, 'busy@example.com')
+        other = self.make_job(2000, 'other@example.com')
+        self.queue.usage[('busy@example.com',)] = (1024 * 1024, self.now)
+        self.assertIs(self.pick([busy, other]), other)
+        # Usage is forgotten over time
+        self.queue.usage[('busy@example.com',)] = (
+            1024 * 1024, self.now - 20 * sendkindle.QUEUE_USAGE_HALF_LIFE)
+        self.assertIs(self.pick([busy, other]), busy)
+
+    def test_retry_not_due(self):
+        job = self.make_job(1000)
+        job.next_attempt = self.now + 60
+        self.assertIs(self.pick([job]), None)
+
+
+class LedgerTest(TempDirTestCase):
+
+    def test_non_ascii_names(self):
+        ledger = sendkindle.Ledger(os.path.join(self.directory, 'ledger'))
+        ledger.record('0' * 40, 'r\xc3\xa9sum\xc3\xa9.pdf',
+                      'kindle@example.com', True, '250 \xc3\xa9 ok')
+        ledger.record('1' * 40, u'r\xe9sum\xe9.pdf',
+                      'kindle@example.com', True, '250 ok')
+        self.assertTrue(ledger.has_sent('0' * 40, 'kindle@example.com'))
+        self.assertTrue(ledger.has_sent('1' * 40, 'kindle@example.com'))
+        ledger.close()
+
+
+class WarmUpTest(TempDirTestCase):
+
+    def test_reads_files_once(self):
+        settings = {'user': {'email': 'me@example.com'},
+                    'smtp': {'type': 'maildir',
+                             'path': os.path.join(self.directory, 'mail')}}
+        cache = sendkindle.AttachmentCache(
+            os.path.join(self.directory, 'cache'), 1024 * 1024)
+        sender = sendkindle.SendKindle(settings, cache)
+        document = self.make_file('document.pdf', 'Hello Kindle\n')
+        reads = []
+        iter_file = sendkindle.iter_file
+
+        def counting_iter_file(file_path, stats=None):
+            reads.append(file_path)
+            return iter_file(file_path, stats)
+
+        sendkindle.iter_file = counting_iter_file
+        try:
+            warm_up = sendkindle.WarmUp(
+                sender, [document], lambda warm_up: warm_up.release())
+            warm_up.run()
+        finally:
+            sendkindle.iter_file = iter_file
+        self.assertEqual(reads, [document])
+        self.assertEqual(sender.get_digest(document),
+                         sendkindle.file_digest(document))
+
+    def test_connection_error(self):
+        settings = {'user': {'email': 'me@example.com'},
+                    'smtp': {'host': 'localhost', 'port': 0, 'type': '',
+                             'username': '', 'password': ''}}
+        sender = sendkindle.SendKindle(settings)
+        relay = sender.transport.relays[0]
+
+        def connect(stats=None):
+            raise sendkindle.socket.error(111, 'Connection refused')
+
+        sender.transport.pools[relay.key] = \
+            sendkindle.SMTPConnectionPool(connect)
+        document = self.make_file('document.pdf', 'Hello Kindle\n')
+        done = []
+
+        def callback(warm_up):
+            done.append(warm_up)
+            warm_up.release()
+
+        warm_up = sendkindle.WarmUp(sender, [document], callback)
+        warm_up.run()
+        self.assertEqual(done, [warm_up])
+        self.assertTrue('Connection refused' in str(warm_up.error))
+        self.assertEqual(warm_up.wire_size,
+                         sendkindle.base64_size(len('Hello Kindle\n')))
+
+
+class ScriptedSMTP(object):
+    """Stands in for an ``smtplib.SMTP`` or ``smtplib.LMTP`` session,
+    answering with the ``replies`` given, in order. Like a strict
+    server, it refuses MAIL while a transaction is still open.
+    """
+
+    def __init__(self, extensions, replies, upload_time=0):
+        self.extensions = extensions
+        self.replies = list(replies)
+        self.upload_time = upload_time
+        self.commands = []
+        self.in_transaction = False
+
+    def has_extn(self, name):
+        return name.lower() in self.extensions
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def send(self, data):
+        if data[:4] in ('BDAT', 'RSET'):
+            self.commands.append(data.split()[0])
+            if data.endswith(' LAST\r\n'):
+                self.in_transaction = False
+        elif data == '.\r\n':
+            self.commands.append('.')
+            self.in_transaction = False
+        else:
+            time.sleep(self.upload_time)
+
+    def getreply(self):
+        return self.replies.pop(0)
+
+    def docmd(self, command):
+        self.commands.append(command.upper())
+        return self.getreply()
+
+    def mail(self, sender, options=()):
+        if self.in_transaction:
+            self.commands.append('MAIL')
+            return 503, 'nested MAIL command'
+        self.in_transaction = True
+        return self.docmd('mail')
+
+    def rcpt(self, recipient):
+        return self.docmd('rcpt')
+
+    def rset(self):
+        self.in_transaction = False
+        return self.docmd('rset')
+
+    def quit(self):
+        pass
+
+
+class LMTPTransferTest(TempDirTestCase):
+
+    recipients = ['a@example.com', 'b@example.com']
+
+    def transfer(self, smtp, size):
+        settings = {'host': 'localhost', 'port': 0, 'type': 'lmtp',
+                    'username': '', 'password': ''}
+        self.transport = sendkindle.LMTPTransport(settings)
+        message = sendkindle.OutgoingMessage(
+            'me@example.com', ', '.join(self.recipients),
+            [self.make_file('document.bin', 'x' * size)])
+        self.delivery = sendkindle.Delivery(
+            'me@example.com', self.recipients, message)
+        self.delivery.relay = self.transport.relays[0]
+        return self.transport.transfer(smtp, self.delivery)
+
+    def test_reply_per_recipient(self):
+        smtp = ScriptedSMTP(['chunking'], [
+            (250, 'ok'), (250, 'ok'), (250, 'ok'),
+            (250, 'delivered'), (452, 'mailbox full')])
+        delivered, refused = self.transfer(smtp, 1000)
+        self.assertEqual(delivered, {'a@example.com': '250 delivered'})
+        self.assertEqual(refused, {'b@example.com': (452, 'mailbox full')})
+        self.assertEqual(smtp.replies, [])
+
+    def test_latency_excludes_upload(self):
+        smtp = ScriptedSMTP(['chunking'], [
+            (250, 'ok'), (250, 'ok'), (250, 'ok'),
+            (250, 'delivered'), (250, 'delivered')], upload_time=0.2)
+        self.transfer(smtp, 1000)
+        self.transport.reroute(self.delivery, None)
+        self.assertTrue(self.delivery.relay.latency < 0.1)
+
+    def test_rejected_chunk(self):
+        # The first of several chunks is refused: there is one reply
+        # for the transaction, and not one per recipient
+        smtp = ScriptedSMTP(['chunking'], [
+            (250, 'ok'), (250, 'ok'), (250, 'ok'),
+            (552, 'too big'), (250, 'reset')])
+        self.assertRaises(sendkindle.smtplib.SMTPDataError, self.transfer,
+                          smtp, sendkindle.BDAT_CHUNK_SIZE)
+        self.assertEqual(smtp.commands,
+                         ['MAIL', 'RCPT', 'RCPT', 'BDAT', 'RSET'])
+        self.assertEqual(smtp.replies, [])
+
+
+class PooledTransferTest(TempDirTestCase):
+
+    def test_session_reset_after_refused_data(self):
+        smtp = ScriptedSMTP([], [
+            (250, 'ok'), (250, 'ok'), (451, 'try again later'),
+            (250, 'reset'),
+            (250, 'ok'), (250, 'ok'), (354, 'go ahead'), (250, 'queued')])
+        settings = {'host': 'localhost', 'port': 0, 'type': '',
+                    'username': '', 'password': ''}
+        transport = sendkindle.SMTPTransport(settings)
+        relay = transport.relays[0]
+        transport.pools[relay.key] = sendkindle.SMTPConnectionPool(
+            lambda stats=None: smtp)
+        message = sendkindle.OutgoingMessage(
+            'me@example.com', 'kindle@example.com',
+            [self.make_file('document.pdf', 'Hello Kindle\n')])
+
+        def deliver():
+            return transport.deliver(sendkindle.Delivery(
+                'me@example.com', ['kindle@example.com'], message))
+
+        self.assertRaises(sendkindle.smtplib.SMTPDataError, deliver)
+        delivered, refused = deliver()
+        self.assertEqual(delivered, {'kindle@example.com': '250 queued'})
+        self.assertEqual(smtp.commands, ['MAIL', 'RCPT', 'DATA', 'RSET',
+                                         'MAIL', 'RCPT', 'DATA', '.'])
+        self.assertEqual(smtp.replies, [])
+
+    def test_refused_recipient_fails_batch(self):
+        smtp = ScriptedSMTP([], [
+            (250, 'ok'), (250, 'ok'), (550, 'no such device'),
+            (354, 'go ahead'), (250, 'queued')])
+        settings = {'user': {'email': 'me@example.com'},
+                    'smtp': {'host': 'localhost', 'port': 0, 'type': '',
+                             'username': '', 'password': ''}}
+        sender = sendkindle.SendKindle(settings)
+        relay = sender.transport.relays[0]
+        sender.transport.pools[relay.key] = sendkindle.SMTPConnectionPool(
+            lambda stats=None: smtp)
+        document = self.make_file('document.pdf', 'Hello Kindle\n')
+        try:
+            sender.send_batch(['a@example.com', 'b@example.com'], [document])
+        except sendkindle.SendKindleException, e:
+            self.assertEqual(e.files, [document])
+            self.assertTrue('refused by b@example.com (550 no such device)'
+                            in str(e), str(e))
+        else:
+            self.fail('the refused recipient was not reported')
+
+
+class BrokenSender(object):
+
+    def plan(self, recipient, files, convert, force):
+        raise KeyError('broken')
+
+
+class UnreachableSender(BrokenSender):
+
+    def plan(self, recipient, files, convert, force):
+        raise sendkindle.socket.error(111, 'Connection refused')
+
+
+class RefusingSender(object):
+
+    def plan(self, recipient, files, convert, force):
+        return [(sendkindle.as_list(recipient), files)]
+
+    def prefetch(self, files, mode=None):
+        pass
+
+    def create_message(self, recipients, group, convert):
+        return group
+
+    def send_message(self, recipients, message, progress):
+        return ({recipients[0]: '250 ok'},
+                {recipients[1]: (550, 'no such device')})
+
+    def record_delivery(self, files, delivered, convert):
+        pass
+
+
+class SendQueueTest(TempDirTestCase):
+
+    def test_unexpected_error_fails_job(self):
+        spool = sendkindle.Spool(self.directory)
+        queue = sendkindle.SendQueue(BrokenSender, spool)
+        job = sendkindle.SendJob('kindle@example.com', ['a.pdf'])
+        queue.put(job)
+        self.assertTrue(queue.process(job))
+        self.assertEqual(job.failed, ['a.pdf'])
+        self.assertTrue('unexpected error' in str(job.error))
+        self.assertEqual(spool.load(), [])
+
+    def test_transient_error_is_retried(self):
+        queue = sendkindle.SendQueue(UnreachableSender)
+        job = sendkindle.SendJob('kindle@example.com', ['a.pdf'])
+        self.assertFalse(queue.process(job))
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue('Connection refused' in job.last_error)
+        self.assertEqual(job.failed, [])
+
+    def test_unreadable_spool_entry(self):
+        spool = sendkindle.Spool(self.directory)
+        self.make_file('broken.json', '{')
+        errors = []
+        self.assertEqual(spool.load(
+            on_error=lambda filename, e: errors.append(filename)), [])
+        self.assertEqual(errors, [os.path.join(self.directory, 'broken.json')])
+
+    def test_refused_recipient_fails_job(self):
+        queue = sendkindle.SendQueue(RefusingSender)
+        job = sendkindle.SendJob(['a@example.com', 'b@example.com'],
+                                 ['a.pdf'])
+        self.assertTrue(queue.process(job))
+        self.assertEqual(job.failed, ['a.pdf'])
+        self.assertTrue('refused by b@example.com' in str(job.error))
+
+    def test_transient_errors(self):
+        self.assertTrue(sendkindle.is_transient_error(
+            sendkindle.socket.error(104, 'Connection reset by peer')))
+        self.assertTrue(sendkindle.is_transient_error(
+            ssl.SSLEOFError(8, 'EOF occurred in violation of protocol')))
+        self.assertFalse(sendkindle.is_transient_error(
+            ssl.SSLError(1, 'certificate verify failed')))
+        self.assertFalse(sendkindle.is_transient_error(
+            ssl.CertificateError("hostname doesn't match")))
+
+
+if __name__ == '__main__':
+    unittest.main()